@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import shutil
+import threading
+
+class ArchiveCache():
+    """ A disk cache of zipped directories keyed by FileManager.tree_signature
+    An unchanged directory is served from cache instead of being walked and deflated again, a changed directory has a new signature and is rebuilt
+    Least recently used archives are removed when the cache is over max_size
+    Each archive is stored as root/[signature].zip with its info in root/[signature].json
+    """
+    def __init__(self, root:str, max_size:int=512*1024*1024):
+        """Open or create a cache at root
+        @param `root:str` directory of the cache, create if DNE
+        @param `max_size:int` max total bytes of cached archives, <0 for no limit
+        """
+        self.root = os.path.realpath(root)
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _archive_path(self, signature:str)->str:
+        return os.path.join(self.root, f"{signature}.zip")
+
+    def _info_path(self, signature:str)->str:
+        return os.path.join(self.root, f"{signature}.json")
+
+    def get(self, signature:str)->tuple:
+        """Get a cached archive
+        @param `signature:str` tree signature of the directory
+        @return `:tuple len(2)` (archive:file object opened "rb", info:dict) or None if not cached, caller must close archive
+        """
+        with self._lock:
+            try:
+                with open(self._info_path(signature), "r") as f:
+                    info = json.load(f)
+                archive = open(self._archive_path(signature), "rb")
+            except (OSError, ValueError):
+                return None
+            # mtime is used as last access time for eviction
+            os.utime(self._archive_path(signature))
+        return (archive, info)
+
+    def put(self, signature:str, archive, info:dict):
+        """Copy an archive into the cache, then remove least recently used archives over max_size
+        @param `signature:str` tree signature of the directory
+        @param `archive:file object` archive to copy from its current position, position is restored after
+        @param `info:dict` archive info from FileManager.zip_directory
+        """
+        position = archive.tell()
+        temp_path = f"{self._archive_path(signature)}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            shutil.copyfileobj(archive, f)
+        archive.seek(position)
+        with self._lock:
+            os.replace(temp_path, self._archive_path(signature))
+            with open(self._info_path(signature), "w") as f:
+                json.dump(info, f)
+            self._evict(keep=signature)
+
+    def _evict(self, keep:str=""):
+        """Remove least recently used archives until cache is under max_size, must hold self._lock
+        @param `keep:str` signature of an archive that must not be removed
+        """
+        if self.max_size < 0:
+            return
+        archives = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".zip"):
+                entry_stat = entry.stat()
+                archives.append((entry_stat.st_mtime, entry_stat.st_size, entry.name[:-len(".zip")]))
+        total_size = sum(size for _, size, _ in archives)
+        for _, size, signature in sorted(archives):
+            if total_size <= self.max_size:
+                break
+            if signature == keep:
+                continue
+            for path in (self._archive_path(signature), self._info_path(signature)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
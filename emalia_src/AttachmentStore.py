@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import stat
+import shutil
+import hashlib
+import tempfile
+import threading
+try:
+    import fcntl # posix only, no reflink without it
+except ImportError:
+    fcntl = None
+
+# ioctl of linux to clone a file on copy on write file systems (btrfs, xfs), data blocks are shared until one side is modified
+_FICLONE = 0x40049409
+
+class AttachmentStore():
+    """ A content addressed, deduplicated file store for email attachments
+    Each file is stored once at root/ab/cd/abcd...(sha256), same file received again only adds a reference
+    Files to read are handed out by link() as read only hard links, so a repeated file costs no disk space or write, files that may be modified are handed out by copy() (reflink when the file system supports it)
+    A reference is a link or copy in use, example the link of an attachment in the folder of an email, it must be released when it is removed
+    index.json keeps size, refcount, last access time and known names of each file, used by gc() to evict least recently used files when store is over max_size
+    Changes are appended to index.log, index.json is only rewritten when the store is opened or the log grows past the index
+    """
+    index_name = "index.json"
+    log_name = "index.log"
+
+    def __init__(self, root:str, max_size:int=-1):
+        """Open or create a store at root
+        @param `root:str` directory of the store, create if DNE
+        @param `max_size:int` max total bytes of stored files, least recently used files are removed by gc() over this size, <0 for no limit
+        """
+        self.root = os.path.realpath(root)
+        self.max_size = max_size
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+        self._lock = threading.RLock()
+        self._index = self._load_index()
+        self._log_size = 0 # records in index.log
+        self._save_index()
+
+    def _load_index(self)->dict:
+        """Read index.json and replay index.log
+        @return `:dict` {sha256: {"size": int, "refcount": int, "last_access": float, "names": list of str}}, only files still on disk
+        """
+        index = {}
+        try:
+            with open(os.path.join(self.root, self.index_name), "r") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            index = {}
+        try:
+            with open(os.path.join(self.root, self.log_name), "r") as f:
+                for line in f:
+                    try:
+                        self._apply(index, json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        # last line may be cut by a crash
+                        continue
+        except FileNotFoundError:
+            pass
+        return {sha256: entry for sha256, entry in index.items() if os.path.exists(self.object_path(sha256))}
+
+    @staticmethod
+    def _apply(index:dict, record:dict):
+        """Apply one index.log record to index
+        @param `record:dict` {"op": "add"|"ref"|"release"|"access"|"remove", "sha256": str, "time": float, "size": int, "name": str}
+        """
+        sha256 = record["sha256"]
+        if record["op"] == "add":
+            index[sha256] = {"size": record["size"], "refcount": 1, "last_access": record["time"], "names": [record["name"]] if record.get("name") else []}
+            return
+        entry = index.get(sha256)
+        if entry is None:
+            return
+        if record["op"] == "ref":
+            entry["refcount"] += 1
+            entry["last_access"] = record["time"]
+            if record.get("name") and record["name"] not in entry["names"]:
+                entry["names"].append(record["name"])
+        elif record["op"] == "release":
+            entry["refcount"] = max(0, entry["refcount"] - 1)
+        elif record["op"] == "access":
+            entry["last_access"] = record["time"]
+        elif record["op"] == "remove":
+            del index[sha256]
+
+    def _log(self, op:str, sha256:str, **fields):
+        """Apply a change to the index and append it to index.log, must hold self._lock
+        index.json is rewritten once the log has more records than the index has files
+        """
+        record = {"op": op, "sha256": sha256, "time": time.time(), **fields}
+        self._apply(self._index, record)
+        with open(os.path.join(self.root, self.log_name), "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self._log_size += 1
+        if self._log_size > max(1000, len(self._index)):
+            self._save_index()
+
+    def _save_index(self):
+        """Write index.json atomically and empty index.log, must hold self._lock or be in __init__"""
+        index_path = os.path.join(self.root, self.index_name)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self._index, f)
+        os.replace(index_path + ".tmp", index_path)
+        open(os.path.join(self.root, self.log_name), "w").close()
+        self._log_size = 0
+
+    def object_path(self, sha256:str)->str:
+        """Path of a stored file, sharded by the first 4 hex characters of its hash
+        @param `sha256:str` hex digest of the file
+        @return `:str` path of the file, may not exist
+        """
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def temp_file(self):
+        """Create a temp file inside the store, so add_file can move it in without copying
+        @return `:file object` opened "wb", not deleted on close
+        """
+        return tempfile.NamedTemporaryFile("wb", dir=os.path.join(self.root, "tmp"), prefix=".spool-", delete=False)
+
+    def __contains__(self, sha256:str)->bool:
+        with self._lock:
+            return sha256 in self._index
+
+    def total_size(self)->int:
+        """@return `:int` total bytes of stored files"""
+        with self._lock:
+            return sum(entry["size"] for entry in self._index.values())
+
+    def add_reference(self, sha256:str, name:str="")->bool:
+        """Add a reference to a file already stored, no data is written
+        @param `sha256:str` hex digest of the file
+        @param `name:str` file name to remember, optional
+        @return `:bool` True if file is stored, False if not (caller should add_file)
+        """
+        with self._lock:
+            if sha256 not in self._index:
+                return False
+            self._log("ref", sha256, name=name)
+            return True
+
+    def add_file(self, file_path:str, sha256:str="", name:str="", target_path:str="")->str:
+        """Move a file into the store with one reference, file_path is removed. If same content is already stored only a reference is added
+        @param `file_path:str` file to move in, best created with temp_file() so it is on the same file system
+        @param `sha256:str` hex digest of the file if already known, computed otherwise
+        @param `name:str` file name to remember, optional
+        @param `target_path:str` if set, a read only link of the stored file is placed there, the link the reference is for
+        @return `:str` sha256 of the file
+        """
+        if not sha256:
+            file_hash = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    file_hash.update(chunk)
+            sha256 = file_hash.hexdigest()
+        with self._lock:
+            if self.add_reference(sha256, name):
+                os.remove(file_path)
+            else:
+                object_path = self.object_path(sha256)
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                shutil.move(file_path, object_path)
+                # stored files are shared by every link handed out, they must never be written
+                os.chmod(object_path, stat.S_IREAD)
+                self._log("add", sha256, size=os.path.getsize(object_path), name=name)
+            if target_path:
+                self.link(sha256, target_path)
+        self.gc(keep=sha256)
+        return sha256
+
+    def link(self, sha256:str, target_path:str)->str:
+        """Place a stored file at target_path as a read only hard link, no data is written, falls back to a read only copy if target_path is on another file system
+        The link is the stored file itself, open it for reading only, use copy() for a file that may be modified. Remove it with unlink()
+        @param `sha256:str` hex digest of the stored file
+        @param `target_path:str` where to place the file, replaced if exist
+        @return `:str` target_path
+        @exception `:FileNotFoundError` if file is not stored
+        """
+        with self._lock:
+            if sha256 not in self._index:
+                raise FileNotFoundError(f"{sha256} not found in attachment store")
+            self._log("access", sha256)
+            object_path = self.object_path(sha256)
+            # files stored before links were handed out may still be writable
+            os.chmod(object_path, stat.S_IREAD)
+            temp_path = f"{target_path}.{os.getpid()}.link"
+            try:
+                try:
+                    os.link(object_path, temp_path)
+                except OSError:
+                    # other file system, or hard links not supported
+                    _copy_file(object_path, temp_path)
+                    os.chmod(temp_path, stat.S_IREAD)
+                os.replace(temp_path, target_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    self.unlink(temp_path)
+                raise
+        return target_path
+
+    @staticmethod
+    def unlink(path:str):
+        """Remove a file handed out by link(), read only files cannot be removed on windows without write permission
+        @param `path:str` file to remove, nothing is done if DNE
+        """
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            os.chmod(path, stat.S_IREAD | stat.S_IWRITE)
+            os.remove(path)
+
+    def copy(self, sha256:str, target_path:str)->str:
+        """Place a copy of a stored file at target_path, by reflink when the file system supports it so no data is written
+        Existing target_path is replaced, the stored file is never modified
+        @param `sha256:str` hex digest of the stored file
+        @param `target_path:str` where to place the file
+        @return `:str` target_path
+        @exception `:FileNotFoundError` if file is not stored
+        """
+        with self._lock:
+            if sha256 not in self._index:
+                raise FileNotFoundError(f"{sha256} not found in attachment store")
+            self._log("access", sha256)
+            object_path = self.object_path(sha256)
+            temp_path = f"{target_path}.{os.getpid()}.copy"
+            try:
+                _copy_file(object_path, temp_path)
+                os.replace(temp_path, target_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        return target_path
+
+    def release(self, sha256:str):
+        """Remove a reference to a stored file, file is kept until gc() needs the space
+        @param `sha256:str` hex digest of the stored file
+        """
+        with self._lock:
+            entry = self._index.get(sha256)
+            if entry is not None and entry["refcount"] > 0:
+                self._log("release", sha256)
+
+    def gc(self, keep:str="")->list:
+        """Remove least recently used files until the store is under max_size, files no longer referenced are removed first
+        Links and copies handed out are not affected
+        @param `keep:str` sha256 of a file that must not be removed, such as the file just added
+        @return `:list of str` sha256 of removed files
+        """
+        removed = []
+        if self.max_size < 0:
+            return removed
+        with self._lock:
+            total_size = self.total_size()
+            if total_size <= self.max_size:
+                return removed
+            for sha256, entry in sorted(self._index.items(), key=lambda item: (item[1]["refcount"] > 0, item[1]["last_access"])):
+                if total_size <= self.max_size:
+                    break
+                if sha256 == keep:
+                    continue
+                self.unlink(self.object_path(sha256))
+                total_size -= entry["size"]
+                removed.append(sha256)
+            for sha256 in removed:
+                self._log("remove", sha256)
+        return removed
+
+def _copy_file(source_path:str, target_path:str):
+    """Copy a file, clone it when the file system supports it (btrfs, xfs), byte copy otherwise"""
+    if fcntl is not None:
+        with open(source_path, "rb") as source, open(target_path, "wb") as target:
+            try:
+                fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(source_path, target_path)
@@ -0,0 +1,88 @@
+import re
+from typing import NamedTuple
+"""Tokenizer of email commands, body format: command [option] <setting> text
+"""
+
+class ParsedCommand(NamedTuple):
+    """Parsed email body, indexable like the tuple returned by Emalia._parse_email_part
+    raw: text parts, [] and <> are breaks, raw[0] is usually the command
+    square: content of each [], empty ones skipped
+    sharp: content of each <>, empty ones skipped
+    command: lower case word at the very start of body, "" if body do not start with a word
+    """
+    raw: list
+    square: list
+    sharp: list
+    command: str
+
+_ESCAPABLE = "[]<>"
+# the only characters the scan stop at, text between them is skipped in one search
+_SPECIAL = re.compile(r"[\\\[\]<>]")
+_WORD = re.compile(r"\w*")
+
+def _find_close(text:str, start:int, close:str, stop:str)->int:
+    """Find the unescaped close bracket of a bracket opened before start
+    @param `close:str` closing bracket
+    @param `stop:str` characters that end the search unpaired, example another open bracket
+    @return `:int` index of close, or -1 if unpaired
+    """
+    length = len(text)
+    while match := _SPECIAL.search(text, start):
+        i = match.start()
+        char = text[i]
+        if char == "\\":
+            # skip the escaped bracket
+            start = i + 2 if i + 1 < length and text[i + 1] in _ESCAPABLE else i + 1
+            continue
+        if char == close:
+            return i
+        if char in stop:
+            return -1
+        start = i + 1
+    return -1
+
+def parse_command(text:str)->ParsedCommand:
+    """Split an email body into raw text parts, [] options and <> settings in one scan
+    @param `text:str` the email body to be parse, must be plain string, not html or rich
+    @return `:ParsedCommand` the parsed body, [0][0] will be command, [0][1] first word and so on
+    Content of a pair of [] or <> is returned without the brackets, brackets escaped with "\\" are kept as written and do not pair, so \\<123\\> stay in raw text
+    A bracket without its pair is plain text
+    Time analysis: linear in len(text), each character is read at most three times
+    """
+    raw, square, sharp = [], [], []
+    length = len(text)
+    command = _WORD.match(text).group().lower()
+
+    segment_start = 0 # start of the raw text part being read
+    i = 0
+    while match := _SPECIAL.search(text, i):
+        i = match.start()
+        char = text[i]
+        if char == "\\":
+            i = i + 2 if i + 1 < length and text[i + 1] in _ESCAPABLE else i + 1
+            continue
+        if char == "[":
+            # [] cannot nest, <> inside [] is part of the option
+            close = _find_close(text, i + 1, "]", "[")
+            options = square
+        elif char == "<":
+            close = _find_close(text, i + 1, ">", "<")
+            options = sharp
+        else:
+            i += 1
+            continue
+        if close < 0:
+            # unpaired, continue after the bracket so brackets inside are still found
+            i += 1
+            continue
+        segment = text[segment_start:i].strip()
+        if segment:
+            raw.append(segment)
+        option = text[i + 1:close].strip()
+        if option:
+            options.append(option)
+        segment_start = i = close + 1
+    segment = text[segment_start:].strip()
+    if segment:
+        raw.append(segment)
+    return ParsedCommand(raw, square, sharp, command)
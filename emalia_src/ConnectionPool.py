@@ -0,0 +1,352 @@
+import re
+import time
+import threading
+from contextlib import contextmanager
+# email connections
+import imaplib
+import smtplib
+
+class IMAPSession():
+    """A logged in imap connection kept by IMAPSessionPool
+    Remember which mailbox is selected so repeated calls do not pay another SELECT
+    """
+    def __init__(self, imap:imaplib.IMAP4):
+        self.imap = imap
+        self.selected = None # (mailbox:str, readonly:bool) currently selected, None if not selected
+        self.uidvalidity = None # UIDVALIDITY reported by the last SELECT, None if unknown
+        self.last_used = time.monotonic()
+
+class IMAPSessionPool():
+    """ A pool of long lived, logged in imap sessions shared by all EmailManager calls
+    Time analysis (second): first checkout ~ 1.4 (connect + login + select), later checkout ~ 0 (+ noop ~ 0.2 if idle over keepalive_interval)
+    Broken sessions (abort, BYE, socket error) are dropped and reconnected transparently
+    """
+    # errors that mean the connection is no longer usable
+    connection_errors = (imaplib.IMAP4.abort, OSError, EOFError)
+
+    def __init__(self, HANDLER_IMAP:dict, HANDLER_EMAIL:str, HANDLER_PASSWORD:str, max_size:int=2, keepalive_interval:float=60.0):
+        """Create an empty pool, sessions are created on first use
+        @param `HANDLER_IMAP:dict` elements supported by imaplib.IMAP4_SSL, pass "ssl": False to use plain imaplib.IMAP4
+        @param `HANDLER_EMAIL:str` login email
+        @param `HANDLER_PASSWORD:str` login password
+        @param `max_size:int` max number of sessions open at once, callers wait if all are in use
+        @param `keepalive_interval:float` seconds a session can be idle before a NOOP is sent to check it on checkout
+        """
+        self.HANDLER_IMAP = dict(HANDLER_IMAP)
+        self.HANDLER_EMAIL = HANDLER_EMAIL
+        self.HANDLER_PASSWORD = HANDLER_PASSWORD
+        self.max_size = max_size
+        self.keepalive_interval = keepalive_interval
+        self._idle_sessions = [] # sessions ready for checkout, most recently used at the end
+        self._session_count = 0 # sessions open, idle or in use
+        self.uidvalidity = {} # {mailbox: UIDVALIDITY} last reported by any session, known without a round trip
+        self._condition = threading.Condition()
+
+    def _connect(self)->IMAPSession:
+        """Open and login a new imap connection
+        @return `:IMAPSession` the new session, no mailbox selected
+        """
+        config = dict(self.HANDLER_IMAP)
+        if config.pop("ssl", True):
+            imap = imaplib.IMAP4_SSL(**config)
+        else:
+            imap = imaplib.IMAP4(**config)
+        try:
+            imap.login(self.HANDLER_EMAIL, self.HANDLER_PASSWORD)
+        except Exception:
+            self._close_imap(imap)
+            raise
+        return IMAPSession(imap)
+
+    def _close_imap(self, imap:imaplib.IMAP4):
+        """Logout and close an imap connection, ignoring any error as connection may already be dead"""
+        try:
+            imap.logout()
+        except Exception:
+            try:
+                imap.shutdown()
+            except Exception:
+                pass
+
+    def _is_alive(self, session:IMAPSession)->bool:
+        """Check a session is still usable, send NOOP if session is idle over keepalive_interval
+        @return `:bool` True if session can be used
+        """
+        if getattr(session.imap, "state", None) == "LOGOUT":
+            return False
+        if time.monotonic() - session.last_used < self.keepalive_interval:
+            return True
+        try:
+            status, _ = session.imap.noop()
+        except self.connection_errors:
+            return False
+        return str(status).lower() == "ok"
+
+    def acquire(self, timeout:float=None)->IMAPSession:
+        """Checkout a session, reuse an idle one if alive, otherwise connect a new one
+        @param `timeout:float` seconds to wait for a free session when pool is full, None to wait forever
+        @return `:IMAPSession` logged in session, must be returned with release()
+        @exception `:TimeoutError` if no session is freed in time
+        """
+        while True:
+            with self._condition:
+                while not self._idle_sessions and self._session_count >= self.max_size:
+                    if not self._condition.wait(timeout):
+                        raise TimeoutError("No imap session available")
+                session = self._idle_sessions.pop() if self._idle_sessions else None
+                if session is None:
+                    self._session_count += 1
+            if session is None:
+                break
+            # check outside of lock, NOOP is a round trip and other callers can take other sessions meanwhile
+            if self._is_alive(session):
+                return session
+            # dead session, drop it and try next
+            self.release(session, broken=True)
+        # connect outside of lock, login is slow
+        try:
+            return self._connect()
+        except Exception:
+            with self._condition:
+                self._session_count -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, session:IMAPSession, broken:bool=False):
+        """Return a session to the pool
+        @param `session:IMAPSession` session from acquire()
+        @param `broken:bool` if True, close the session instead of keeping it
+        """
+        if broken:
+            self._close_imap(session.imap)
+        with self._condition:
+            if broken:
+                self._session_count -= 1
+            else:
+                session.last_used = time.monotonic()
+                self._idle_sessions.append(session)
+            self._condition.notify()
+
+    def select(self, session:IMAPSession, mailbox:str="inbox", readonly:bool=False):
+        """Select mailbox on session, skipped if the same mailbox is already selected
+        @param `session:IMAPSession` session to select on
+        @param `mailbox:str` mailbox to select
+        @param `readonly:bool` if True, open mailbox with EXAMINE so no flag can be changed
+        """
+        if session.selected == (mailbox, readonly):
+            return
+        status, response = session.imap.select(mailbox, readonly=readonly)
+        if str(status).lower() != "ok":
+            session.selected = None
+            raise ConnectionError(f"Cannot select {mailbox}: {response}")
+        session.selected = (mailbox, readonly)
+        # select is the only time UIDVALIDITY is reported
+        _, uidvalidity = session.imap.response("UIDVALIDITY")
+        if uidvalidity and uidvalidity[0]:
+            session.uidvalidity = int(uidvalidity[0])
+            self.uidvalidity[mailbox] = session.uidvalidity
+
+    def refresh_uidvalidity(self, session:IMAPSession, mailbox:str="inbox")->int:
+        """Read UIDVALIDITY of mailbox again, pooled sessions skip SELECT so a change would not be seen otherwise
+        Uses the UIDVALIDITY the server reported unsolicited since the last check if any, STATUS otherwise
+        @param `session:IMAPSession` session to ask on
+        @param `mailbox:str` mailbox to check, usually the one selected
+        @return `:int` current UIDVALIDITY, also kept in session.uidvalidity when mailbox is selected
+        """
+        _, reported = session.imap.response("UIDVALIDITY")
+        if reported and reported[-1]:
+            uidvalidity = int(reported[-1])
+        else:
+            status, response = session.imap.status(mailbox, "(UIDVALIDITY)")
+            match = re.search(rb"UIDVALIDITY (\d+)", response[0] or b"") if str(status).lower() == "ok" and response else None
+            if match is None:
+                raise ConnectionError(f"Cannot read UIDVALIDITY of {mailbox}: {response}")
+            uidvalidity = int(match.group(1))
+        if session.selected and session.selected[0] == mailbox:
+            session.uidvalidity = uidvalidity
+        self.uidvalidity[mailbox] = uidvalidity
+        return uidvalidity
+
+    @contextmanager
+    def session(self, mailbox:str="inbox", readonly:bool=False):
+        """[context manager] checkout a session with mailbox selected, dropped if connection breaks inside the block
+        @param `mailbox:str` mailbox to select, None to not select any
+        @param `readonly:bool` if True, open mailbox readonly
+        @return `:IMAPSession` session ready for use
+        """
+        session = self.acquire()
+        try:
+            if mailbox:
+                self.select(session, mailbox, readonly)
+            yield session
+        except self.connection_errors:
+            self.release(session, broken=True)
+            raise
+        except BaseException:
+            # state of connection is unknown, reselect next time
+            session.selected = None
+            self.release(session)
+            raise
+        else:
+            self.release(session)
+
+    def run(self, action, mailbox:str="inbox", readonly:bool=False, retry:int=1):
+        """Run action(session) on a pooled session, reconnect and retry if connection is aborted (BYE, timeout, reset)
+        @param `action:callable` function that takes an IMAPSession, must be safe to run again
+        @param `mailbox:str` mailbox to select before running
+        @param `readonly:bool` if True, open mailbox readonly
+        @param `retry:int` number of reconnects to attempt
+        @return return value of action
+        """
+        for attempt in range(retry + 1):
+            try:
+                with self.session(mailbox, readonly) as session:
+                    return action(session)
+            except self.connection_errors:
+                if attempt >= retry:
+                    raise
+
+    def keepalive(self):
+        """Send NOOP to idle sessions that passed keepalive_interval, drop the ones that are dead
+        Called periodically by the owner (Emalia.main_loop every scan) so the server do not close idle sessions
+        """
+        with self._condition:
+            now = time.monotonic()
+            sessions = [session for session in self._idle_sessions if now - session.last_used >= self.keepalive_interval]
+            self._idle_sessions = [session for session in self._idle_sessions if now - session.last_used < self.keepalive_interval]
+        for session in sessions:
+            if self._is_alive(session):
+                self.release(session)
+            else:
+                self.release(session, broken=True)
+
+    def close(self):
+        """Logout all idle sessions, sessions in use are closed when released with broken=True"""
+        with self._condition:
+            sessions = self._idle_sessions
+            self._idle_sessions = []
+            self._session_count -= len(sessions)
+        for session in sessions:
+            self._close_imap(session.imap)
+
+class DeliveryUnknownError(ConnectionError):
+    """Connection broke after the message data was sent, the server may have accepted the message so it is not sent again"""
+
+class SMTPSessionPool():
+    """ A long lived, logged in smtp session shared by all EmailManager sends
+    Time analysis (second): first send ~ 1.3 (connect + login + send), later send ~ 0.3 while session is not idle over idle_timeout
+    Session is closed after idle_timeout as most servers drop idle smtp clients anyway, and logged in again on next send
+    """
+    # errors that mean the connection is no longer usable
+    connection_errors = (smtplib.SMTPServerDisconnected, OSError, EOFError)
+
+    def __init__(self, HANDLER_SMTP:dict, HANDLER_EMAIL:str, HANDLER_PASSWORD:str, idle_timeout:float=60.0):
+        """Create the pool, session is created on first send
+        @param `HANDLER_SMTP:dict` elements supported by smtplib.SMTP_SSL, pass "ssl": False to use plain smtplib.SMTP
+        @param `HANDLER_EMAIL:str` login email
+        @param `HANDLER_PASSWORD:str` login password
+        @param `idle_timeout:float` seconds a session can be idle before it is closed instead of reused
+        """
+        self.HANDLER_SMTP = dict(HANDLER_SMTP)
+        self.HANDLER_EMAIL = HANDLER_EMAIL
+        self.HANDLER_PASSWORD = HANDLER_PASSWORD
+        self.idle_timeout = idle_timeout
+        self._server = None # current smtp session, None if not connected
+        self._last_used = 0.0
+        self._data_sent = False # DATA of the current message was started, set by the session, reset by send()
+        self._lock = threading.RLock() # smtp session can only send one message at a time
+
+    def _connect(self)->smtplib.SMTP:
+        """Open and login a new smtp connection
+        @return `:smtplib.SMTP` logged in session
+        """
+        config = dict(self.HANDLER_SMTP)
+        if config.pop("ssl", True):
+            server = smtplib.SMTP_SSL(**config)
+        else:
+            server = smtplib.SMTP(**config)
+        try:
+            server.login(self.HANDLER_EMAIL, self.HANDLER_PASSWORD)
+        except Exception:
+            self._close_server(server)
+            raise
+        # from DATA on the server may accept the message even if its reply is lost, send() must know not to repeat it
+        send_data = server.data
+        def data(msg):
+            self._data_sent = True
+            return send_data(msg)
+        server.data = data
+        return server
+
+    def _close_server(self, server:smtplib.SMTP):
+        """Quit and close a smtp connection, ignoring any error as connection may already be dead"""
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _get_server(self)->smtplib.SMTP:
+        """Get the current session, replace it if idle over idle_timeout
+        Must hold self._lock
+        """
+        if self._server is not None and time.monotonic() - self._last_used > self.idle_timeout:
+            self._close_server(self._server)
+            self._server = None
+        if self._server is None:
+            self._server = self._connect()
+        return self._server
+
+    def send(self, outgoing_email, retry:int=1):
+        """Send one message on the shared session, login again and retry if the session was dropped by server before the message data was sent
+        @param `outgoing_email:Message` email to send
+        @param `retry:int` number of reconnects to attempt
+        @return return value of smtplib.SMTP.send_message, dict of refused recipients
+        @exception `:DeliveryUnknownError` if the session was dropped after DATA, the message may be delivered, it is not sent again
+        @exception `:smtplib.SMTPException` replies refusing the message are raised unchanged and never retried here
+        """
+        with self._lock:
+            for attempt in range(retry + 1):
+                server = self._get_server()
+                self._data_sent = False
+                try:
+                    refused = server.send_message(outgoing_email)
+                except self.connection_errors as err:
+                    if isinstance(err, smtplib.SMTPException) and not isinstance(err, smtplib.SMTPServerDisconnected):
+                        # SMTPException is an OSError, but this is a reply of the server (refused, 4xx, 5xx), session is still usable and caller decides
+                        self._last_used = time.monotonic()
+                        raise
+                    self._close_server(server)
+                    self._server = None
+                    if self._data_sent:
+                        raise DeliveryUnknownError(f"Connection lost after message data was sent, message may be delivered: {err}") from err
+                    if attempt >= retry:
+                        raise
+                else:
+                    self._last_used = time.monotonic()
+                    return refused
+
+    def send_many(self, outgoing_emails:list, retry:int=1)->list:
+        """Send a batch of messages over one authenticated session, the session is held for the whole batch
+        @param `outgoing_emails:list of Message` emails to send, in order
+        @param `retry:int` number of reconnects to attempt per message
+        @return `:list of tuple of len=2` [(outgoing_email:Message, error:Exception|None)] in same order as outgoing_emails
+        """
+        results = []
+        with self._lock:
+            for outgoing_email in outgoing_emails:
+                try:
+                    self.send(outgoing_email, retry)
+                    results.append((outgoing_email, None))
+                except Exception as err:
+                    results.append((outgoing_email, err))
+        return results
+
+    def close(self):
+        """Quit the current session if any"""
+        with self._lock:
+            if self._server is not None:
+                self._close_server(self._server)
+                self._server = None
@@ -0,0 +1,155 @@
+import logging
+import threading
+import collections
+import concurrent.futures
+"""Run jobs on a bounded thread pool, with a concurrency limit per kind of job and results delivered in submission order per sender
+"""
+
+class Dispatcher():
+    """ Jobs run on at most max_workers threads
+    Jobs with the same limit_key run at most limit at a time, extra jobs stay in queue without holding a thread, so a slow kind of job never block others
+    Results of jobs with the same order_key are passed to on_done in submission order, a fast job wait for slower jobs submitted before it with same order_key
+    Jobs are only handed to the pool when a thread is free, until then they wait in queue, which pick the next job to run among jobs under their limit
+    """
+    def __init__(self, max_workers:int=8, on_done=None, queue=None, logger:logging.Logger=None):
+        """@param `max_workers:int` max number of jobs running at once
+        @param `on_done:function` called as on_done(tag, result, error) for every job, error is None if job did not raise
+            Called from a worker thread without any lock held, one call at a time per order_key, calls of different order_key can run at once
+        @param `queue:object` jobs waiting for a thread, with put(job, queue_key), get(ready=function)->job or None and len(), example Scheduler.PriorityScheduler
+            get must only return a job ready(job) accept, first in first out if None
+        @param `logger:logging.Logger` where errors raised by on_done are logged, logger of this module if None
+        """
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.max_workers = max_workers
+        self.on_done = on_done
+        self.queue = queue
+        self._ready = collections.deque() # jobs waiting for a thread when queue is None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="emalia-worker")
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+        self._running = collections.Counter() # {limit_key: jobs running}
+        self._running_total = 0
+        self._ordered = collections.defaultdict(collections.deque) # {order_key: deque of jobs not yet passed to on_done}
+        self._delivering = set() # order_key a thread is passing results of to on_done, other threads leave them to it
+        self._jobs = 0 # jobs submitted and not yet passed to on_done
+        self._closed = False
+
+    def submit(self, function, *args, tag=None, limit_key:str="", limit:int=-1, order_key:str="", queue_key:str=""):
+        """Run function(*args) on the pool
+        @param `function:function` job to run
+        @param `tag:any` passed to on_done with the result, to identify the job
+        @param `limit_key:str` jobs sharing this key share limit
+        @param `limit:int` max jobs with limit_key running at once, <0 for no limit other than max_workers
+        @param `order_key:str` results of jobs sharing this key are passed to on_done in submission order
+        @param `queue_key:str` passed to queue.put, example the priority class of the job
+        """
+        job = {"function": function, "args": args, "tag": tag, "limit_key": limit_key, "limit": limit, "order_key": order_key, "done": False, "result": None, "error": None}
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Dispatcher is shut down")
+            self._jobs += 1
+            self._ordered[order_key].append(job)
+            if self.queue is None:
+                self._ready.append(job)
+            else:
+                self.queue.put(job, queue_key)
+            self._fill()
+
+    def _can_start(self, job:dict)->bool:
+        """@return `:bool` True if job is under the limit of its limit_key, must hold self._lock"""
+        return job["limit"] < 0 or self._running[job["limit_key"]] < job["limit"]
+
+    def _fill(self):
+        """Start queued jobs while a thread is free, must hold self._lock
+        A job over its limit is left in queue, in its place, it can start once a job of same limit_key finish
+        """
+        while self._running_total < self.max_workers:
+            if self.queue is None:
+                job = next((job for job in self._ready if self._can_start(job)), None)
+                if job is not None:
+                    self._ready.remove(job)
+            else:
+                job = self.queue.get(ready=self._can_start)
+            if job is None:
+                return
+            self._start(job)
+
+    def _start(self, job:dict):
+        """Send a job to the pool, must hold self._lock"""
+        self._running[job["limit_key"]] += 1
+        self._running_total += 1
+        self._executor.submit(self._run, job)
+
+    def _run(self, job:dict):
+        """[worker thread] run one job, start the next queued jobs, then release finished results in order"""
+        try:
+            job["result"] = job["function"](*job["args"])
+        except Exception as err:
+            job["error"] = err
+        with self._lock:
+            job["done"] = True
+            limit_key = job["limit_key"]
+            self._running[limit_key] -= 1
+            self._running_total -= 1
+            if self._running[limit_key] <= 0:
+                del self._running[limit_key]
+            self._fill()
+            order_key = job["order_key"]
+            if order_key in self._delivering:
+                # the thread delivering this order_key will pass this result when its turn come
+                return
+            self._delivering.add(order_key)
+        self._deliver(order_key)
+
+    def _deliver(self, order_key:str):
+        """[worker thread] pass finished results of order_key to on_done in submission order, without holding the lock
+        Only one thread deliver an order_key at a time, it keep going while the next result is finished
+        """
+        finished = None
+        while True:
+            with self._lock:
+                if finished is not None:
+                    # counted only after on_done returned, so join() also wait for on_done
+                    self._jobs -= 1
+                    if self._jobs == 0:
+                        self._idle.notify_all()
+                ordered = self._ordered.get(order_key)
+                if not ordered or not ordered[0]["done"]:
+                    self._delivering.discard(order_key)
+                    if ordered is not None and not ordered:
+                        del self._ordered[order_key]
+                    return
+                finished = ordered.popleft()
+            if self.on_done:
+                try:
+                    self.on_done(finished["tag"], finished["result"], finished["error"])
+                except Exception:
+                    self.logger.exception(f"Error in on_done of job {finished['tag']}")
+
+    def pending(self)->int:
+        """@return `:int` jobs submitted and not yet passed to on_done"""
+        with self._lock:
+            return self._jobs
+
+    def join(self, timeout:float=None)->bool:
+        """Wait until every submitted job is passed to on_done
+        @param `timeout:float` max seconds to wait, None to wait forever
+        @return `:bool` True if all jobs are done
+        """
+        with self._lock:
+            return self._idle.wait_for(lambda: self._jobs == 0, timeout)
+
+    def shutdown(self, wait:bool=True):
+        """Stop accepting jobs
+        @param `wait:bool` if True, wait for submitted jobs to finish, else jobs not started are dropped
+        """
+        with self._lock:
+            self._closed = True
+            if not wait:
+                self._ready.clear()
+                while self.queue is not None and self.queue.get() is not None:
+                    pass
+        # queued jobs are started by finishing jobs, the pool must accept them until all are done
+        if wait:
+            self.join()
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
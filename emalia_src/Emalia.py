@@ -5,14 +5,26 @@ from email.message import Message # email template for sending
 import re
 import logging
 import traceback
+import textwrap
 import sys
 import json
+import threading
 # main support
 from EmailManager import EmailManager
+from AttachmentStore import AttachmentStore
+from ArchiveCache import ArchiveCache
+from MessageCache import MessageCache
+from HistoryStore import SQLiteHistoryStore, normalize_address
+from Outbox import Outbox
+from Dispatcher import Dispatcher
+from Scheduler import PollScheduler, PriorityScheduler
+from TaskRegistry import TaskRegistry
+from PythonWorker import PythonWorkerPool
+from RequestEngine import RequestEngine
 import FileManager
+import CommandParser
 # worker
 import gpt_request
-import requests
 import subprocess # shell
 
 class Emalia():
@@ -44,24 +56,42 @@ class Emalia():
     instance_name:str = "Emalia" # name of the service robot, Emalia is her default name
     server_running:bool = False # if True, a server is running, set to false will stop server at next loop
     freeze_server:bool = False # if True, will temporarily stop tasks execution except emalia_manager. 
-    statistics:dict = {"sent": None, "received": None} # track statistics for current/last running instance, {"sent":int, "received":int}
+    statistics:dict = {"sent": None, "received": None, "processed": None} # track statistics for current/last running instance, {"sent":int, "received":int, "processed":int}, update with _count
     permission = {} # holds information regarding what the user can/cannot access
     vip_list = {} # a list of senders with special permission
-    custom_tasks = {} # user defined tasks on the run
+    custom_tasks = {} # user defined tasks on the run, {key: task}, tasks registered with CUSTOM are saved to custom_action.json under _save_path
     
     # =====================Configurable Settings=========================
     # should not be changed mid-execution or may error out
 
     _setting_location = f"{__file__}/../emalia_setting.json"
     _max_send_count = -1 # FILE max email emalia can send per instance, <0 for infinite
+    _max_scan_interval = 300 # FILE max seconds between inbox scans when idle, scan interval back off from main_loop scan_interval up to this
+    _quiet_hours = [] # FILE [["HH:MM", "HH:MM"]] start and end of periods with few emails expected, example [["23:00", "07:00"]]
+    _quiet_scan_interval = 1800 # FILE seconds between inbox scans during quiet hours when idle
+    _max_workers = 8 # FILE max tasks running at once, each task also has its own "concurrency" limit in task_list
+    _priority_weights = {"vip_fast": 8, "vip_slow": 4, "fast": 4, "slow": 1} # FILE share of free workers given to emails waiting in each class, vip_list senders and task "cost"
+    _priority_max_wait = 60 # FILE seconds an email can wait for a worker before it is served ahead of every class
+    _send_per_minute = -1 # FILE max email sent per minute (email provider quota), <0 for infinite
+    _send_per_day = -1 # FILE max email sent per day (email provider quota), <0 for infinite
     _file_roots = f"{__file__}/../../" # FILE should point to GS-Emalia directory
-    _save_path = f"{__file__}/../../" # FILE a history file with .csv extension, create if DNE 
+    _save_path = f"{__file__}/../../" # FILE directory of history.db and other state files, create if DNE 
+    _attachment_store_size = 1024 * 1024 * 1024 # FILE max bytes kept in attachment store under _save_path, <0 for no limit
+    _archive_cache_size = 512 * 1024 * 1024 # FILE max bytes of zipped directories cached under _save_path, <0 for no limit
+    _message_cache_size = 256 * 1024 * 1024 # FILE max bytes of raw emails cached under _save_path, <0 for no limit
     _GPT_API_KEY = "" # FILE
     _HANDLER_EMAIL = "" # FILE
     _HANDLER_PASSWORD = "" # FILE
     _HANDLER_SMTP = "" # FILE
     _HANDLER_IMAP = "" # FILE
     _powershell_path = "" #shell path
+    _request_timeout = 30 # FILE max seconds a REQUEST wait to connect or between two bytes received
+    _request_body_size = 256 * 1024 # FILE REQUEST responses up to this many bytes are put in the reply body, larger ones are attached as a file
+    _request_max_size = 20 * 1024 * 1024 # FILE REQUEST responses over this many bytes are aborted, <0 for no limit
+    _python_workers = 2 # FILE number of processes running PYTHON scripts, started with main_loop
+    _python_timeout = 30 # FILE max seconds of wall clock and of cpu time a PYTHON script can use
+    _python_memory = 512 * 1024 * 1024 # FILE max bytes of memory of a PYTHON worker process, <0 for no limit
+    _python_max_jobs = 50 # FILE scripts run by a PYTHON worker process before it is replaced by a fresh one
     _custom_tasks = {}
     # =======================Runtime Variable=========================
     # do not change unless confident
@@ -125,14 +155,53 @@ class Emalia():
         self._HANDLER_SMTP = HANDLER_SMTP if HANDLER_SMTP else os.environ.get("HANDLER_SMTP")
         self._HANDLER_IMAP = HANDLER_IMAP if HANDLER_IMAP else os.environ.get("HANDLER_IMAP")
         
-        self.email_handler = EmailManager(HANDLER_PASSWORD=self._HANDLER_PASSWORD, HANDLER_EMAIL=self._HANDLER_EMAIL, HANDLER_SMTP=self._HANDLER_SMTP, HANDLER_IMAP=self._HANDLER_IMAP)
+        self.email_handler = EmailManager(HANDLER_PASSWORD=self._HANDLER_PASSWORD, HANDLER_EMAIL=self._HANDLER_EMAIL, HANDLER_SMTP=self._HANDLER_SMTP, HANDLER_IMAP=self._HANDLER_IMAP, 
+            sync_state_path=os.path.join(self._save_path, "inbox_state.json"), 
+            spool_attachments=True, 
+            attachment_store=AttachmentStore(os.path.join(self._save_path, "attachment_store"), max_size=self._attachment_store_size), 
+            archive_cache=ArchiveCache(os.path.join(self._save_path, "archive_cache"), max_size=self._archive_cache_size), 
+            message_cache=MessageCache(os.path.join(self._save_path, "message_cache"), max_size=self._message_cache_size), 
+            logger=self.logger)
         self.email_handler.footer = f"email from {self.instance_name}"
-    def main_loop(self, scan_interval:float=5.0):
+        # history is written by a background thread, lookups use indexed columns
+        self.history = SQLiteHistoryStore(os.path.join(self._save_path, "history.db"), logger=self.logger)
+        # replies are sent by a background thread, pending replies are kept on disk across restart
+        self.outbox = Outbox(os.path.join(self._save_path, "outbox"), self.email_handler.send_many, 
+            per_minute=self._send_per_minute, per_day=self._send_per_day, max_total=self._max_send_count, 
+            on_sent=self._on_email_sent, on_failed=self._on_email_failed)
+        # statistics and the uids below are updated from worker and outbox threads
+        self._statistics_lock = threading.Lock()
+        self._in_flight_uids = {} # uids dispatched and not yet done: UIDVALIDITY they belong to
+        self._done_uids = [] # (uid, UIDVALIDITY) done and not yet marked read
+        self.dispatcher = None
+        # keep-alive sessions per host, repeated requests to one api reuse connections
+        self.request_engine = RequestEngine(connect_timeout=min(10, self._request_timeout), read_timeout=self._request_timeout, 
+            memory_size=self._request_body_size, max_size=self._request_max_size)
+        # python scripts run in other processes, a script cannot block main_loop or other tasks
+        self.python_pool = PythonWorkerPool(workers=self._python_workers, timeout=self._python_timeout, cpu_time=self._python_timeout, 
+            memory=self._python_memory, max_jobs=self._python_max_jobs)
+        self._stop_event = threading.Event() # set by break_loop to end a wait early
+        # tasks and trigger index are built once, rebuilt only when a custom task is registered
+        self.tasks = TaskRegistry(self._builtin_tasks())
+        self._builtin_triggers = self.tasks.triggers # {trigger: key} of builtin tasks only, custom tasks can never take them
+        for key, task in {**self.custom_tasks, **self._load_custom_tasks()}.items():
+            try:
+                self.tasks.register(key, self._custom_task_entry(key, task))
+            except ValueError as err:
+                self.logger.error(f"Custom task {key} not loaded: {err}")
+    def main_loop(self, scan_interval:float=5.0, wait_mode:str="poll", idle_timeout:float=300.0):
         """Start the email listener and responding system
-        @param `scan_interval:float` the time to pause between each email scan session, if processing tie (request time >= scan_interval, there will be no pause)
+        @param `scan_interval:float` the shortest pause between each email scan session, used right after emails arrive or while tasks are running, if processing tie (request time >= scan_interval, there will be no pause)
+          when idle the pause back off up to _max_scan_interval, or _quiet_scan_interval during _quiet_hours, current pause is in statistics["scan_interval"]
+        @param `wait_mode:str` how to wait for new email when inbox is empty
+          if "poll": sleep the current scan interval between each scan
+          if "idle": block with IMAP IDLE until server push new email (or idle_timeout), fallback to polling at the current scan interval if server do not support IDLE
+        @param `idle_timeout:float` max seconds to wait in one IDLE when wait_mode is "idle"
         @return `:datetime` time of main_loop completion
         Info: Only one main_loop or async_main_loop can run, all other calls will not create new Emalia loops. Please create new Emalia Object to do such task
         """
+        if wait_mode not in ("poll", "idle"):
+            raise AttributeError(f"Unknown wait_mode {wait_mode}")
         self.PID = os.getpid()
         self.server_running = True
         self.server_start_time = datetime.now()
@@ -141,79 +210,235 @@ class Emalia():
             "name": self.instance_name,
             "sent": 0, 
             "received": 0, 
+            "processed": 0, 
+            "scan_interval": scan_interval, 
+            "queues": {}, 
             "on_time": self.server_start_time
         }
+        self._stop_event.clear()
+        # poll fast while active, back off when idle
+        scheduler = PollScheduler(min_interval=scan_interval, max_interval=max(scan_interval, self._max_scan_interval), 
+            quiet_hours=self._quiet_hours, quiet_interval=self._quiet_scan_interval)
+        self.outbox.start()
+        self.python_pool.start()
+        # tasks run on a thread pool, replies to one sender are queued in the order their emails were received
+        # when all workers are busy, vip senders and fast tasks are served first
+        self.priority_queue = PriorityScheduler(weights=self._priority_weights, max_wait=self._priority_max_wait)
+        self.dispatcher = Dispatcher(max_workers=self._max_workers, on_done=self._on_task_done, queue=self.priority_queue, logger=self.logger)
         
         # infinity loop unless self.server_running is changed in loop or from other functions in separate process
         while self.server_running:
             loop_start_time = datetime.now()
-            response_email = None
             try:
-                # get unseen_emails
-                unseen_email_ids = self.email_handler.unseen_emails()
-                
-                # fetch email by id
-                if unseen_email_ids:
-                    unseen_email_id_selected = unseen_email_ids[0]
-                    unseen_email = self.email_handler.fetch_email(unseen_email_id_selected)
-                    unseen_email_parsed = self.email_handler.parse_email(unseen_email)
-                    self.email_handler.assert_valid_email_received(unseen_email_parsed)
-                else:
-                    unseen_email = None
-                    unseen_email_parsed = None
+                # get emails arrived since last scan and fetch them all in batches
+                # emails still being processed are returned by new_uids until done, skip them
+                # only this thread dispatch, so a uid not in flight before new_uids cannot be dispatched during it
+                with self._statistics_lock:
+                    in_flight_uids = set(self._in_flight_uids)
+                unseen_email_uids = [uid for uid in self.email_handler.new_uids() if uid not in in_flight_uids]
+                # uids are only used under the UIDVALIDITY they were found with, fetch and store check it again on their own session
+                uidvalidity = self.email_handler.sync_uidvalidity()
+                # only headers and text body, attachments are fetched later by tasks that need them
+                # emails are marked read only after they are processed
+                unseen_emails = self.email_handler.fetch_email_summaries(unseen_email_uids, mark_read=False, uidvalidity=uidvalidity) if unseen_email_uids else []
+                # emails deleted before they could be fetched will never be fetched
+                fetched_uids = set(uid for uid, _, _ in unseen_emails)
+                missing_uids = [uid for uid in unseen_email_uids if uid not in fetched_uids]
+                if missing_uids:
+                    self.email_handler.mark_processed(missing_uids, uidvalidity)
             except Exception as err:
                 self.logger.exception("Error when attempting to fetch new emails")
-                unseen_email = None
-                unseen_email_parsed = None
+                unseen_emails = []
                 
-            # handle user request if new email detected
-            if unseen_email:
-                try:
-                    # save email
-                    self.email_handler.store_email_to_csv(unseen_email_parsed, self._save_path + history.csv, "received"  )
-                    # parse command
-                    user_command = re.search("^\w*", unseen_email_parsed["body"][0][0]).group().lower() # normalize to lower case
-                    # if server freeze, force all command to system manager
-                    if self.freeze_server:
-                        # "0" = system manager
-                        response_email = self.task_list["0"]["function"](unseen_email_parsed)
-                    # If user have valid key, use that key's function
-                    # TODO update the accepted value to task_list[X]["trigger"]
-                    elif user_command in self.task_list.keys():
-                        response_email = self.task_list[user_command]["function"](unseen_email_parsed)
-                    else:
-                        response_email = self._new_emalia_email(unseen_email_parsed, f"Error: Unknown command {user_command}")
-                except Exception as err:
-                    self.logger.exception(f"Error: {user_command} failed")
-                    response_email = self._new_emalia_email(unseen_email_parsed, f"Error: {err}", traceback.format_exc())
-            if unseen_email or response_email:
+            self._count("received", len(unseen_emails))
+            # handle user request for each new email detected, parse here and run the task on the pool
+            for unseen_email_uid, unseen_email, attachment_parts in unseen_emails:
+                with self._statistics_lock:
+                    self._in_flight_uids[unseen_email_uid] = uidvalidity
+                prepared = self._prepare_email(unseen_email, unseen_email_uid)
+                if prepared is None:
+                    self._on_task_done(unseen_email_uid, None, None)
+                    continue
+                unseen_email_parsed, task_key = prepared
+                self.dispatcher.submit(self._run_task, unseen_email_parsed, task_key, attachment_parts, tag=unseen_email_uid, 
+                    limit_key=self.task_list.get(task_key, {}).get("target", task_key), limit=self.task_list.get(task_key, {}).get("concurrency", -1), order_key=unseen_email_parsed["sender"], 
+                    queue_key=self._priority_class(unseen_email_parsed, task_key))
+            self._mark_done_read()
             # freeze if conditions are not meet
-                if (self.statistics["sent"] >= self._max_send_count) and (self._max_send_count >= 0):
-                    self.freeze_server = True
-                    self.logger.info("Server frozen")
-                # reply based on action
-                try:
-                    self.email_handler.send_email(response_email)
-                    self.statistics["sent"] += 1
-                    self.logger.info(f"Sent email to {unseen_email_parsed['sender']}")
-                        
-                except Exception as err:
-                    self.logger.exception("Error when attempting send email")
+            if (self.statistics["sent"] >= self._max_send_count) and (self._max_send_count >= 0) and not self.freeze_server:
+                self.freeze_server = True
+                self.logger.info("Server frozen")
                 
-            # calculate and sleep for desired scan_interval - current loop_time
+            # calculate and sleep for desired interval - current loop_time
+            backlog = self.dispatcher.pending()
+            self.statistics["queues"] = self.priority_queue.statistics()
+            interval = scheduler.next_interval(activity=len(unseen_emails), backlog=backlog)
+            self.statistics["scan_interval"] = interval
             loop_end_time = datetime.now()
             loop_time = (loop_end_time - loop_start_time).total_seconds()
-            if (scan_interval - loop_time) > 0:
-                time.sleep(scan_interval - loop_time)
+            try:
+                # pooled imap sessions idle too long are checked before the server drops them
+                self.email_handler.keepalive()
+            except Exception:
+                self.logger.exception("Error when checking imap sessions")
+            if wait_mode == "idle" and not unseen_emails and not backlog:
+                # inbox is empty, wait for server to push new email instead of sleeping
+                try:
+                    self.email_handler.wait_for_new_emails(timeout=idle_timeout, poll_interval=interval, stop=lambda: not self.server_running)
+                except Exception as err:
+                    self.logger.exception("Error when waiting for new emails, fallback to polling")
+                    self._stop_event.wait(max(0, interval - loop_time))
+            elif (wait_mode == "poll" or not unseen_emails) and (interval - loop_time) > 0:
+                # ends early on break_loop, idle mode rescan at once after emails arrived
+                self._stop_event.wait(interval - loop_time)
             self.logger.info(f"Loop time: {loop_time}")
 
+        # finish running tasks, write history still queued, unsent replies stay in outbox for next start
+        self.dispatcher.shutdown(wait=True)
+        self._mark_done_read()
+        self.history.flush()
+        self.outbox.stop()
+        self.python_pool.stop()
+        FileManager.shutdown_pool()
+        self.request_engine.close()
         # return server completion time
         return datetime.now()
         
+    def _process_email(self, unseen_email:Message, uid:str="", attachment_parts:list=[])->Message:
+        """Parse, record and run the task requested by one received email, in the calling thread
+        @param `unseen_email:Message` the email received, full email or summary from EmailManager.fetch_email_summaries
+        @param `uid:str` uid of the email, needed to download attachment_parts
+        @param `attachment_parts:list of dict` attachments not yet downloaded, fetched only if the task needs attachments
+        @return `:Message` the response email to sender, None if the email cannot be understood
+        """
+        prepared = self._prepare_email(unseen_email, uid)
+        if prepared is None:
+            return None
+        return self._run_task(*prepared, attachment_parts)
+
+    def _prepare_email(self, unseen_email:Message, uid:str="")->tuple:
+        """Parse one received email and find the task it requests
+        @param `unseen_email:Message` the email received, full email or summary from EmailManager.fetch_email_summaries
+        @param `uid:str` uid of the email
+        @return `:tuple len(2)` (email parsed:dict, task key:str), task key is "" for unknown command, None if the email cannot be understood
+        """
+        try:
+            unseen_email_parsed = self.email_handler.parse_email(unseen_email)
+            self.email_handler.assert_valid_email_received(unseen_email_parsed)
+            unseen_email_parsed["uid"] = uid
+        except Exception as err:
+            self.logger.exception("Error when attempting to parse new email")
+            return None
+        try:
+            # parse command once, handlers reuse it
+            unseen_email_parsed["command"] = self._parsed_command(unseen_email_parsed).command
+        except Exception as err:
+            unseen_email_parsed["command"] = ""
+        # if server freeze, force all command to system manager "0"
+        if self.freeze_server:
+            return (unseen_email_parsed, "0")
+        return (unseen_email_parsed, self.tasks.find(unseen_email_parsed["command"]) or "")
+
+    def _run_task(self, unseen_email_parsed:dict, task_key:str, attachment_parts:list=[])->Message:
+        """[worker thread] Run the task of one parsed email and record it to history
+        @param `unseen_email_parsed:dict` email parsed by _prepare_email
+        @param `task_key:str` key in task_list, "" for unknown command
+        @param `attachment_parts:list of dict` attachments not yet downloaded, fetched only if the task needs attachments
+        @return `:Message` the response email to sender
+        """
+        task_error = None
+        try:
+            if not task_key:
+                response_email = self._new_emalia_email(unseen_email_parsed, f"Error: Unknown command {unseen_email_parsed['command']}")
+            else:
+                task = self.task_list[task_key]
+                # download attachments only for tasks that use them
+                if task.get("attachments") and attachment_parts:
+                    unseen_email_parsed["attachments"] = self.email_handler.fetch_attachments(unseen_email_parsed["uid"], attachment_parts, unseen_email_parsed["id"])
+                response_email = task["function"](unseen_email_parsed)
+        except Exception as err:
+            self.logger.exception(f"Error: {unseen_email_parsed['command']} failed")
+            task_error = str(err)
+            response_email = self._new_emalia_email(unseen_email_parsed, f"Error: {err}", traceback.format_exc())
+        finally:
+            # the task saved what it needs, spooled copies and their store references are released
+            self.email_handler.release_attachments(unseen_email_parsed.get("attachments"))
+        # save email, queued and written in background
+        self.history.record(unseen_email_parsed, "received", task=task_key, error=task_error)
+        return response_email
+
+    def _priority_class(self, unseen_email_parsed:dict, task_key:str)->str:
+        """Class of an email in priority_queue
+        @return `:str` "vip_fast", "vip_slow", "fast" or "slow", vip if sender is in vip_list, slow if the task "cost" is "slow"
+        """
+        vip = self._is_vip(unseen_email_parsed.get("sender"))
+        slow = self.task_list.get(task_key, {}).get("cost") == "slow"
+        return f"{'vip_' if vip else ''}{'slow' if slow else 'fast'}"
+
+    def _is_vip(self, sender:str)->bool:
+        """Check a sender is in vip_list
+        @param `sender:str` address in any form, example "Name <a@b.com>"
+        @return `:bool` True if sender is a vip
+        """
+        sender = normalize_address(sender)
+        return bool(sender) and any(sender == normalize_address(str(vip_sender)) for vip_sender in self.vip_list)
+
+    def _on_task_done(self, uid:str, response_email:Message, task_error:Exception):
+        """[worker thread] queue the reply of a finished task and mark its email processed
+        Called in receive order for emails of the same sender
+        """
+        with self._statistics_lock:
+            uidvalidity = self._in_flight_uids.get(uid)
+        try:
+            if task_error:
+                self.logger.error(f"Error when processing email {uid}: {task_error}")
+            if response_email:
+                # replies are written to outbox and sent in background, tasks never wait on smtp
+                try:
+                    self.outbox.enqueue(response_email)
+                except Exception as err:
+                    self.logger.exception(f"Error when attempting to queue email to {response_email['To']}")
+            self.email_handler.mark_processed(uid, uidvalidity)
+        finally:
+            # never left in flight, the email is marked read even if its sync state could not be saved
+            with self._statistics_lock:
+                self._in_flight_uids.pop(uid, None)
+                self._done_uids.append((uid, uidvalidity))
+                self.statistics["processed"] += 1
+
+    def _mark_done_read(self):
+        """Mark emails of finished tasks read, in one command"""
+        with self._statistics_lock:
+            done_uids, self._done_uids = self._done_uids, []
+        # one command per UIDVALIDITY, uids of a changed mailbox are dropped by store_flags and resynced by new_uids
+        batches = {}
+        for uid, uidvalidity in done_uids:
+            batches.setdefault(uidvalidity, []).append(uid)
+        for uidvalidity, uids in batches.items():
+            try:
+                self.email_handler.store_flags(uids, "+FLAGS", "\\Seen", uidvalidity=uidvalidity)
+            except Exception as err:
+                self.logger.exception("Error when attempting to mark emails read")
+
+    def _count(self, key:str, value:int=1):
+        """Add value to statistics[key], safe to call from any thread"""
+        with self._statistics_lock:
+            self.statistics[key] += value
+
+    def _on_email_sent(self, sent_email:Message):
+        """[outbox thread] count and log a sent reply"""
+        self._count("sent")
+        self.logger.info(f"Sent email to {sent_email['To']}")
+
+    def _on_email_failed(self, sent_email:Message, send_error:Exception):
+        """[outbox thread] log a reply that will not be retried"""
+        self.logger.error(f"Error when attempting send email to {sent_email['To']}: {send_error}")
+
     def break_loop(self):
         """Stop the execution of mainloop externally
         Repeated call have no effect"""
         self.server_running = False
+        self._stop_event.set()
     
     # ========================== WORKER FUNCTIONs =========================
     def _validate_password(password:str):
@@ -234,48 +459,40 @@ class Emalia():
         email_body = email_body
         return self.email_handler.new_email(target_email=target_email, email_subject=email_subject, email_body=email_body, attachments=attachments)
     
-    def _parse_email_part(self, email_body:str)->tuple:
-        """Return a tuple of 3 that contains (Raw body part (space or [] or <> as break), [] options ([] as break), <> options (<> as break)) make sure to strip reply section before requesting
+    def _parse_email_part(self, email_body:str)->CommandParser.ParsedCommand:
+        """Return a tuple that contains (Raw body part (space or [] or <> as break), [] options ([] as break), <> options (<> as break), command) make sure to strip reply section before requesting
         @param `email_body:str` the email body to be parse, must be plain string, not html or rich
-        @return `:tuple len(3) of list`  the parsed email body, [0][0] will be command, [0][1] first word and so on
+        @return `:ParsedCommand` the parsed email body, [0][0] will be command, [0][1] first word and so on
         response will not contain <> or [], will escape with "\". So <123> with return 123, \<123\> will not
-        Requires brackets to be paired, there cannot be floating brackets
+        Requires brackets to be paired, a floating bracket is plain text
+        Prefer _parsed_command for a received email, it parse the body once
         """
-        # find<>
-        email_sharp_bracket_pattern = r"(?<!\\)<([^<>]*)(?<!\\)>"
-        matches = re.findall(email_sharp_bracket_pattern, email_body)
-        # replace <> with empty [] to simplify raw body parsing. can remove this and spend more time to update raw_body parsing to handle both [] and <>
-        email_body = re.sub(email_sharp_bracket_pattern, "[]", email_body)
-        email_sharp_bracket_part = []
-        # append <> found to save list
-        for match in matches:
-            if match.strip():
-                email_sharp_bracket_part.append(match.strip())
-                
-        # find []
-        email_square_bracket_pattern = r"(?<!\\)\[([^\[\]]*)(?<!\\)\]"
-        matches = re.findall(email_square_bracket_pattern, email_body)
-        email_square_bracket_part = []
-        for match in matches:
-            if match.strip(">").strip():
-                email_square_bracket_part.append(match.strip())
-            
-        # find and store body content
-        email_raw_body_pattern = r"(?<!\\)(?:^|\])([^\[\]]*)(?<!\\)(?:$|\[)"
-        matches = re.findall(email_raw_body_pattern, email_body)
-        email_raw_body_part = []
-        for match in matches:
-            if match.strip():
-                email_raw_body_part.append(match.strip())
-                    
-        return (email_raw_body_part, email_square_bracket_part, email_sharp_bracket_part)
+        return CommandParser.parse_command(email_body)
+
+    def _parsed_command(self, email_received:dict)->CommandParser.ParsedCommand:
+        """Parsed command of a received email, parsed on first call and cached on the email as "parsed_command"
+        @param `email_received:dict` the email sent by sender, parsed to dict format with EmailManager.parse_email
+        @return `:ParsedCommand` same as _parse_email_part of the email body
+        """
+        parsed_command = email_received.get("parsed_command")
+        if parsed_command is None:
+            parsed_command = email_received["parsed_command"] = CommandParser.parse_command(email_received["body"][0][0])
+        return parsed_command
         
     @property
-    def task_list(self):
-        """stores Worker function list, access keys and corresponding action functions
-        TODO: Redesign task_list so it is more concise
+    def task_list(self)->dict:
+        """Read only view of all tasks {key: task}, register tasks with self.tasks.register"""
+        return self.tasks.tasks
+
+    def _builtin_tasks(self)->dict:
+        """Worker function list, access keys and corresponding action functions
+        @return `:dict` {key: task}
         """
         # keys must be lower case! trigger is not case sensitive
+        # "attachments": True if the task needs email attachments, they are not downloaded otherwise
+        # "concurrency": max emails running this task at once, no limit other than _max_workers if not set
+        # "cost": "slow" if the task usually take seconds or more, it wait behind fast tasks when workers are busy, "fast" if not set
+        # "target": custom tasks only, key of the builtin task the custom task runs, the concurrency limit is shared with it
         default_worker_functions = {
             "?": {"function": self._action_get_help, 
                 "name":"Get help", 
@@ -286,7 +503,8 @@ class Emalia():
                 "name":"System Settings", 
                 "trigger": ["0", "manage", f"{self.instance_name}"], 
                 "description": "Edit system settings and trigger system commands", 
-                "help": ""},
+                "help": "",
+                "concurrency": 1},
             "1": {"function": self._action_read_file,
                 "name":"Get File", 
                 "trigger": ["1", "read"], 
@@ -296,22 +514,29 @@ class Emalia():
                 "name":"Write File", 
                 "trigger": ["2", "write"], 
                 "description": "Store an email attachment as file", 
-                "help": ""},
+                "help": "",
+                "attachments": True},
             "3": {"function": self._action_make_request,
                 "name":"HTTP Request", 
                 "trigger": ["3", "request"], 
                 "description": "Make a http request and get the response", 
-                "help": ""},
+                "help": "",
+                "cost": "slow",
+                "concurrency": 4},
             "4": {"function": self._action_execute_powershell,
                 "name":"Execute Powershell", 
                 "trigger": ["4", "shell", "powershell"], 
                 "description": "Run a powershell script", 
-                "help": ""},
+                "help": "",
+                "cost": "slow",
+                "concurrency": 1},
             "5": {"function": self._action_execute_python,
                 "name":"Execute Python", 
                 "trigger": ["5", "python"], 
-                "description": "Run a python script in line", 
-                "help": ""},
+                "description": "Run a python script in a worker process", 
+                "help": "",
+                "cost": "slow",
+                "concurrency": self._python_workers},
             "6": {"function": self._action_execute_python,
                 "name":"Email Action", 
                 "trigger": ["6", "email"], 
@@ -321,26 +546,24 @@ class Emalia():
                 "name":"GPT query", 
                 "trigger": ["7", "gpt"], 
                 "description": "Get a gpt response to email sent", 
-                "help": ""},
+                "help": "",
+                "cost": "slow",
+                "concurrency": 2},
             "9": {"function": self._action_register_custom_task,
                 "name":"Custom Tasks", 
                 "trigger": ["9", "custom"], 
                 "description": "Store a new user defined task chian", 
-                "help": ""}
+                "help": "",
+                "concurrency": 1}
         }
-        default_worker_functions.update(self.custom_tasks)
         return default_worker_functions
     
     def get_task(self, text):
         """Get task object from task_list
         @param `text:str` the text to be searched in task_list
-        @return `:dict` the task_list entry that contains the text in "trigger", return None if do not exist
+        @return `:dict` the task_list entry that contains the text in "trigger" or as key, return None if do not exist
         """
-        
-        for key, value in self.task_list.items():
-            if text.lower() in value["trigger"]:
-                return value
-        return None
+        return self.tasks.get(self.tasks.find(text))
             
     def _action_get_help(self, email_received:dict)->Message:
         """Get help on how to use emalia
@@ -362,10 +585,60 @@ class Emalia():
         @return `:dict` the response email to sender
         """
         self.logger.info("manage_emalia: processing")
-        main_menu = """Options"""
-        response_email_subject = f"HELP: complete"
+        main_menu = """Options
+history [sender:a@b.com] [since:2023-01-01] [until:2023-02-01] [task:7] [error:yes|no] [page:1] words: search your email history, words are matched against subject and body, only vip senders can search other senders"""
+        email_body_parts = self._parsed_command(email_received)
+        words = " ".join(email_body_parts[0]).split()
+        # words[0] is the trigger
+        if len(words) > 1 and words[1].lower() == "history":
+            return self._manage_history(email_received, " ".join(words[2:]), email_body_parts[1])
+        response_email_subject = f"MANAGE: Main Menu"
         response_email_body = main_menu
-        return self._new_emalia_email(email_received, response_email_subject, response_email_body, attachments=[path])
+        return self._new_emalia_email(email_received, response_email_subject, response_email_body)
+
+    def _manage_history(self, email_received:dict, text:str, options:list, page_size:int=20)->Message:
+        """Search email history for the manage task
+        @param `email_received:dict` the email sent by sender, parsed to dict format with EmailManager.parse_email
+        @param `text:str` words to search in subject and body
+        @param `options:list of str` filters as "name:value", name is one of sender, since, until, task, error, page
+        @param `page_size:int` records per response email
+        @return `:Message` the response email to sender
+        @exception `:PermissionError` if a sender not in vip_list asks for history of another sender
+        Senders not in vip_list only see their own history, vip senders see all senders unless filtered
+        """
+        requester = normalize_address(email_received.get("sender"))
+        vip = self._is_vip(requester)
+        if not vip and not requester:
+            raise PermissionError("Cannot search history without a sender address")
+        filters = {} if vip else {"sender": requester}
+        page = 1
+        for option in options:
+            name, _, value = option.partition(":")
+            name, value = name.strip().lower(), value.strip()
+            if name == "sender":
+                if not vip and normalize_address(value) != requester:
+                    raise PermissionError(f"Only vip senders can search history of {value}")
+                filters["sender"] = normalize_address(value)
+            elif name in ("since", "until"):
+                filters[name] = datetime.fromisoformat(value)
+            elif name == "task":
+                # task key or any of its trigger
+                filters["task"] = self.tasks.find(value) or value
+            elif name == "error":
+                filters["error"] = value.lower() in ("yes", "true", "1")
+            elif name == "page":
+                page = max(1, int(value))
+            else:
+                raise AttributeError(f"Unknown history filter {name}")
+        lines = []
+        for record in self.history.search(text, offset=(page - 1) * page_size, page_size=page_size, **filters):
+            status = f"ERROR {record['error']}" if record["error"] is not None else "OK"
+            lines.append(f"{record['date']} {record['sender']} task {record['task'] or '-'} {status}: {record['subject']}\n    {(record['body'] or '')[:200]}")
+            if len(lines) >= page_size:
+                break
+        response_email_subject = f"MANAGE: history page {page}, {len(lines)} records"
+        response_email_body = "\n".join(lines) if lines else "No record found"
+        return self._new_emalia_email(email_received, response_email_subject, response_email_body)
     
     def _action_read_file(self, email_received:dict)->Message:
         """1 find one file and attach it as attachment to response email by emalia permission and return it
@@ -375,7 +648,7 @@ class Emalia():
         """
         self.logger.info("read_file: processing")
         main_menu = """Retrieve file stored on emalia server with commands.\n Format: [path], both relative and complete path are supported."""
-        path = self._parse_email_part(email_received["body"][0][0])[0][-1]
+        path = self._parsed_command(email_received)[0][-1]
         # if path is passed in
         if path:
             if os.path.exists(path):
@@ -408,7 +681,7 @@ class Emalia():
         self.logger.info("write_file: processing")
         main_menu = """Write file to emalia server with commands.\n Format: [path], both relative and complete path are supported. File to write need to be passed as attachments"""
         paths_of_attachments = email_received["attachments"]
-        paths_to_write = self._parse_email_part(email_received["body"][0][0])[0][1:]
+        paths_to_write = self._parsed_command(email_received)[0][1:]
         assert len(paths_of_attachments) == len(paths_to_write) or len(paths_to_write) == 1 or len(paths_of_attachments) == 0
         # if path is passed in
         
@@ -417,10 +690,11 @@ class Emalia():
             if len(paths_to_write) == 1: 
                 # if not dir, force to get level above
                 if not os.path.isdir(paths_to_write[0]):
-                    self.logger.info(f"WRITE: input path {path} not dir, normalizing")
+                    self.logger.info(f"WRITE: input path {paths_to_write[0]} not dir, normalizing")
                     paths_to_write = [os.path.dirname(paths_to_write[0])]
                 paths_to_write = paths_to_write * len(paths_of_attachments)
             # for each attachment, save to target location
+            saved_paths = []
             for i, path in enumerate(paths_to_write):
                 if os.path.exists(path):
                     if os.path.isdir(path):
@@ -437,11 +711,11 @@ class Emalia():
                     raise AttributeError(f"WRITE: {path} does not exist")
                 # after absolute path found, return email as attachment
                 path_to_write = os.path.realpath(path_to_write)
-                file_name = os.path.basename(path)
-                #TODO save file
+                file_name = os.path.basename(paths_of_attachments[i][0])
+                # linked from attachment store when possible, no data is copied
+                saved_paths.append(self.email_handler.save_attachment(paths_of_attachments[i], os.path.join(path_to_write, file_name)))
             response_email_subject = f"WRITE: {len(paths_to_write)} write completed"
-            response_email_body = f"{len(paths_to_write)} saved"
-            # TODO specify where each file is saved
+            response_email_body = f"{len(paths_to_write)} saved\n" + "\n".join(saved_paths)
             return self._new_emalia_email(email_received, response_email_subject, response_email_body)
         
         # help menu
@@ -449,46 +723,62 @@ class Emalia():
             # return main options
             response_email_subject = f"WRITE: Main Menu"
             response_email_body = main_menu
-            return self._new_emalia_email(email_received, response_email_subject, response_email_body, attachments=[path])
+            return self._new_emalia_email(email_received, response_email_subject, response_email_body)
         
         
     def _action_make_request(self, email_received:dict)->Message:
         """3 make an external request by emalia permission
         @param `email_received:dict` the email sent by sender, parsed to dict format with EmailManager.parse_email
-        @return `:Message` the response email to sender
+            Body format: REQUEST [] URL [] METHOD [] HEADERS [] BODY, HEADERS is json, BODY is json or text, None for a field that is not needed
+        @return `:Message` the response email to sender, response body is attached as a file if over _request_body_size
         """
         self.logger.info("make_request: processing")
-        main_menu = """Main_menu"""
+        main_menu = """Make a http request and get the response.\n Format: REQUEST [] URL [] METHOD [] HEADERS [] BODY, HEADERS is json, BODY is json or text, None for a field that is not needed"""
         # if full body is passed
-        if len(self._parse_email_part(email_received["body"][0][0])[0]) == 5:
-            url = self._parse_email_part(email_received["body"][0][0])[0][1]
-            request_type = self._parse_email_part(email_received["body"][0][0])[0][2] # POST, GET, etc
-            headers = self._parse_email_part(email_received["body"][0][0])[0][3]
-            if len(self._parse_email_part(email_received["body"][0][0])[0]) > 4:
-                body = self._parse_email_part(email_received["body"][0][0])[0][4]
+        email_body_parts = self._parsed_command(email_received).raw
+        if len(email_body_parts) == 5:
+            url = email_body_parts[1]
+            request_type = email_body_parts[2] # POST, GET, etc
+            headers = email_body_parts[3]
+            body = email_body_parts[4]
             good_request = True
         else:
             good_request = False
         # make request with the URL provided
         if good_request:
-            
-            # convert the body to json
-            json_body = None
-            if body: json_body = body
-
+            result = None
+            attachments = []
             try:
-                response = requests.request(request_type, url, headers=headers, json=json_body)
-                response.raise_for_status()
-                response = response.json()
-            # primary catch
-            except requests.HTTPError as http_err:
-                response = f'REQUEST: HTTP error occurred: {http_err}'
+                headers = None if headers.lower() in ("none", "") else json.loads(headers)
+                # json body is sent as json, anything else as text
+                if body.lower() in ("none", ""):
+                    body = None
+                else:
+                    try:
+                        parsed_body = json.loads(body)
+                    except ValueError:
+                        parsed_body = None
+                    # only objects and arrays are sent as json, a scalar like 123 or true is text
+                    body = parsed_body if isinstance(parsed_body, (dict, list)) else body.encode("utf-8")
+                result = self.request_engine.request(request_type, url, headers=headers, body=body)
+                response_email_subject = f"REQUEST: Completed {result['status']} {result['reason']}"
+                if result["headers"].get("Location"):
+                    response_email_subject += f" -> {result['headers']['Location']}"
+                if result["path"]:
+                    attachments = [result["path"]]
+                    response = f"Response of {result['size']} bytes ({result['content_type']}) attached as {os.path.basename(result['path'])}"
+                else:
+                    response = self.request_engine.text(result)
             # catch all
             except Exception as err:
+                response_email_subject = f"REQUEST: Error"
                 response = f'REQUEST: Error occurred: {err}' 
-            response_email_subject = f"REQUEST: Completed"
             response_email_body = str(response)
-            return self._new_emalia_email(email_received, response_email_subject, response_email_body)
+            try:
+                return self._new_emalia_email(email_received, response_email_subject, response_email_body, attachments=attachments)
+            finally:
+                # attachment is read into the email already
+                self.request_engine.cleanup(result)
         
         # help menu
         else:
@@ -532,24 +822,24 @@ class Emalia():
             return self._new_emalia_email(email_received, response_email_subject, response_email_body)
     
     def _action_execute_python(self, email_received:dict)->Message:
-        """5 Execute a python script in current process by emalia permission
+        """5 Execute a python script in a python_pool worker process by emalia permission
         @param `email_received:dict` the email sent by sender, parsed to dict format with EmailManager.parse_email
-        @return `:Message` the response email to sender
-        UNSAFE: this function is not safe, need to limit scope of what can be executed
+            Body format: PYTHON [] code, everything after the command word is the script
+        @return `:Message` the response email to sender, with stdout and stderr of the script
+        UNSAFE: this function is not safe, need to limit scope of what can be executed, worker limits only stop runaway scripts
         """
         self.logger.info("execute_python: processing")
-        main_menu = """Main_menu"""
-        # if full body is passed
-        python_code = email_received["body"][0][0]
-        if not powershell_path: powershell_path = self._powershell_path
-        if python_code:
-            try:
-                exec(python_code) # need security check
-                response_email_subject = f"PYTHON: Completed"
-                response_email_body = str("Completed") 
-            except Exception as err:
-                response_email_subject = f"PYTHON: Error"
-                response_email_body = str(err)
+        main_menu = """Run a python script in a worker process, stdout and stderr are returned.\n Format: PYTHON [] code"""
+        # script is the body after the command word and an optional [] separator, [] inside the script are kept
+        python_code = email_received["body"][0][0][len(self._parsed_command(email_received).command):]
+        python_code = python_code.strip(" \t")
+        if python_code.startswith("[]"):
+            python_code = python_code[2:]
+        python_code = textwrap.dedent(python_code.strip("\r\n"))
+        if python_code.strip():
+            result = self.python_pool.run(python_code)
+            response_email_subject = f"PYTHON: Error" if result["error"] else f"PYTHON: Completed"
+            response_email_body = f"{result['error'] or 'Completed'} in {result['duration']:.2f}s\n\nstdout:\n{result['stdout']}\n\nstderr:\n{result['stderr']}"
             return self._new_emalia_email(email_received, response_email_subject, response_email_body)
         
         # help menu
@@ -568,7 +858,7 @@ class Emalia():
         """
         self.logger.info("gpt_request: processing")
         main_menu = """Options"""
-        email_gpt_request = self._parse_email_part(email_received["body"][0][0])
+        email_gpt_request = self._parsed_command(email_received)
         # collected but not returned
         # TODO return
         warning_messages = []
@@ -605,30 +895,62 @@ class Emalia():
             response_email_body = main_menu
         return self._new_emalia_email(email_received, response_email_subject, response_email_body)
     
+    def _load_custom_tasks(self)->dict:
+        """Read tasks saved by _action_register_custom_task
+        @return `:dict` {key: task} without "function", {} if none saved
+        """
+        try:
+            with open(os.path.join(self._save_path, "custom_action.json"), "r") as f:
+                return {task["key"]: task for task in json.load(f)}
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError, TypeError) as err:
+            self.logger.error(f"Cannot read custom_action.json: {err}")
+            return {}
+
+    def _custom_task_entry(self, key:str, task:dict)->dict:
+        """Build the registered task of a custom task saved by _action_register_custom_task
+        "attachments", "concurrency" and "cost" are copied from the builtin task the command runs, so the custom task is scheduled like it
+        @param `key:str` custom task key
+        @param `task:dict` custom task without "function"
+        @return `:dict` task to register
+        @raise ValueError if key or a trigger is a builtin key or trigger, or the command does not start with a builtin task
+        """
+        for trigger in [key] + list(task.get("trigger", [])):
+            if str(trigger).lower() in self._builtin_triggers:
+                raise ValueError(f"{trigger} is used by builtin task {self._builtin_triggers[str(trigger).lower()]}")
+        target_key = self._builtin_triggers.get(CommandParser.parse_command(task.get("command", "")).command)
+        if target_key is None:
+            raise ValueError(f"Command of a custom task must start with a builtin task, not {task.get('command')}")
+        target_task = self.tasks.get(target_key)
+        inherited = {field: target_task[field] for field in ("attachments", "concurrency", "cost") if field in target_task}
+        return {**task, **inherited, "function": self._action_run_custom_task, "target": target_key}
+
     def _action_register_custom_task(self, email_received:dict):
-        """9 user can store custom tasks (nest multiple or define new)
+        """9 user can store custom tasks, a custom task is a name for the command of another task
         @param `email_received:dict` the email sent by sender, parsed to dict format with EmailManager.parse_email
+            Body format: CUSTOM [name] [trigger, trigger] command, example CUSTOM [report] [report, daily] read [] report.txt
         @return `:Message` the response email to sender
         """
         self.logger.info("new_task: processing")
-        main_menu = """Options"""
-        new_task = self._parse_email_part(email_received["body"][0][0])
+        main_menu = """Store a command to run it later with a trigger word.\n Format: CUSTOM [name] [trigger, trigger] command, example CUSTOM [report] [report, daily] read [] report.txt"""
+        new_task = re.search(r"^\s*\w*\s*\[([^\[\]]+)\]\s*\[([^\[\]]+)\]\s*(.+)$", email_received["body"][0][0], re.DOTALL)
         
         if new_task:
-            # save to file
+            name, triggers, command = (part.strip() for part in new_task.groups())
+            key = name.lower()
+            task = {"key": key, "name": name, "trigger": [trigger.strip().lower() for trigger in triggers.split(",") if trigger.strip()], 
+                "description": f"Run: {command}", "help": "", "command": command}
             # TODO active flag
             try:
-                if os.path.exists(self._save_path + "custom_action.json"):
-                    with open(self._save_path + "custom_action.json", "r") as f:
-                        custom_tasks = json.load(f)
-                else:
-                    custom_tasks = []
-                with open(self._save_path + "custom_action.json", "w") as f:
-                    custom_tasks.append(new_task)
-                    json.dump(custom_tasks, f)
-                self.task_list[new_task["name"]] = new_task
+                # registered first so a trigger conflict is reported before anything is saved, only a custom task can be replaced
+                self.tasks.register(key, self._custom_task_entry(key, task), replace=key not in self._builtin_triggers)
+                custom_tasks = self._load_custom_tasks()
+                custom_tasks[key] = task
+                with open(os.path.join(self._save_path, "custom_action.json"), "w") as f:
+                    json.dump(list(custom_tasks.values()), f)
                 response_email_subject = f"TASK: Completed"
-                response_email_body = f"{new_task}\n\nSaved"
+                response_email_body = f"{task}\n\nSaved"
             except Exception as err:
                 response_email_subject = f"TASK: Error"
                 response_email_body = str(err)
@@ -641,8 +963,14 @@ class Emalia():
         
     def _action_run_custom_task(self, email_received:dict):
         """<custom command> run user stored custom tasks 
-        The first word in the body of of the email will be fuction identifier, rest is parameters
+        The stored command replace the email body and run with the task of its first word
         @param `email_received:dict` the email sent by sender, parsed to dict format with EmailManager.parse_email
         @return `:Message` the response email to sender
         """
-        pass
\ No newline at end of file
+        task = self.get_task(email_received["command"])
+        self.logger.info(f"custom_task: processing {task['name']}")
+        parsed_command = CommandParser.parse_command(task["command"])
+        target_task = self.get_task(parsed_command.command)
+        if not target_task or target_task["function"] == self._action_run_custom_task:
+            raise AttributeError(f"Custom task {task['name']} does not start with a builtin task")
+        return target_task["function"](dict(email_received, body=[(task["command"], "plain")] + email_received["body"][1:], parsed_command=parsed_command, command=parsed_command.command))
@@ -1,5 +1,15 @@
 import os
+import zlib
 import mimetypes
+import zipfile
+import tempfile
+import shutil
+import struct
+import hashlib
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
 """Functions to perform file operation
 """
 
@@ -167,4 +177,279 @@ def get_file_info(path:str, block:list)->dict:
         if key in info:
             del info[key]
             
-    return info
\ No newline at end of file
+    return info
+
+def tree_signature(path:str)->str:
+    """Cheap signature of a directory tree, changes when any entry is added, removed, resized or modified. File content is not read
+    @param `path:str` directory to sign
+    @return `:str` sha256 hex digest of relative path, size and mtime_ns of every entry
+    """
+    signature = hashlib.sha256()
+    root_path = os.path.realpath(path)
+    directories = [root_path]
+    while directories:
+        directory = directories.pop()
+        # scandir entries carry cached stat on most platforms, sort so order do not depend on file system
+        with os.scandir(directory) as scanned:
+            entries = sorted(scanned, key=lambda entry: entry.name)
+        for entry in entries:
+            relative_path = os.path.relpath(entry.path, root_path)
+            # links are not followed into, same as os.walk in walk_all, so a link cycle or dangling link is just an entry
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+                signature.update(f"d {relative_path}\0".encode("utf-8", "surrogateescape"))
+                continue
+            entry_stat = entry.stat(follow_symlinks=False)
+            signature.update(f"f {relative_path}\0{entry_stat.st_size}\0{entry_stat.st_mtime_ns}\0".encode("utf-8", "surrogateescape"))
+            if entry.is_symlink():
+                # a zip stores the content a file link points to, sign the target too when it exists
+                try:
+                    target_stat = os.stat(entry.path)
+                    signature.update(f"l {os.readlink(entry.path)}\0{target_stat.st_size}\0{target_stat.st_mtime_ns}\0".encode("utf-8", "surrogateescape"))
+                except OSError:
+                    signature.update(f"l {relative_path}\0".encode("utf-8", "surrogateescape"))
+    return signature.hexdigest()
+
+# mimetypes with already compressed content, deflate only spend cpu on them
+_COMPRESSED_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp", "image/heic", "image/avif", "video/", "audio/mpeg", "audio/aac", "audio/ogg", "audio/mp4", "audio/flac",
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-7z-compressed", "application/x-rar-compressed", "application/x-bzip2", "application/x-xz",
+    "application/zstd", "application/java-archive", "application/epub+zip", "application/vnd.openxmlformats-officedocument.", "application/vnd.oasis.opendocument.")
+
+def choose_compression(path:str, probe_size:int=64*1024, min_ratio:float=0.9)->int:
+    """Pick how a file is stored in a zip, by mimetype first, then by deflating a sample of the file
+    @param `path:str` file to check
+    @param `probe_size:int` bytes sampled from the start and middle of the file, smaller files are always deflated
+    @param `min_ratio:float` file is stored if the sample does not deflate below this ratio of its size
+    @return `:int` zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+    """
+    info = get_file_info(path, [])
+    # a content encoding like gzip (.tar.gz) means already compressed
+    if info.get("encoding") or info.get("type", "").startswith(_COMPRESSED_TYPES):
+        return zipfile.ZIP_STORED
+    if info.get("size", 0) <= probe_size:
+        return zipfile.ZIP_DEFLATED
+    with open(path, "rb") as f:
+        sample = f.read(probe_size // 2)
+        f.seek(info["size"] // 2)
+        sample += f.read(probe_size // 2)
+    return zipfile.ZIP_STORED if len(zlib.compress(sample, 1)) > len(sample) * min_ratio else zipfile.ZIP_DEFLATED
+
+def _compress_file(path:str, temp_path:str, chunk_size:int=1024*1024, probe_size:int=64*1024)->dict:
+    """Deflate one file for zip_directory, run in a worker process
+    @param `path:str` file to compress
+    @param `temp_path:str` directory to write compressed data larger than chunk_size
+    @return `:dict` {"compress_type": int, "CRC": int, "compress_size": int, "file_size": int, "data": bytes or None, "data_path": str or None}
+    compress_type is ZIP_STORED with no data if file should be stored as is, data is in data_path if not None
+    """
+    result = {"compress_type": zipfile.ZIP_STORED, "CRC": 0, "compress_size": 0, "file_size": 0, "data": None, "data_path": None}
+    if choose_compression(path, probe_size) == zipfile.ZIP_STORED:
+        return result
+    # raw deflate stream (no zlib header), as zip entries store it
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    output = tempfile.SpooledTemporaryFile(max_size=chunk_size, dir=temp_path)
+    with output, open(path, "rb") as source:
+        while chunk := source.read(chunk_size):
+            result["CRC"] = zlib.crc32(chunk, result["CRC"])
+            result["file_size"] += len(chunk)
+            output.write(compressor.compress(chunk))
+        output.write(compressor.flush())
+        result["compress_size"] = output.tell()
+        # did not shrink, store instead
+        if result["compress_size"] >= result["file_size"]:
+            return result
+        result["compress_type"] = zipfile.ZIP_DEFLATED
+        output.seek(0)
+        if result["compress_size"] <= chunk_size:
+            result["data"] = output.read()
+        else:
+            with tempfile.NamedTemporaryFile(dir=temp_path, delete=False) as data_file:
+                while chunk := output.read(chunk_size):
+                    data_file.write(chunk)
+            result["data_path"] = data_file.name
+    return result
+
+class _ZipWriter():
+    """ Minimal zip archive writer for zip_directory, entries are written as given, already deflated data is copied as is
+    zipfile has no public way to add data compressed elsewhere, so headers and central directory are written here by the zip specification (APPNOTE), zip64 when sizes or counts need it
+    """
+    def __init__(self, output):
+        """@param `output:file object` seekable binary file positioned where the archive start"""
+        self.output = output
+        self.start = output.tell()
+        self._entries = [] # (zip_info, flags, header offset)
+
+    @staticmethod
+    def _dos_time(zip_info:zipfile.ZipInfo)->tuple:
+        year, month, day, hour, minute, second = zip_info.date_time
+        return ((hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day)
+
+    def _local_header(self, zip_info:zipfile.ZipInfo, flags:int, zip64:bool)->bytes:
+        name = zip_info.filename.encode("utf-8")
+        extra = struct.pack("<HHQQ", 1, 16, zip_info.file_size, zip_info.compress_size) if zip64 else b""
+        dos_time, dos_date = self._dos_time(zip_info)
+        return struct.pack("<IHHHHHIIIHH", 0x04034b50, 45 if zip64 else 20, flags, zip_info.compress_type, dos_time, dos_date, zip_info.CRC,
+            0xFFFFFFFF if zip64 else zip_info.compress_size, 0xFFFFFFFF if zip64 else zip_info.file_size, len(name), len(extra)) + name + extra
+
+    def header_size(self, zip_info:zipfile.ZipInfo)->int:
+        """@return `:int` bytes of the local header of zip_info"""
+        return 30 + len(zip_info.filename.encode("utf-8")) + (20 if zip_info.file_size >= 0xFFFFFFFF else 0)
+
+    def add(self, zip_info:zipfile.ZipInfo, chunks, check=None):
+        """Write one entry
+        @param `zip_info:zipfile.ZipInfo` entry, compress_type, file_size are set, CRC and compress_size too if chunks is already compressed data
+        @param `chunks:iterable of bytes` data of the entry as stored in the archive
+        @param `check:function` called as check(bytes about to be written) before each write, can raise to abort
+        If compress_type is ZIP_STORED, CRC and sizes are computed from chunks and written back into the header
+        """
+        check = check or (lambda size: None)
+        # zip64 is decided by the size known now, sizes can only be written back if they fit the header
+        zip64 = zip_info.file_size >= 0xFFFFFFFF
+        flags = 0x800 if not zip_info.filename.isascii() else 0
+        offset = self.output.tell()
+        if zip_info.compress_type == zipfile.ZIP_STORED:
+            # placeholder until the data is read
+            zip_info.CRC, zip_info.compress_size = 0, 0
+        header = self._local_header(zip_info, flags, zip64)
+        check(len(header))
+        self.output.write(header)
+        if zip_info.compress_type == zipfile.ZIP_STORED:
+            crc, size = 0, 0
+            for chunk in chunks:
+                check(len(chunk))
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                self.output.write(chunk)
+            if (size >= 0xFFFFFFFF) != zip64:
+                raise ValueError(f"{zip_info.filename} changed size while zipped")
+            zip_info.CRC, zip_info.file_size, zip_info.compress_size = crc, size, size
+            end = self.output.tell()
+            self.output.seek(offset)
+            self.output.write(self._local_header(zip_info, flags, zip64))
+            self.output.seek(end)
+        else:
+            for chunk in chunks:
+                check(len(chunk))
+                self.output.write(chunk)
+        self._entries.append((zip_info, flags, offset - self.start))
+
+    def close(self):
+        """Write central directory and end records"""
+        directory_offset = self.output.tell() - self.start
+        for zip_info, flags, offset in self._entries:
+            name = zip_info.filename.encode("utf-8")
+            # zip64 extra only carry the fields that overflow, in this order
+            zip64_fields = [value for value in (zip_info.file_size, zip_info.compress_size, offset) if value >= 0xFFFFFFFF]
+            extra = struct.pack(f"<HH{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b""
+            dos_time, dos_date = self._dos_time(zip_info)
+            self.output.write(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | 45, 45 if zip64_fields else 20, flags, zip_info.compress_type, dos_time, dos_date,
+                zip_info.CRC, min(zip_info.compress_size, 0xFFFFFFFF), min(zip_info.file_size, 0xFFFFFFFF), len(name), len(extra), 0, 0, 0, zip_info.external_attr,
+                min(offset, 0xFFFFFFFF)) + name + extra)
+        directory_end = self.output.tell() - self.start
+        directory_size = directory_end - directory_offset
+        count = len(self._entries)
+        if count >= 0xFFFF or directory_offset >= 0xFFFFFFFF or directory_size >= 0xFFFFFFFF:
+            self.output.write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count, directory_size, directory_offset))
+            self.output.write(struct.pack("<IIQI", 0x07064b50, 0, directory_end, 1))
+        self.output.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF), min(directory_size, 0xFFFFFFFF), min(directory_offset, 0xFFFFFFFF), 0))
+
+# compressing processes shared by every zip_directory call, started on first use
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool(workers:int)->concurrent.futures.ProcessPoolExecutor:
+    """Process pool of zip_directory, created with workers processes on first use and reused after
+    forkserver start processes from a clean server process, forking the caller could deadlock as emalia runs many threads
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            _pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn"))
+        return _pool
+
+def shutdown_pool():
+    """Stop the process pool of zip_directory, a later call start a new one"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def zip_directory(path:str, max_size:int=-1, spool_size:int=8*1024*1024, chunk_size:int=1024*1024, workers:int=None, parallel_size:int=4*1024*1024)->tuple:
+    """Zip a directory into a temp file, memory use do not grow with directory size
+    Each file is stored or deflated depending on choose_compression, files are deflated in parallel by a process pool then written in order into one archive
+    @param `path:str` directory to zip, entries are stored relative to it
+    @param `max_size:int` max size of archive in bytes, abort before the archive grows over it, <0 for no limit
+    @param `spool_size:int` archive is kept in memory up to this size, then moved to a temp file on disk
+    @param `chunk_size:int` bytes read from each file at a time
+    @param `workers:int` number of compressing processes, None for cpu count, <=1 to compress in this process
+        The pool is shared by all calls and keeps the size of the first call that started it, see shutdown_pool
+    @param `parallel_size:int` directories with less bytes than this are compressed in this process, sending files to the pool cost more than it saves
+    @return `:tuple len(2)` (archive:SpooledTemporaryFile positioned at 0, info:dict {"entries": int, "stored_entries": int, "compressed_size": int, "uncompressed_size": int})
+    @raise ValueError if archive is over max_size
+    Caller must close the returned archive
+    """
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"{path} is not a directory")
+    root_path = os.path.realpath(path)
+    zip_infos = [zipfile.ZipInfo.from_file(file_path, os.path.relpath(file_path, root_path)) for file_path in walk_all(root_path, "file")]
+    uncompressed_size = sum(zip_info.file_size for zip_info in zip_infos)
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    archive = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    temp_path = tempfile.mkdtemp(prefix="emalia-zip-")
+    executor = None
+    if workers > 1 and len(zip_infos) > 1 and uncompressed_size >= parallel_size:
+        executor = _get_pool(workers)
+    def check_size(size:int):
+        # checked before writing, nothing over max_size is ever written
+        if max_size >= 0 and archive.tell() + size > max_size:
+            raise ValueError(f"Archive of {path} is over max size {max_size} bytes")
+    def read_chunks(file_path:str, remove:bool=False):
+        """[generator] chunks of a file, file is removed after if remove"""
+        with open(file_path, "rb") as source:
+            while chunk := source.read(chunk_size):
+                yield chunk
+        if remove:
+            os.remove(file_path)
+    pending = collections.deque()
+    def compressed():
+        """[generator] _compress_file result of each entry in order, at most a few entries per worker are compressed ahead"""
+        if executor is None:
+            for zip_info in zip_infos:
+                yield _compress_file(os.path.join(root_path, zip_info.filename), temp_path, chunk_size)
+            return
+        for zip_info in zip_infos:
+            pending.append(executor.submit(_compress_file, os.path.join(root_path, zip_info.filename), temp_path, chunk_size))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    stored_entries = 0
+    try:
+        writer = _ZipWriter(archive)
+        for zip_info, result in zip(zip_infos, compressed()):
+            file_path = os.path.join(root_path, zip_info.filename)
+            zip_info.compress_type = result["compress_type"]
+            if result["compress_type"] == zipfile.ZIP_STORED:
+                # copy by chunk so a large file is never fully in memory
+                writer.add(zip_info, read_chunks(file_path), check_size)
+                stored_entries += 1
+            else:
+                for key in ("CRC", "compress_size", "file_size"):
+                    setattr(zip_info, key, result[key])
+                # whole entry checked first, deflated data is not written at all if it cannot fit
+                check_size(writer.header_size(zip_info) + result["compress_size"])
+                writer.add(zip_info, [result["data"]] if result["data_path"] is None else read_chunks(result["data_path"], remove=True))
+        writer.close()
+        check_size(0)
+    except BaseException:
+        archive.close()
+        raise
+    finally:
+        # entries compressed ahead are not needed any more
+        for future in pending:
+            future.cancel()
+        shutil.rmtree(temp_path, ignore_errors=True)
+    compressed_size = archive.tell()
+    archive.seek(0)
+    return (archive, {"entries": len(zip_infos), "stored_entries": stored_entries, "compressed_size": compressed_size, "uncompressed_size": uncompressed_size})
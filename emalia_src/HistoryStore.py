@@ -0,0 +1,329 @@
+import os
+import abc
+import csv
+import ast
+import json
+import time
+import queue
+import sqlite3
+import threading
+import logging
+import argparse
+from datetime import datetime
+from email.utils import parsedate_to_datetime, parseaddr
+"""Email history backends, record emails sent and received without blocking the caller
+"""
+
+def normalize_address(address:str)->str:
+    """Bare lower case address of "Name <a@b.com>", "<a@b.com>" or "a@b.com", senders are stored and searched in this form
+    @param `address:str` email address as found in a header
+    @return `:str` example "a@b.com", address unchanged if it cannot be parsed, "" for None
+    """
+    if not address:
+        return ""
+    return (parseaddr(address)[1] or address).strip().lower()
+
+def _email_record(email_received:dict, action:str, comment:str="", task:str="", error:str=None)->dict:
+    """Flatten a parsed email into one history record
+    @param `email_received:dict` email parsed by EmailManager.parse_email
+    @param `action:str` "received"|"sent", email type
+    @param `comment:str` comment to add for email
+    @param `task:str` task_list key the email triggered, "" if none
+    @param `error:str` error message if the task failed, None if succeeded
+    @return `:dict` record with keys "message_id", "sender", "date", "timestamp", "subject", "action", "task", "comment", "error", "body", "raw"
+    """
+    # plain body first, it is what commands are parsed from
+    body = ""
+    for body_part in email_received.get("body") or []:
+        if isinstance(body_part, (tuple, list)) and body_part and isinstance(body_part[0], str):
+            body = body_part[0]
+            if len(body_part) < 2 or body_part[1] == "plain":
+                break
+    try:
+        timestamp = parsedate_to_datetime(email_received["date"]).timestamp() if email_received.get("date") else time.time()
+    except (TypeError, ValueError):
+        timestamp = time.time()
+    # attachment data is on disk already, only keep name and handle
+    raw = dict(email_received)
+    # tokens of the body, the body is already stored
+    raw.pop("parsed_command", None)
+    raw["attachments"] = [(attachment[0], attachment[1] if isinstance(attachment[1], dict) else None) for attachment in email_received.get("attachments") or []]
+    return {
+        "message_id": email_received.get("id"),
+        "sender": normalize_address(email_received.get("sender") or email_received.get("from")),
+        "date": email_received.get("date"),
+        "timestamp": timestamp,
+        "subject": email_received.get("subject"),
+        "action": action,
+        "task": task,
+        "comment": comment,
+        "error": error,
+        "body": body,
+        "raw": json.dumps(raw, default=str)
+    }
+
+class HistoryStore(abc.ABC):
+    """ Base of email history backends
+    record() must return immediately, writing is done by the backend
+    """
+    @abc.abstractmethod
+    def record(self, email_received:dict, action:str, comment:str="", task:str="", error:str=None):
+        """Record one email
+        @param `email_received:dict` email parsed by EmailManager.parse_email
+        @param `action:str` "received"|"sent", email type
+        @param `comment:str` comment to add for email
+        @param `task:str` task_list key the email triggered, "" if none
+        @param `error:str` error message if the task failed, None if succeeded
+        """
+
+    def flush(self):
+        """Block until every recorded email is written"""
+        pass
+
+    def close(self):
+        """Write remaining records and release the backend"""
+        self.flush()
+
+class CSVHistoryStore(HistoryStore):
+    """ History in a csv file with the columns of SQLiteHistoryStore, one row per record, lookups need a full scan
+    Not the format of EmailManager.store_email_to_csv, use migrate_csv to import those files
+    Header is checked once when the store is opened instead of on every write
+    """
+    fieldnames = ["message_id", "sender", "date", "timestamp", "subject", "action", "task", "comment", "error", "body", "raw"]
+
+    def __init__(self, path:str):
+        """@param `path:str` csv file, create if dne"""
+        self.path = path
+        self._lock = threading.Lock()
+        self._write_header = not (os.path.exists(path) and os.path.getsize(path) > 0)
+
+    def record(self, email_received:dict, action:str, comment:str="", task:str="", error:str=None):
+        with self._lock:
+            with open(self.path, "a", newline="", encoding="utf-8") as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=self.fieldnames)
+                if self._write_header:
+                    writer.writeheader()
+                    self._write_header = False
+                writer.writerow(_email_record(email_received, action, comment, task, error))
+
+class SQLiteHistoryStore(HistoryStore):
+    """ History in a sqlite database (WAL mode) with indexed sender, date, message id, action and task
+    Records are queued by record() and written in batches by a background thread, so history writes never wait on disk in the request path
+    """
+    columns = ["message_id", "sender", "date", "timestamp", "subject", "action", "task", "comment", "error", "body", "raw"]
+
+    def __init__(self, path:str, batch_size:int=200, flush_interval:float=1.0, logger:logging.Logger=None):
+        """Open or create the database and start the writer thread
+        @param `path:str` database file, create if dne
+        @param `batch_size:int` max records written in one transaction
+        @param `flush_interval:float` max seconds a record waits in queue before written
+        @param `logger:logging.Logger` where write errors are logged, logger of this module if None
+        """
+        self.path = path
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._closed = False
+        # create schema before writer and readers start
+        connection = self._connect()
+        self._create_schema(connection)
+        connection.close()
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self)->sqlite3.Connection:
+        """Open a connection in WAL mode, readers do not block the writer and the writer do not block readers"""
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _create_schema(self, connection:sqlite3.Connection):
+        with connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY,
+                message_id TEXT, sender TEXT, date TEXT, timestamp REAL, subject TEXT,
+                action TEXT, task TEXT, comment TEXT, error TEXT, body TEXT, raw TEXT)""")
+            for column in ("message_id", "sender", "timestamp", "action", "task"):
+                connection.execute(f"CREATE INDEX IF NOT EXISTS history_{column} ON history ({column})")
+            if connection.execute("PRAGMA user_version").fetchone()[0] < 1:
+                # senders were stored as found in the email before version 1
+                connection.create_function("normalize_address", 1, normalize_address)
+                connection.execute("UPDATE history SET sender = normalize_address(sender)")
+                connection.execute("PRAGMA user_version = 1")
+        # full text index of subject and body, kept in sync by trigger so the writer and migrate_csv need no extra step
+        try:
+            with connection:
+                fts_exists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'history_fts'").fetchone()
+                connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(subject, body, content='history', content_rowid='id')")
+                connection.execute("""CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+                    INSERT INTO history_fts (rowid, subject, body) VALUES (new.id, new.subject, new.body); END""")
+                connection.execute("""CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+                    INSERT INTO history_fts (history_fts, rowid, subject, body) VALUES ('delete', old.id, old.subject, old.body); END""")
+                if not fts_exists:
+                    # index records written before full text search existed
+                    connection.execute("INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
+            self.full_text = True
+        except sqlite3.OperationalError:
+            # sqlite built without fts5, search() falls back to LIKE
+            self.full_text = False
+
+    def reader(self)->sqlite3.Connection:
+        """Connection for queries, one per thread
+        @return `:sqlite3.Connection` rows returned as sqlite3.Row
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._connect()
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+        return connection
+
+    def record(self, email_received:dict, action:str, comment:str="", task:str="", error:str=None):
+        if self._closed:
+            raise ValueError("History store is closed")
+        # flatten now, email_received may be modified by caller later
+        self._queue.put(_email_record(email_received, action, comment, task, error))
+
+    def _write_loop(self):
+        """[thread] write queued records in batches until a None is queued"""
+        connection = None
+        running = True
+        while running:
+            records = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # gather a batch, wait at most flush_interval for more
+            while len(records) < self.batch_size and records[-1] is not None:
+                try:
+                    records.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if records[-1] is None:
+                running = False
+            to_write = [record for record in records if record is not None]
+            try:
+                if to_write:
+                    if connection is None:
+                        connection = self._connect()
+                    with connection:
+                        connection.executemany(f"INSERT INTO history ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))})",
+                            [[record[column] for column in self.columns] for record in to_write])
+            except Exception:
+                # history is best effort, losing a batch must not stop the writer or flush() would wait forever
+                self.logger.exception(f"Cannot write {len(to_write)} history records to {self.path}")
+                if connection is not None:
+                    # connection may be broken, open a new one for next batch
+                    connection.close()
+                    connection = None
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+        if connection is not None:
+            connection.close()
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+
+    def find(self, **filters)->list:
+        """Exact match lookup by indexed columns
+        @param `filters` column=value, example find(sender="a@b.com", action="received"), sender in any form normalize_address accepts
+        @return `:list of sqlite3.Row` matching records, oldest first
+        """
+        for column in filters:
+            if column not in self.columns:
+                raise AttributeError(f"Unknown column {column}")
+        if filters.get("sender"):
+            filters["sender"] = normalize_address(filters["sender"])
+        where = " AND ".join(f"{column} = ?" for column in filters) or "1"
+        return self.reader().execute(f"SELECT * FROM history WHERE {where} ORDER BY timestamp", list(filters.values())).fetchall()
+
+    def search(self, text:str="", sender:str=None, since=None, until=None, task:str=None, error:bool=None, action:str=None, offset:int=0, page_size:int=50):
+        """Search history by words in subject or body and by field, newest first
+        Uses the fts5 index if sqlite supports it, LIKE over subject and body otherwise
+        @param `text:str` words that must all appear in subject or body, "" for any
+        @param `sender:str` sender address, "a@b.com", "<a@b.com>" or "Name <a@b.com>", None for any
+        @param `since:float|datetime` only records at or after this time, None for any
+        @param `until:float|datetime` only records before this time, None for any
+        @param `task:str` task_list key, None for any
+        @param `error:bool` True for failed tasks only, False for succeeded only, None for any
+        @param `action:str` "received"|"sent", None for any
+        @param `offset:int` number of matching records to skip
+        @param `page_size:int` records read from database at once
+        @return `:generator of sqlite3.Row` matching records, read lazily page_size at a time
+        Example: search("report", sender="a@b.com", since=datetime(2023, 1, 1), error=True)
+        """
+        conditions = []
+        values = []
+        source = "history"
+        words = text.split()
+        if words and self.full_text:
+            source = "history JOIN history_fts ON history_fts.rowid = history.id"
+            conditions.append("history_fts MATCH ?")
+            # quote every word so user input is never read as fts syntax
+            values.append(" ".join('"' + word.replace('"', '""') + '"' for word in words))
+        else:
+            for word in words:
+                conditions.append("(history.subject LIKE ? OR history.body LIKE ?)")
+                values += [f"%{word}%", f"%{word}%"]
+        if sender:
+            conditions.append("history.sender = ?")
+            values.append(normalize_address(sender))
+        for condition, value in (("history.timestamp >= ?", since), ("history.timestamp < ?", until)):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value.timestamp() if isinstance(value, datetime) else float(value))
+        if task is not None:
+            conditions.append("history.task = ?")
+            values.append(task)
+        if action is not None:
+            conditions.append("history.action = ?")
+            values.append(action)
+        if error is not None:
+            conditions.append("history.error IS NOT NULL" if error else "history.error IS NULL")
+        where = " AND ".join(conditions) or "1"
+        cursor = self.reader().execute(f"SELECT history.* FROM {source} WHERE {where} ORDER BY history.timestamp DESC, history.id DESC LIMIT -1 OFFSET ?", values + [offset])
+        try:
+            while rows := cursor.fetchmany(page_size):
+                yield from rows
+        finally:
+            cursor.close()
+
+def migrate_csv(csv_path:str, store:HistoryStore)->int:
+    """Import a history csv written by EmailManager.store_email_to_csv into a history store
+    @param `csv_path:str` history csv file
+    @param `store:HistoryStore` store to import into
+    @return `:int` number of records imported
+    """
+    count = 0
+    with open(csv_path, "r", newline="", encoding="utf-8") as csvfile:
+        for row in csv.DictReader(csvfile):
+            email_received = dict(row)
+            # body was written with str(list of tuples)
+            try:
+                email_received["body"] = ast.literal_eval(row.get("body") or "[]")
+            except (ValueError, SyntaxError):
+                email_received["body"] = [(row.get("body") or "", "plain")]
+            email_received["attachments"] = []
+            store.record(email_received, row.get("action") or "received", row.get("comment") or "")
+            count += 1
+    store.flush()
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import history.csv files into a sqlite history database")
+    parser.add_argument("csv_paths", nargs="+", help="history csv files to import")
+    parser.add_argument("--database", default="history.db", help="sqlite history database, create if dne")
+    arguments = parser.parse_args()
+    history_store = SQLiteHistoryStore(arguments.database)
+    for csv_path in arguments.csv_paths:
+        print(f"{csv_path}: {migrate_csv(csv_path, history_store)} records imported")
+    history_store.close()
@@ -0,0 +1,159 @@
+import email.header
+from urllib.parse import unquote
+"""Functions to parse imap FETCH responses (BODYSTRUCTURE, literals, nested lists) that imaplib returns unparsed
+"""
+
+_OPEN = object() # token for "("
+_CLOSE = object() # token for ")"
+
+def _tokenize(text:bytes)->list:
+    """Split one line of imap response into tokens
+    @param `text:bytes` response line, a trailing literal size {n} is skipped as the literal is passed separately by imaplib
+    @return `:list` tokens, _OPEN, _CLOSE, bytes for atom and quoted string, None for NIL
+    """
+    tokens = []
+    i = 0
+    length = len(text)
+    while i < length:
+        char = text[i:i+1]
+        if char in (b" ", b"\r", b"\n"):
+            i += 1
+        elif char == b"(":
+            tokens.append(_OPEN)
+            i += 1
+        elif char == b")":
+            tokens.append(_CLOSE)
+            i += 1
+        elif char == b'"':
+            # quoted string, \ escapes " and \
+            value = bytearray()
+            i += 1
+            while i < length and text[i:i+1] != b'"':
+                if text[i:i+1] == b"\\":
+                    i += 1
+                value += text[i:i+1]
+                i += 1
+            tokens.append(bytes(value))
+            i += 1
+        elif char == b"{":
+            # literal size, literal itself follows in next response item
+            i = text.index(b"}", i) + 1
+        else:
+            # atom, BODY[HEADER] keeps everything inside []
+            start = i
+            while i < length and text[i:i+1] not in (b" ", b"(", b")", b"\r", b"\n"):
+                if text[i:i+1] == b"[":
+                    i = text.index(b"]", i)
+                i += 1
+            atom = text[start:i]
+            tokens.append(None if atom.upper() == b"NIL" else atom)
+    return tokens
+
+def parse_fetch_response(response:list)->list:
+    """Parse FETCH response returned by imaplib into a dict of items per email
+    @param `response:list` data returned by imaplib fetch/uid("FETCH"), bytes lines and (line, literal) tuples
+    @return `:list of dict` one dict per email in response order, {"SEQ": bytes, item name in upper case: value}
+      values are bytes (atom, string, literal), None (NIL) or nested list, example {"SEQ": b"1", "UID": b"5", "BODY[HEADER]": b"..."}
+    """
+    tokens = []
+    for item in response:
+        if isinstance(item, tuple):
+            tokens.extend(_tokenize(item[0]))
+            tokens.append(item[1])
+        elif isinstance(item, bytes):
+            tokens.extend(_tokenize(item))
+    # build nested list
+    stack = [[]]
+    for token in tokens:
+        if token is _OPEN:
+            stack.append([])
+        elif token is _CLOSE:
+            if len(stack) > 1:
+                nested = stack.pop()
+                stack[-1].append(nested)
+        else:
+            stack[-1].append(token)
+    while len(stack) > 1:
+        nested = stack.pop()
+        stack[-1].append(nested)
+    # "SEQ (NAME VALUE NAME VALUE ...)" for each email
+    emails = []
+    top_level = stack[0]
+    for i in range(len(top_level) - 1):
+        if isinstance(top_level[i], bytes) and top_level[i].isdigit() and isinstance(top_level[i + 1], list):
+            items = top_level[i + 1]
+            fetched = {"SEQ": top_level[i]}
+            for j in range(0, len(items) - 1, 2):
+                if isinstance(items[j], bytes):
+                    fetched[items[j].decode().upper()] = items[j + 1]
+            emails.append(fetched)
+    return emails
+
+def _to_str(value)->str:
+    """Decode a parsed value to str, None stays None"""
+    if value is None:
+        return None
+    return value.decode("utf-8", "replace") if isinstance(value, bytes) else str(value)
+
+def _to_params(value)->dict:
+    """Convert a parameter list ("NAME" "VALUE" ...) to dict with lower case keys, RFC 2231 and encoded word values are decoded
+    @param `value:list|None` parsed parameter list
+    @return `:dict` {name: value}
+    """
+    params = {}
+    if not isinstance(value, list):
+        return params
+    for i in range(0, len(value) - 1, 2):
+        name = _to_str(value[i]).lower()
+        param = _to_str(value[i + 1])
+        if param is None:
+            continue
+        if name.endswith("*"):
+            # RFC 2231 charset'language'value
+            name = name[:-1]
+            charset, _, value_encoded = param.split("'", 2) if param.count("'") >= 2 else ("", "", param)
+            try:
+                param = unquote(value_encoded, encoding=charset or "utf-8", errors="replace")
+            except LookupError:
+                param = unquote(value_encoded, errors="replace")
+        elif "=?" in param:
+            param = str(email.header.make_header(email.header.decode_header(param)))
+        params[name] = param
+    return params
+
+def parse_bodystructure(structure:list, section:str="")->list:
+    """Flatten a parsed BODYSTRUCTURE into the list of leaf parts with their section number (for BODY[section])
+    @param `structure:list` BODYSTRUCTURE value from parse_fetch_response
+    @param `section:str` section of structure, "" for top level
+    @return `:list of dict` [{"section": str, "type": str, "params": dict, "encoding": str, "size": int, "disposition": str|None, "filename": str|None}]
+    Example: multipart/mixed with text and a pdf -> [{"section": "1", "type": "text/plain", ...}, {"section": "2", "type": "application/pdf", "disposition": "attachment", ...}]
+    """
+    if structure and isinstance(structure[0], list):
+        # multipart: child parts then subtype and extension data
+        parts = []
+        for i, child in enumerate(structure):
+            if not isinstance(child, list):
+                break
+            parts.extend(parse_bodystructure(child, f"{section}.{i + 1}" if section else f"{i + 1}"))
+        return parts
+    main_type = (_to_str(structure[0]) or "").lower()
+    sub_type = (_to_str(structure[1]) or "").lower()
+    params = _to_params(structure[2])
+    encoding = (_to_str(structure[5]) or "7bit").lower()
+    size = int(structure[6]) if structure[6] else 0
+    # text has line count, message/rfc822 has envelope, body and line count before extension data
+    extension = 7 + (1 if main_type == "text" else 0) + (3 if (main_type, sub_type) == ("message", "rfc822") else 0)
+    disposition, disposition_params = None, {}
+    # extension data: md5, then disposition
+    if len(structure) > extension + 1 and isinstance(structure[extension + 1], list) and structure[extension + 1]:
+        disposition = (_to_str(structure[extension + 1][0]) or "").lower()
+        disposition_params = _to_params(structure[extension + 1][1] if len(structure[extension + 1]) > 1 else None)
+    return [{
+        "section": section if section else "1",
+        "type": f"{main_type}/{sub_type}",
+        "params": params,
+        "encoding": encoding,
+        "size": size,
+        "disposition": disposition,
+        "filename": disposition_params.get("filename") or params.get("name")
+    }]
@@ -0,0 +1,143 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from email.parser import BytesHeaderParser
+
+class MessageCache():
+    """ A maildir style disk cache of raw RFC822 emails, so an email fetched once can be read again without the imap server
+    Emails are written to root/tmp then moved to root/cur, file name is [uidvalidity]_[uid]_[message id hash] so the index is rebuilt from file names only
+    Lookup by (UIDVALIDITY, UID) or by Message-Id, least recently used emails are removed when the cache is over max_size
+    """
+    _name_pattern = re.compile(r"^(\d+)_(\d+)_([0-9a-f]*)$")
+
+    def __init__(self, root:str, max_size:int=256*1024*1024):
+        """Open or create a cache at root
+        @param `root:str` directory of the cache, create if DNE
+        @param `max_size:int` max total bytes of cached emails, <0 for no limit
+        """
+        self.root = os.path.realpath(root)
+        self.max_size = max_size
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+        os.makedirs(os.path.join(self.root, "cur"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = {} # {(uidvalidity, uid): {"name": str, "size": int, "last_access": float}}
+        self._message_ids = {} # {message id hash: (uidvalidity, uid)}
+        for entry in os.scandir(os.path.join(self.root, "cur")):
+            match = self._name_pattern.match(entry.name)
+            if not match:
+                continue
+            entry_stat = entry.stat()
+            key = (int(match.group(1)), int(match.group(2)))
+            self._entries[key] = {"name": entry.name, "size": entry_stat.st_size, "last_access": entry_stat.st_mtime}
+            if match.group(3):
+                self._message_ids[match.group(3)] = key
+
+    def _message_id_hash(self, message_id:str)->str:
+        """Message-Id can contain any character, only its hash is used in file names"""
+        return hashlib.sha256(message_id.strip().encode("utf-8", "replace")).hexdigest()[:32] if message_id else ""
+
+    def _path(self, name:str)->str:
+        return os.path.join(self.root, "cur", name)
+
+    def __contains__(self, key:tuple)->bool:
+        """@param `key:tuple` (uidvalidity, uid)"""
+        with self._lock:
+            return (int(key[0]), int(key[1])) in self._entries
+
+    def total_size(self)->int:
+        """@return `:int` total bytes of cached emails"""
+        with self._lock:
+            return sum(entry["size"] for entry in self._entries.values())
+
+    def put(self, uidvalidity:int, uid:int|str, raw_email:bytes):
+        """Cache a raw email, replace the cached email with same uid, then remove least recently used emails over max_size
+        @param `uidvalidity:int` UIDVALIDITY of the mailbox
+        @param `uid:int|str` uid of the email
+        @param `raw_email:bytes` RFC822 email as fetched with BODY[]
+        """
+        key = (int(uidvalidity), int(uid))
+        message_id = BytesHeaderParser().parsebytes(raw_email).get("Message-ID", "")
+        message_id_hash = self._message_id_hash(message_id)
+        name = f"{key[0]}_{key[1]}_{message_id_hash}"
+        temp_path = os.path.join(self.root, "tmp", f"{name}.{threading.get_ident()}")
+        with open(temp_path, "wb") as f:
+            f.write(raw_email)
+        with self._lock:
+            old_entry = self._entries.get(key)
+            os.replace(temp_path, self._path(name))
+            if old_entry and old_entry["name"] != name:
+                self._remove(key)
+            self._entries[key] = {"name": name, "size": len(raw_email), "last_access": time.time()}
+            if message_id_hash:
+                self._message_ids[message_id_hash] = key
+            self._evict(keep=key)
+
+    def get(self, uidvalidity:int, uid:int|str)->bytes:
+        """Read a cached email
+        @param `uidvalidity:int` UIDVALIDITY of the mailbox, None always miss
+        @param `uid:int|str` uid of the email
+        @return `:bytes` raw email, None if not cached
+        """
+        if uidvalidity is None:
+            return None
+        key = (int(uidvalidity), int(uid))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            try:
+                with open(self._path(entry["name"]), "rb") as f:
+                    raw_email = f.read()
+            except FileNotFoundError:
+                self._remove(key)
+                return None
+            # mtime is used as last access time so it survives restart
+            entry["last_access"] = time.time()
+            os.utime(self._path(entry["name"]))
+        return raw_email
+
+    def get_by_message_id(self, message_id:str)->bytes:
+        """Read a cached email by its Message-Id header
+        @param `message_id:str` Message-Id, example "<abc@mail.gmail.com>"
+        @return `:bytes` raw email, None if not cached
+        """
+        with self._lock:
+            key = self._message_ids.get(self._message_id_hash(message_id))
+        if key is None:
+            return None
+        return self.get(*key)
+
+    def discard(self, uidvalidity:int, uid:int|str):
+        """Remove a cached email if cached"""
+        with self._lock:
+            self._remove((int(uidvalidity), int(uid)))
+
+    def _remove(self, key:tuple):
+        """Remove one email from disk and index, must hold self._lock"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        message_id_hash = self._name_pattern.match(entry["name"]).group(3)
+        if self._message_ids.get(message_id_hash) == key:
+            del self._message_ids[message_id_hash]
+        try:
+            os.remove(self._path(entry["name"]))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep:tuple=None):
+        """Remove least recently used emails until cache is under max_size, must hold self._lock
+        @param `keep:tuple` (uidvalidity, uid) of an email that must not be removed
+        """
+        if self.max_size < 0:
+            return
+        total_size = sum(entry["size"] for entry in self._entries.values())
+        for key, entry in sorted(self._entries.items(), key=lambda item: item[1]["last_access"]):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total_size -= entry["size"]
+            self._remove(key)
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import uuid
+import email
+import random
+import smtplib
+import threading
+from email.message import Message
+from email.generator import BytesGenerator
+from ConnectionPool import DeliveryUnknownError
+"""Durable outbox, emails are written to disk and sent by a background thread with retry and rate limit
+"""
+
+class TokenBucket():
+    """ Allow up to capacity events per period, refilled continuously
+    Uses wall clock time so the state can be saved and restored across restarts
+    """
+    def __init__(self, capacity:float, period:float, tokens:float=None, updated:float=None):
+        """@param `capacity:float` max events per period, <0 for no limit
+        @param `period:float` seconds to refill a full bucket
+        @param `tokens:float` tokens left, full if None
+        @param `updated:float` time.time() of tokens, now if None
+        """
+        self.capacity = capacity
+        self.period = period
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.updated = time.time() if updated is None else updated
+
+    def _refill(self, now:float):
+        if self.capacity >= 0 and now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.period)
+        self.updated = now
+
+    def available(self, now:float=None)->int:
+        """@return `:int` whole tokens available now, -1 for no limit"""
+        if self.capacity < 0:
+            return -1
+        self._refill(time.time() if now is None else now)
+        return int(self.tokens)
+
+    def consume(self, count:int=1, now:float=None):
+        """Take count tokens, tokens can go negative if more were taken than available"""
+        if self.capacity < 0:
+            return
+        self._refill(time.time() if now is None else now)
+        self.tokens -= count
+
+    def wait_time(self, count:int=1, now:float=None)->float:
+        """@return `:float` seconds until count tokens are available, 0 if available now"""
+        if self.capacity < 0:
+            return 0.0
+        self._refill(time.time() if now is None else now)
+        if self.tokens >= count:
+            return 0.0
+        if self.capacity == 0:
+            return float("inf")
+        return (count - self.tokens) * self.period / self.capacity
+
+    def state(self)->dict:
+        """@return `:dict` {"tokens": float, "updated": float}, used to restore with TokenBucket(capacity, period, **state)"""
+        return {"tokens": self.tokens, "updated": self.updated}
+
+class Outbox():
+    """ An on disk queue of outgoing emails drained by a background sender
+    Each email is directory/pending/<id>.eml with retry information in <id>.json, ids sort in enqueue order
+    Emails not sent are retried with exponential backoff, emails that fail max_attempts times, are refused permanently or may have been delivered by a send that broke after DATA are moved to directory/failed
+    Sending is limited by per minute, per day and total quotas, limits and pending emails survive restart
+    """
+    def __init__(self, directory:str, send_many, per_minute:int=-1, per_day:int=-1, max_total:int=-1, max_attempts:int=8,
+                 base_delay:float=5.0, max_delay:float=3600.0, batch_size:int=20, on_sent=None, on_failed=None):
+        """Open or create an outbox, call start() to begin sending
+        @param `directory:str` outbox directory, create if dne
+        @param `send_many:function` send a list of Message, return [(Message, error:Exception|None)] such as EmailManager.send_many
+        @param `per_minute:int` max emails sent per minute, <0 for no limit
+        @param `per_day:int` max emails sent per day, <0 for no limit
+        @param `max_total:int` max emails sent by this outbox object, emails over the limit stay pending, <0 for no limit
+        @param `max_attempts:int` attempts before an email is moved to failed
+        @param `base_delay:float` seconds before first retry, doubled each attempt
+        @param `max_delay:float` max seconds between retries
+        @param `batch_size:int` max emails given to send_many at once
+        @param `on_sent:function` called as on_sent(Message) from sender thread after each email is sent, optional
+        @param `on_failed:function` called as on_failed(Message, error:Exception) from sender thread when an email is moved to failed, optional
+        """
+        self.directory = directory
+        self.pending_path = os.path.join(directory, "pending")
+        self.failed_path = os.path.join(directory, "failed")
+        os.makedirs(self.pending_path, exist_ok=True)
+        os.makedirs(self.failed_path, exist_ok=True)
+        self.send_many = send_many
+        self.max_total = max_total
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.sent_count = 0
+        state = self._load_state()
+        self.buckets = {
+            "minute": TokenBucket(per_minute, 60, **state.get("minute", {})),
+            "day": TokenBucket(per_day, 24 * 60 * 60, **state.get("day", {}))
+        }
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def _load_state(self)->dict:
+        """@return `:dict` saved bucket states {"minute": dict, "day": dict}, {} if not saved"""
+        try:
+            with open(os.path.join(self.directory, "state.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        """Write bucket states atomically"""
+        state_path = os.path.join(self.directory, "state.json")
+        with open(state_path + ".tmp", "w") as f:
+            json.dump({name: bucket.state() for name, bucket in self.buckets.items()}, f)
+        os.replace(state_path + ".tmp", state_path)
+
+    def _write_meta(self, email_id:str, meta:dict):
+        meta_path = os.path.join(self.pending_path, f"{email_id}.json")
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def _read_meta(self, email_id:str)->dict:
+        try:
+            with open(os.path.join(self.pending_path, f"{email_id}.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # email written but meta lost, send now
+            return {"attempts": 0, "next_attempt": 0, "last_error": None}
+
+    def enqueue(self, outgoing_email:Message)->str:
+        """Write an email to the outbox, returns once the email is on disk
+        @param `outgoing_email:Message` email to send, prepare with EmailManager.new_email
+        @return `:str` id of the email in outbox
+        """
+        email_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        self._write_meta(email_id, {"attempts": 0, "next_attempt": 0, "last_error": None})
+        email_path = os.path.join(self.pending_path, f"{email_id}.eml")
+        with open(email_path + ".tmp", "wb") as f:
+            BytesGenerator(f).flatten(outgoing_email)
+        os.replace(email_path + ".tmp", email_path)
+        self._wake.set()
+        return email_id
+
+    def pending(self)->list:
+        """@return `:list of str` ids of emails not yet sent, in enqueue order"""
+        return sorted(name[:-len(".eml")] for name in os.listdir(self.pending_path) if name.endswith(".eml"))
+
+    def failed(self)->list:
+        """@return `:list of str` ids of emails that will not be retried"""
+        return sorted(name[:-len(".eml")] for name in os.listdir(self.failed_path) if name.endswith(".eml"))
+
+    def load(self, email_id:str)->Message:
+        """@return `:Message` pending email by id"""
+        with open(os.path.join(self.pending_path, f"{email_id}.eml"), "rb") as f:
+            return email.message_from_binary_file(f)
+
+    def _is_permanent(self, err:Exception)->bool:
+        """@return `:bool` True if retrying cannot succeed or may deliver twice, such as a missing receiver, a 5xx reply or a connection lost after DATA"""
+        if isinstance(err, (AttributeError, ValueError, DeliveryUnknownError)):
+            return True
+        if isinstance(err, smtplib.SMTPRecipientsRefused):
+            return all(code >= 500 for code, _ in err.recipients.values())
+        if isinstance(err, smtplib.SMTPResponseException):
+            return err.smtp_code >= 500
+        return False
+
+    def _remove(self, email_id:str):
+        for extension in (".eml", ".json"):
+            try:
+                os.remove(os.path.join(self.pending_path, email_id + extension))
+            except FileNotFoundError:
+                pass
+
+    def _quota(self, now:float)->int:
+        """@return `:int` emails that can be sent now, -1 for no limit"""
+        limits = [bucket.available(now) for bucket in self.buckets.values()]
+        if self.max_total >= 0:
+            limits.append(self.max_total - self.sent_count)
+        limits = [max(0, limit) for limit in limits if limit >= 0]
+        return min(limits) if limits else -1
+
+    def send_due(self, now:float=None)->float:
+        """Send one batch of emails due now, within quota
+        @param `now:float` time.time() to use, now if None
+        @return `:float` seconds until next email can be sent, inf if outbox is empty or max_total is reached
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            due = []
+            next_attempt = float("inf")
+            for email_id in self.pending():
+                meta = self._read_meta(email_id)
+                if meta["next_attempt"] <= now:
+                    due.append((email_id, meta))
+                else:
+                    next_attempt = min(next_attempt, meta["next_attempt"])
+            if not due:
+                return next_attempt - now
+            quota = self._quota(now)
+            if quota == 0:
+                if self.max_total >= 0 and self.sent_count >= self.max_total:
+                    return float("inf")
+                return max(bucket.wait_time(1, now) for bucket in self.buckets.values())
+            due = due[:self.batch_size if quota < 0 else min(quota, self.batch_size)]
+            batch = []
+            for email_id, meta in due:
+                try:
+                    batch.append((email_id, meta, self.load(email_id)))
+                except FileNotFoundError:
+                    self._remove(email_id)
+            # provider counts attempts, not deliveries
+            for bucket in self.buckets.values():
+                bucket.consume(len(batch), now)
+            self._save_state()
+            results = self.send_many([outgoing_email for _, _, outgoing_email in batch])
+            for (email_id, meta, _), (outgoing_email, send_error) in zip(batch, results):
+                if send_error is None:
+                    self._remove(email_id)
+                    self.sent_count += 1
+                    if self.on_sent:
+                        self.on_sent(outgoing_email)
+                    continue
+                meta["attempts"] += 1
+                meta["last_error"] = repr(send_error)
+                if meta["attempts"] >= self.max_attempts or self._is_permanent(send_error):
+                    self._write_meta(email_id, meta)
+                    for extension in (".eml", ".json"):
+                        os.replace(os.path.join(self.pending_path, email_id + extension), os.path.join(self.failed_path, email_id + extension))
+                    if self.on_failed:
+                        self.on_failed(outgoing_email, send_error)
+                else:
+                    # exponential backoff with jitter so emails failed together do not retry together
+                    delay = min(self.max_delay, self.base_delay * 2 ** (meta["attempts"] - 1))
+                    meta["next_attempt"] = now + delay * random.uniform(0.8, 1.0)
+                    self._write_meta(email_id, meta)
+            return 0.0
+
+    def _send_loop(self):
+        """[thread] send due emails until stop()"""
+        while self._running:
+            try:
+                wait = self.send_due()
+            except Exception:
+                # send_many should not raise, wait before trying again if it did
+                wait = self.base_delay
+            if wait > 0:
+                self._wake.wait(min(wait, self.max_delay))
+                self._wake.clear()
+
+    def start(self):
+        """Start the background sender, repeated call have no effect"""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._send_loop, name="outbox-sender", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout:float=None):
+        """Stop the background sender after the current batch, pending emails stay on disk"""
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
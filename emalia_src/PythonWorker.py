@@ -0,0 +1,164 @@
+import io
+import sys
+import time
+import queue
+import signal
+import traceback
+import threading
+import contextlib
+import multiprocessing
+try:
+    import resource # posix only, no cpu and memory limit without it
+except ImportError:
+    resource = None
+"""Pool of warm python processes that run code sent by email, with time, cpu and memory limits
+"""
+
+class CPUTimeExceeded(Exception):
+    pass
+
+def _on_cpu_limit(signum, frame):
+    raise CPUTimeExceeded("CPU time limit exceeded")
+
+def _worker_main(connection, memory:int, max_output:int):
+    """[worker process] run code received from connection until None is received
+    @param `memory:int` max bytes of address space, <0 for no limit
+    @param `max_output:int` max characters of stdout and stderr returned each
+    """
+    if resource is not None:
+        if memory >= 0:
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        code, cpu_time = job
+        if resource is not None and cpu_time >= 0:
+            # RLIMIT_CPU count the whole process life, allow cpu_time more than used so far
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            limit = int(usage.ru_utime + usage.ru_stime + cpu_time) + 1
+            resource.setrlimit(resource.RLIMIT_CPU, (limit, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+        stdout, stderr = io.StringIO(), io.StringIO()
+        error = None
+        start_time = time.monotonic()
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                exec(compile(code, "<email>", "exec"), {"__name__": "__main__", "__builtins__": __builtins__})
+        except BaseException as err:
+            error = f"{type(err).__name__}: {err}"
+            stderr.write(traceback.format_exc())
+        if resource is not None and cpu_time >= 0:
+            resource.setrlimit(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+        result = {"stdout": stdout.getvalue()[-max_output:], "stderr": stderr.getvalue()[-max_output:], "error": error, "duration": time.monotonic() - start_time}
+        try:
+            connection.send(result)
+        except (OSError, ValueError):
+            return
+
+class PythonWorkerPool():
+    """ Processes started ahead and reused, so a script start without interpreter startup and imports stay loaded between scripts
+    Each script run in one worker at a time, scripts run in parallel up to workers
+    A worker is replaced after max_jobs scripts, or at once if its script timed out or crashed it
+    UNSAFE: limits stop runaway scripts, they do not sandbox, a script can still do anything the user running emalia can
+    """
+    def __init__(self, workers:int=2, timeout:float=30.0, cpu_time:int=30, memory:int=512*1024*1024, max_jobs:int=50, max_output:int=64*1024):
+        """@param `workers:int` number of worker processes
+        @param `timeout:float` max wall clock seconds of one script, the worker is killed after
+        @param `cpu_time:int` max cpu seconds of one script, <0 for no limit
+        @param `memory:int` max bytes of address space of a worker, <0 for no limit
+        @param `max_jobs:int` scripts run by a worker before it is replaced, <0 to never replace
+        @param `max_output:int` max characters of stdout and stderr returned, the end is kept
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.cpu_time = cpu_time
+        self.memory = memory
+        self.max_jobs = max_jobs
+        self.max_output = max_output
+        # forkserver fork workers from a clean process, forking a process with threads running can deadlock
+        self._context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+        self._idle = queue.Queue() # workers ready for a script, {"process", "connection", "jobs"}
+        self._lock = threading.Lock()
+        self._all = [] # every worker started and not stopped
+        self._running = False
+
+    def _new_worker(self)->dict:
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child_connection, self.memory, self.max_output), daemon=True, name="emalia-python")
+        process.start()
+        child_connection.close()
+        worker = {"process": process, "connection": parent_connection, "jobs": 0}
+        with self._lock:
+            self._all.append(worker)
+        return worker
+
+    def _stop_worker(self, worker:dict, kill:bool=False):
+        """Stop one worker, ask it to exit unless kill"""
+        with self._lock:
+            if worker in self._all:
+                self._all.remove(worker)
+        if not kill:
+            try:
+                worker["connection"].send(None)
+                worker["process"].join(1)
+            except (OSError, ValueError):
+                pass
+        if worker["process"].is_alive():
+            worker["process"].kill()
+            worker["process"].join(1)
+        worker["connection"].close()
+
+    def start(self):
+        """Start the worker processes, repeated call have no effect"""
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        for _ in range(self.workers):
+            self._idle.put(self._new_worker())
+
+    def stop(self):
+        """Stop every worker, scripts running are killed"""
+        with self._lock:
+            self._running = False
+            workers = list(self._all)
+        for worker in workers:
+            self._stop_worker(worker)
+        while not self._idle.empty():
+            self._idle.get_nowait()
+
+    def run(self, code:str)->dict:
+        """Run a script on the first free worker, wait for a worker if all are busy
+        @param `code:str` python code
+        @return `:dict` {"stdout": str, "stderr": str, "error": str or None, "duration": float}, error is set if the script raised, timed out or crashed the worker
+        """
+        self.start()
+        worker = self._idle.get()
+        replace = False
+        try:
+            worker["connection"].send((code, self.cpu_time))
+            worker["jobs"] += 1
+            if worker["connection"].poll(self.timeout):
+                result = worker["connection"].recv()
+                if result["error"] and result["error"].startswith(("CPUTimeExceeded", "MemoryError")):
+                    # worker may be left near its limit
+                    replace = True
+            else:
+                result = {"stdout": "", "stderr": "", "error": f"Timed out after {self.timeout} seconds", "duration": self.timeout}
+                replace = True
+        except (EOFError, OSError) as err:
+            # worker died, example killed by cpu hard limit
+            result = {"stdout": "", "stderr": "", "error": f"Worker exited with code {worker['process'].exitcode}: {err}", "duration": 0.0}
+            replace = True
+        finally:
+            if replace or (0 <= self.max_jobs <= worker["jobs"]) or not self._running:
+                self._stop_worker(worker, kill=replace)
+                if self._running:
+                    self._idle.put(self._new_worker())
+            else:
+                self._idle.put(worker)
+        return result
@@ -0,0 +1,153 @@
+import os
+import re
+import json
+import queue
+import shutil
+import mimetypes
+import tempfile
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+"""HTTP client of the REQUEST task, keep-alive sessions per host, timeouts and bounded response size
+"""
+
+class RequestEngine():
+    """ Make http requests with a pool of requests.Session per host, a session is used by one request at a time so connections (and TLS) are reused safely across threads
+    Sessions keep no cookies between requests, requests of different senders share connections but nothing else
+    Responses are streamed, kept in memory up to memory_size, written to a file in a temp directory above it, and aborted above max_size
+    """
+    def __init__(self, connect_timeout:float=5.0, read_timeout:float=30.0, memory_size:int=256*1024, max_size:int=20*1024*1024, pool_size:int=4, chunk_size:int=64*1024):
+        """@param `connect_timeout:float` max seconds to connect
+        @param `read_timeout:float` max seconds between two bytes received
+        @param `memory_size:int` responses up to this many bytes are returned in memory, larger ones in a file
+        @param `max_size:int` max bytes of a response body, <0 for no limit
+        @param `pool_size:int` max idle sessions kept per host
+        @param `chunk_size:int` bytes read from the response at a time
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.memory_size = memory_size
+        self.max_size = max_size
+        self.pool_size = pool_size
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._sessions = {} # {(scheme, host): queue.LifoQueue of idle sessions}, most recently used first so warm connections are reused
+
+    def _new_session(self)->requests.Session:
+        session = requests.Session()
+        # one connection per session, the pool of sessions is the pool of connections
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _checkout(self, host_key:tuple)->requests.Session:
+        with self._lock:
+            idle = self._sessions.setdefault(host_key, queue.LifoQueue())
+        try:
+            return idle.get_nowait()
+        except queue.Empty:
+            return self._new_session()
+
+    def _checkin(self, host_key:tuple, session:requests.Session):
+        # sessions are shared by every sender, only the connection is kept, cookies (a login of one sender) and auth are not
+        session.cookies.clear()
+        session.auth = None
+        with self._lock:
+            idle = self._sessions.setdefault(host_key, queue.LifoQueue())
+            if idle.qsize() < self.pool_size:
+                idle.put(session)
+                return
+        session.close()
+
+    def request(self, method:str, url:str, headers:dict=None, body=None)->dict:
+        """Make one request and read the response within max_size
+        @param `method:str` GET, POST, etc
+        @param `url:str` http or https url
+        @param `headers:dict` request headers, None for none
+        @param `body:dict|list|str|bytes` request body, dict and list are sent as json, None for no body
+        @return `:dict` {"status": int, "reason": str, "headers": dict, "content_type": str, "size": int, "body": bytes or None, "path": str or None, "elapsed": float}
+            body is set if size <= memory_size, else path is a file in a temp directory, caller must remove it with cleanup(result)
+            Redirects are not followed, a 3xx is returned with its Location header, a session only ever hold a connection to the host it is pooled under
+        @raise ValueError if the response is over max_size, AttributeError if url is not http(s)
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.netloc:
+            raise AttributeError(f"Unknown url {url}, must start with http:// or https://")
+        host_key = (parts.scheme, parts.netloc.lower())
+        session = self._checkout(host_key)
+        keep_session = False
+        output = None
+        try:
+            response = session.request(method.upper(), url, headers=headers, json=body if isinstance(body, (dict, list)) else None,
+                data=body if not isinstance(body, (dict, list)) else None, timeout=self.timeout, stream=True, allow_redirects=False)
+            with response:
+                length = response.headers.get("Content-Length")
+                if self.max_size >= 0 and length and length.isdigit() and int(length) > self.max_size:
+                    raise ValueError(f"Response of {length} bytes is over max size {self.max_size} bytes")
+                data = bytearray()
+                size = 0
+                for chunk in response.iter_content(self.chunk_size):
+                    size += len(chunk)
+                    if self.max_size >= 0 and size > self.max_size:
+                        raise ValueError(f"Response is over max size {self.max_size} bytes")
+                    if output is None and size > self.memory_size:
+                        output = open(os.path.join(tempfile.mkdtemp(prefix="emalia-request-"), self._file_name(url, response)), "wb")
+                        output.write(data)
+                        data = None
+                    if output is None:
+                        data += chunk
+                    else:
+                        output.write(chunk)
+                # fully read, connection can be reused
+                keep_session = True
+            result = {"status": response.status_code, "reason": response.reason, "headers": dict(response.headers), "content_type": response.headers.get("Content-Type", ""),
+                "size": size, "body": bytes(data) if output is None else None, "path": output.name if output else None, "elapsed": response.elapsed.total_seconds()}
+        except BaseException:
+            if output is not None:
+                output.close()
+                shutil.rmtree(os.path.dirname(output.name), ignore_errors=True)
+            raise
+        finally:
+            if keep_session:
+                self._checkin(host_key, session)
+            else:
+                session.close()
+        if output is not None:
+            output.close()
+        return result
+
+    def _file_name(self, url:str, response:requests.Response)->str:
+        """Name of the file a large response is saved to, from Content-Disposition, then url, then content type"""
+        match = re.search(r'filename="?([^";]+)"?', response.headers.get("Content-Disposition", ""))
+        name = match.group(1) if match else os.path.basename(urlsplit(url).path)
+        name = re.sub(r"[^\w.\-]", "_", name).strip(".") or "response"
+        if not os.path.splitext(name)[1]:
+            name += mimetypes.guess_extension(response.headers.get("Content-Type", "").split(";")[0].strip()) or ".bin"
+        return name
+
+    @staticmethod
+    def cleanup(result:dict):
+        """Remove the file of a response returned by request, if any"""
+        if result and result.get("path"):
+            shutil.rmtree(os.path.dirname(result["path"]), ignore_errors=True)
+
+    @staticmethod
+    def text(result:dict)->str:
+        """Body of an in memory response as text, json is indented"""
+        charset = re.search(r"charset=([\w\-]+)", result["content_type"])
+        text = result["body"].decode(charset.group(1) if charset else "utf-8", "replace")
+        if "json" in result["content_type"]:
+            try:
+                return json.dumps(json.loads(text), indent=2, ensure_ascii=False)
+            except ValueError:
+                pass
+        return text
+
+    def close(self):
+        """Close every idle session"""
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for idle in sessions.values():
+            while not idle.empty():
+                idle.get_nowait().close()
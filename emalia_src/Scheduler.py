@@ -0,0 +1,153 @@
+import time
+import threading
+import collections
+from datetime import datetime
+"""Schedulers of Emalia.main_loop
+"""
+
+class PollScheduler():
+    """ Decide how long main_loop waits before next inbox scan
+    Scan at min_interval right after activity or while tasks are pending, multiply the interval by backoff after each idle scan up to max_interval
+    During quiet hours an idle loop wait quiet_interval at once, but never past the end of quiet hours
+    """
+    def __init__(self, min_interval:float=5.0, max_interval:float=300.0, backoff:float=2.0, quiet_hours:list=[], quiet_interval:float=1800.0):
+        """@param `min_interval:float` seconds between scans while active
+        @param `max_interval:float` max seconds between scans when idle
+        @param `backoff:float` interval is multiplied by this after each idle scan
+        @param `quiet_hours:list of list len(2)` [[start, end]] times "HH:MM" of each quiet period, end before start wrap past midnight, example [["23:00", "07:00"]]
+        @param `quiet_interval:float` seconds between idle scans during quiet hours
+        """
+        if min_interval < 0 or max_interval < min_interval or backoff < 1:
+            raise ValueError("Need 0 <= min_interval <= max_interval and backoff >= 1")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.quiet_interval = quiet_interval
+        self.quiet_hours = [(self._parse_time(start), self._parse_time(end)) for start, end in quiet_hours]
+        self.interval = min_interval
+
+    @staticmethod
+    def _parse_time(text:str)->int:
+        """"HH:MM" -> minutes since midnight"""
+        hour, _, minute = str(text).partition(":")
+        minutes = int(hour) * 60 + int(minute or 0)
+        if not 0 <= minutes <= 24 * 60:
+            raise ValueError(f"Unknown time {text}, use HH:MM")
+        return minutes
+
+    def quiet_remaining(self, now:datetime=None)->float:
+        """@return `:float` seconds until the current quiet period ends, 0 if not in quiet hours"""
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute + now.second / 60
+        for start, end in self.quiet_hours:
+            if start <= end and start <= minute < end:
+                remaining = end - minute
+            elif start > end and (minute >= start or minute < end):
+                remaining = (end - minute) % (24 * 60)
+            else:
+                continue
+            return remaining * 60
+        return 0.0
+
+    def next_interval(self, activity:int=0, backlog:int=0, now:datetime=None)->float:
+        """Update and return the wait before next scan
+        @param `activity:int` emails found by the last scan
+        @param `backlog:int` emails still waiting or being processed
+        @param `now:datetime` current time, for quiet hours
+        @return `:float` seconds to wait
+        """
+        if activity > 0 or backlog > 0:
+            self.interval = self.min_interval
+            return self.interval
+        quiet_remaining = self.quiet_remaining(now)
+        if quiet_remaining > 0:
+            # wake up when quiet hours end at the latest, idle scans after that continue at max_interval
+            self.interval = min(self.quiet_interval, quiet_remaining)
+            return self.interval
+        self.interval = min(self.max_interval, max(self.interval, self.min_interval) * self.backoff)
+        return self.interval
+
+class PriorityScheduler():
+    """ Queues of waiting jobs by class, the next job is picked by smooth weighted round robin over non empty queues
+    A class with weight 4 is served 4 times as often as a class with weight 1 while both have jobs, a class alone is served at full speed
+    Aging: a job waiting longer than max_wait is served before any other job, oldest first, so no class starves
+    Thread safe, can be used as Dispatcher queue
+    """
+    def __init__(self, weights:dict={"vip_fast": 8, "vip_slow": 4, "fast": 4, "slow": 1}, max_wait:float=60.0):
+        """@param `weights:dict` {class name: int weight >0}, jobs put to an unknown class use weight 1
+        @param `max_wait:float` seconds a job can wait before it is served first, <0 to disable aging
+        """
+        self.weights = dict(weights)
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._queues = collections.OrderedDict((name, collections.deque()) for name in self.weights) # {class name: deque of (put time, job)}
+        self._current = collections.Counter() # smooth weighted round robin credit of each class
+        self._waits = {name: {"count": 0, "total": 0.0, "max": 0.0} for name in self.weights} # wait time of jobs already served
+
+    def put(self, job, queue_name:str):
+        """Queue a job
+        @param `job:any` job to queue
+        @param `queue_name:str` class of the job
+        """
+        with self._lock:
+            if queue_name not in self._queues:
+                self.weights.setdefault(queue_name, 1)
+                self._queues[queue_name] = collections.deque()
+                self._waits[queue_name] = {"count": 0, "total": 0.0, "max": 0.0}
+            self._queues[queue_name].append((time.monotonic(), job))
+
+    def get(self, now:float=None, ready=None):
+        """Remove and return the next job to run
+        @param `now:float` time.monotonic() of now, for testing
+        @param `ready:function` ready(job)->bool, only jobs it accepts can be returned, None to accept all
+            A class without a ready job is skipped, it gain no round robin credit and its jobs keep their place and wait time
+        @return `:any` the job, None if no job is queued and ready
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            # first ready job of each class, jobs of a class are served in order unless blocked
+            candidates = {}
+            for name, queue in self._queues.items():
+                for index, (_, job) in enumerate(queue):
+                    if ready is None or ready(job):
+                        candidates[name] = index
+                        break
+            if not candidates:
+                return None
+            active = list(candidates)
+            # aged job first
+            oldest = min(active, key=lambda name: self._queues[name][candidates[name]][0])
+            if 0 <= self.max_wait <= now - self._queues[oldest][candidates[oldest]][0]:
+                chosen = oldest
+            else:
+                for name in active:
+                    self._current[name] += self.weights[name]
+                chosen = max(active, key=lambda name: self._current[name])
+                self._current[chosen] -= sum(self.weights[name] for name in active)
+            queue = self._queues[chosen]
+            put_time, job = queue[candidates[chosen]]
+            del queue[candidates[chosen]]
+            if not queue:
+                # credit is only kept while a class has jobs waiting
+                self._current.pop(chosen, None)
+            wait = self._waits[chosen]
+            wait["count"] += 1
+            wait["total"] += now - put_time
+            wait["max"] = max(wait["max"], now - put_time)
+            return job
+
+    def __len__(self)->int:
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def statistics(self, now:float=None)->dict:
+        """@return `:dict` {class name: {"queued": int, "oldest_wait": float, "served": int, "average_wait": float, "max_wait": float}} wait in seconds"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return {name: {
+                "queued": len(queue),
+                "oldest_wait": now - queue[0][0] if queue else 0.0,
+                "served": self._waits[name]["count"],
+                "average_wait": self._waits[name]["total"] / self._waits[name]["count"] if self._waits[name]["count"] else 0.0,
+                "max_wait": self._waits[name]["max"]
+            } for name, queue in self._queues.items()}
@@ -0,0 +1,62 @@
+import threading
+from types import MappingProxyType
+"""Registry of Emalia tasks with a trigger index
+"""
+
+class TaskRegistry():
+    """ Tasks by key, each task is a dict with at least "function", "name" and "trigger" (list of str, not case sensitive)
+    tasks and triggers are read only views, replaced as a whole when a task is registered or removed, so readers never lock and never see a half built index
+    Lookup by key or by trigger is one dict access
+    """
+    def __init__(self, tasks:dict={}):
+        """@param `tasks:dict` {key: task} initial tasks, keys are lower case
+        @raise ValueError if two tasks share a trigger
+        """
+        self._lock = threading.Lock()
+        self._build(dict(tasks))
+
+    def _build(self, tasks:dict):
+        """Replace tasks and rebuild trigger index, must hold self._lock or be in __init__
+        @raise ValueError if two tasks share a trigger, nothing is replaced
+        """
+        triggers = {}
+        for key, task in tasks.items():
+            # key is a trigger too, example "1" for READ
+            for trigger in [key] + list(task.get("trigger", [])):
+                trigger = str(trigger).lower()
+                if triggers.setdefault(trigger, key) != key:
+                    raise ValueError(f"Trigger {trigger} of task {key} is already used by task {triggers[trigger]}")
+        self._tasks = tasks
+        self.tasks = MappingProxyType(tasks) # {key: task}
+        self.triggers = MappingProxyType(triggers) # {trigger: key}
+
+    def register(self, key:str, task:dict, replace:bool=False):
+        """Add a task
+        @param `key:str` task key, lower case
+        @param `task:dict` task, see class doc
+        @param `replace:bool` replace the task already registered under key, if False a registered key is refused
+        @raise ValueError if key is registered and not replace, or a trigger is used by another task
+        """
+        with self._lock:
+            if key in self._tasks and not replace:
+                raise ValueError(f"Task {key} is already registered")
+            tasks = dict(self._tasks)
+            tasks[key] = task
+            self._build(tasks)
+
+    def unregister(self, key:str):
+        """Remove a task if registered"""
+        with self._lock:
+            tasks = dict(self._tasks)
+            if tasks.pop(key, None) is not None:
+                self._build(tasks)
+
+    def find(self, trigger:str)->str:
+        """@param `trigger:str` a task key or trigger, not case sensitive
+        @return `:str` key of the task, None if no task has this trigger
+        """
+        return self.triggers.get(str(trigger).lower())
+
+    def get(self, key:str, default=None)->dict:
+        """@return `:dict` task of key, default if not registered"""
+        return self.tasks.get(key, default)
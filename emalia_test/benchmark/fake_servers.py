@@ -0,0 +1,504 @@
+import re
+import time
+import json
+import select
+import threading
+import socketserver
+from email import message_from_bytes
+from email.message import Message
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+"""In process stand-in servers for benchmarks: IMAP4rev1 (subset used by EmailManager), SMTP sink and HTTP stub
+All servers listen on 127.0.0.1 without TLS, connect with {"host": host, "port": port, "ssl": False}
+latency is slept before every response, to simulate a remote provider
+"""
+
+class Mailbox():
+    """ A thread safe in memory mailbox shared by all connections of FakeIMAPServer
+    """
+    def __init__(self, uidvalidity:int=1):
+        self.uidvalidity = uidvalidity
+        self.next_uid = 1
+        self.messages = [] # [{"uid": int, "flags": set, "raw": bytes, "message": Message, "added": float}] in sequence order
+        self.condition = threading.Condition()
+
+    def append(self, raw:bytes|Message, flags:tuple=())->int:
+        """Deliver an email
+        @param `raw:bytes|Message` the email
+        @param `flags:tuple of str` initial flags, () for unseen
+        @return `:int` uid of the email
+        """
+        if isinstance(raw, Message):
+            raw = raw.as_bytes()
+        # imap literal use CRLF line ending
+        raw = re.sub(rb"\r?\n", b"\r\n", raw)
+        with self.condition:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages.append({"uid": uid, "flags": set(flags), "raw": raw, "message": message_from_bytes(raw), "added": time.monotonic()})
+            self.condition.notify_all()
+        return uid
+
+    def expunge(self, uid:int):
+        """Remove an email, sequence numbers of later emails shift down"""
+        with self.condition:
+            self.messages = [message for message in self.messages if message["uid"] != uid]
+            self.condition.notify_all()
+
+def _parse_set(message_set:str, largest:int)->set:
+    """Expand an imap sequence set such as "1:3,5,9:*"
+    @param `largest:int` value of "*"
+    @return `:set of int`
+    """
+    numbers = set()
+    for item in message_set.split(","):
+        if ":" in item:
+            start, end = (largest if value == "*" else int(value) for value in item.split(":"))
+            numbers.update(range(min(start, end), max(start, end) + 1))
+        elif item:
+            numbers.add(largest if item == "*" else int(item))
+    return numbers
+
+def _quote(value)->str:
+    """imap quoted string, NIL for None"""
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def _payload_bytes(part:Message)->bytes:
+    """Body of a leaf part as transmitted (still transfer encoded)"""
+    payload = part.get_payload()
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, list):
+        # message/rfc822, the attached email
+        return re.sub(rb"\r?\n", b"\r\n", payload[0].as_bytes())
+    return re.sub(rb"\r?\n", b"\r\n", payload.encode("ascii", "surrogateescape") if payload.isascii() else payload.encode("utf-8"))
+
+def _params(params:list)->str:
+    if not params:
+        return "NIL"
+    return "(" + " ".join(f"{_quote(name.upper())} {_quote(value)}" for name, value in params) + ")"
+
+def bodystructure(part:Message)->str:
+    """BODYSTRUCTURE of an email (message/rfc822 parts are reported as leaf parts)"""
+    if part.is_multipart() and part.get_content_type() != "message/rfc822":
+        return "(" + "".join(bodystructure(child) for child in part.get_payload()) + f" {_quote(part.get_content_subtype().upper())})"
+    params = [(name, value) for name, value in (part.get_params() or [])[1:]]
+    body = _payload_bytes(part)
+    structure = [_quote(part.get_content_maintype().upper()), _quote(part.get_content_subtype().upper()), _params(params),
+        _quote(part.get("Content-ID")), _quote(part.get("Content-Description")), _quote((part.get("Content-Transfer-Encoding") or "7BIT").upper()), str(len(body))]
+    if part.get_content_maintype() == "text":
+        structure.append(str(body.count(b"\n") + 1))
+    elif part.get_content_type() == "message/rfc822":
+        # envelope is not used by clients here
+        structure.extend(["NIL", bodystructure(part.get_payload(0)), str(body.count(b"\n") + 1)])
+    # extension data: md5, disposition
+    structure.append("NIL")
+    disposition = part.get_content_disposition()
+    if disposition:
+        disposition_params = [(name, value) for name, value in (part.get_params(header="Content-Disposition") or [])[1:]]
+        structure.append(f"({_quote(disposition.upper())} {_params(disposition_params)})")
+    else:
+        structure.append("NIL")
+    return "(" + " ".join(structure) + ")"
+
+def _section(message:dict, section:str)->bytes:
+    """Content of BODY[section]"""
+    raw = message["raw"]
+    if section == "":
+        return raw
+    if section == "HEADER":
+        end = raw.find(b"\r\n\r\n")
+        return raw if end < 0 else raw[:end + 4]
+    part = message["message"]
+    for depth, number in enumerate(section.split(".")):
+        if depth and part.get_content_type() == "message/rfc822":
+            part = part.get_payload(0)
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+        elif number != "1":
+            return b""
+    return _payload_bytes(part)
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    """One imap connection"""
+    def send(self, line:str|bytes):
+        self.wfile.write((line.encode() if isinstance(line, str) else line) + b"\r\n")
+
+    def handle(self):
+        self.mailbox = self.server.mailbox
+        self.selected = False
+        self.readonly = False
+        self.known_exists = 0
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE] fake imap ready")
+        while line := self.rfile.readline():
+            line = line.rstrip(b"\r\n").decode("utf-8", "replace")
+            tag, _, rest = line.partition(" ")
+            command, _, arguments = rest.partition(" ")
+            command = command.upper()
+            if command == "UID":
+                command, _, arguments = arguments.partition(" ")
+                command = "UID " + command.upper()
+            time.sleep(self.server.latency)
+            self.server.commands.append(command)
+            try:
+                handler = getattr(self, "do_" + command.replace(" ", "_"), None)
+                if handler is None:
+                    self.send(f"{tag} BAD unknown command {command}")
+                    continue
+                if handler(tag, arguments) is False:
+                    return
+            except (ValueError, IndexError) as err:
+                self.send(f"{tag} BAD {err}")
+
+    def do_CAPABILITY(self, tag, arguments):
+        self.send("* CAPABILITY IMAP4rev1 IDLE")
+        self.send(f"{tag} OK CAPABILITY completed")
+
+    def do_LOGIN(self, tag, arguments):
+        self.send(f"{tag} OK LOGIN completed")
+
+    def do_LOGOUT(self, tag, arguments):
+        self.send("* BYE logging out")
+        self.send(f"{tag} OK LOGOUT completed")
+        return False
+
+    def _report_exists(self):
+        with self.mailbox.condition:
+            exists = len(self.mailbox.messages)
+        if exists != self.known_exists:
+            self.send(f"* {exists} EXISTS")
+            self.known_exists = exists
+
+    def do_NOOP(self, tag, arguments):
+        if self.selected:
+            self._report_exists()
+        self.send(f"{tag} OK NOOP completed")
+
+    def do_SELECT(self, tag, arguments, readonly=False):
+        with self.mailbox.condition:
+            exists = len(self.mailbox.messages)
+            unseen = [i + 1 for i, message in enumerate(self.mailbox.messages) if "\\Seen" not in message["flags"]]
+            uidnext = self.mailbox.next_uid
+        self.selected = True
+        self.readonly = readonly
+        self.known_exists = exists
+        self.send("* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)")
+        self.send(f"* {exists} EXISTS")
+        self.send("* 0 RECENT")
+        if unseen:
+            self.send(f"* OK [UNSEEN {unseen[0]}] first unseen")
+        self.send(f"* OK [UIDVALIDITY {self.mailbox.uidvalidity}] UIDs valid")
+        self.send(f"* OK [UIDNEXT {uidnext}] predicted next UID")
+        self.send(f"{tag} OK [{'READ-ONLY' if readonly else 'READ-WRITE'}] SELECT completed")
+
+    def do_EXAMINE(self, tag, arguments):
+        self.do_SELECT(tag, arguments, readonly=True)
+
+    def do_STATUS(self, tag, arguments):
+        mailbox, _, items = arguments.partition(" ")
+        with self.mailbox.condition:
+            values = {"MESSAGES": len(self.mailbox.messages), "UIDNEXT": self.mailbox.next_uid, "UIDVALIDITY": self.mailbox.uidvalidity,
+                "UNSEEN": sum(1 for message in self.mailbox.messages if "\\Seen" not in message["flags"]), "RECENT": 0}
+        reported = [f"{name} {values[name]}" for name in items.strip("() ").upper().split() if name in values]
+        self.send(f"* STATUS {mailbox} ({' '.join(reported)})")
+        self.send(f"{tag} OK STATUS completed")
+
+    def do_CLOSE(self, tag, arguments):
+        self.selected = False
+        self.send(f"{tag} OK CLOSE completed")
+
+    def _messages(self, message_set:str, by_uid:bool)->list:
+        """[(sequence number, message)] matching message_set, in sequence order"""
+        with self.mailbox.condition:
+            messages = list(enumerate(self.mailbox.messages, 1))
+        if not messages:
+            return []
+        if by_uid:
+            numbers = _parse_set(message_set, messages[-1][1]["uid"])
+            return [(seq, message) for seq, message in messages if message["uid"] in numbers]
+        numbers = _parse_set(message_set, len(messages))
+        return [(seq, message) for seq, message in messages if seq in numbers]
+
+    def _search(self, tag, arguments, by_uid):
+        criteria = arguments.upper().split()
+        if criteria and criteria[0] == "CHARSET":
+            criteria = criteria[2:]
+        with self.mailbox.condition:
+            matched = list(enumerate(self.mailbox.messages, 1))
+        i = 0
+        while i < len(criteria):
+            criterion = criteria[i]
+            if criterion == "ALL":
+                pass
+            elif criterion in ("UNSEEN", "SEEN"):
+                matched = [(seq, message) for seq, message in matched if ("\\Seen" in message["flags"]) == (criterion == "SEEN")]
+            elif criterion == "UID":
+                i += 1
+                allowed = set(message["uid"] for _, message in self._messages(criteria[i], True))
+                matched = [(seq, message) for seq, message in matched if message["uid"] in allowed]
+            elif re.fullmatch(r"[\d:*,]+", criterion):
+                allowed = set(seq for seq, _ in self._messages(criterion, False))
+                matched = [(seq, message) for seq, message in matched if seq in allowed]
+            else:
+                raise ValueError(f"unsupported search criterion {criterion}")
+            i += 1
+        self.send("* SEARCH" + "".join(f" {message['uid'] if by_uid else seq}" for seq, message in matched))
+        self.send(f"{tag} OK SEARCH completed")
+
+    def do_SEARCH(self, tag, arguments):
+        self._search(tag, arguments, False)
+
+    def do_UID_SEARCH(self, tag, arguments):
+        self._search(tag, arguments, True)
+
+    def _fetch(self, tag, arguments, by_uid):
+        message_set, _, items = arguments.partition(" ")
+        items = re.findall(r"BODY(?:\.PEEK)?\[[^\]]*\]|[A-Z0-9.]+", items.upper())
+        if by_uid and "UID" not in items:
+            items.insert(0, "UID")
+        for seq, message in self._messages(message_set, by_uid):
+            response = [f"* {seq} FETCH (".encode()]
+            values = []
+            for item in items:
+                if item == "UID":
+                    values.append(f"UID {message['uid']}".encode())
+                elif item == "FLAGS":
+                    values.append(f"FLAGS ({' '.join(sorted(message['flags']))})".encode())
+                elif item == "RFC822.SIZE":
+                    values.append(f"RFC822.SIZE {len(message['raw'])}".encode())
+                elif item == "BODYSTRUCTURE":
+                    values.append(f"BODYSTRUCTURE {bodystructure(message['message'])}".encode())
+                elif item in ("RFC822", "RFC822.HEADER") or item.startswith("BODY"):
+                    section = {"RFC822": "", "RFC822.HEADER": "HEADER"}.get(item, item[item.find("[") + 1:-1])
+                    if not item.startswith("BODY.PEEK") and item != "RFC822.HEADER" and not self.readonly:
+                        message["flags"].add("\\Seen")
+                    data = _section(message, section)
+                    name = item.replace(".PEEK", "")
+                    values.append(f"{name} {{{len(data)}}}\r\n".encode() + data)
+            response.append(b" ".join(values))
+            response.append(b")")
+            self.send(b"".join(response))
+        self.send(f"{tag} OK FETCH completed")
+
+    def do_FETCH(self, tag, arguments):
+        self._fetch(tag, arguments, False)
+
+    def do_UID_FETCH(self, tag, arguments):
+        self._fetch(tag, arguments, True)
+
+    def _store(self, tag, arguments, by_uid):
+        if self.readonly:
+            self.send(f"{tag} NO mailbox is read-only")
+            return
+        message_set, action, flags = arguments.split(" ", 2)
+        flags = set(flags.strip("()").split())
+        action = action.upper()
+        for seq, message in self._messages(message_set, by_uid):
+            if action.startswith("+"):
+                message["flags"] |= flags
+            elif action.startswith("-"):
+                message["flags"] -= flags
+            else:
+                message["flags"] = set(flags)
+            if not action.endswith(".SILENT"):
+                uid = f"UID {message['uid']} " if by_uid else ""
+                self.send(f"* {seq} FETCH ({uid}FLAGS ({' '.join(sorted(message['flags']))}))")
+        self.send(f"{tag} OK STORE completed")
+
+    def do_STORE(self, tag, arguments):
+        self._store(tag, arguments, False)
+
+    def do_UID_STORE(self, tag, arguments):
+        self._store(tag, arguments, True)
+
+    def do_IDLE(self, tag, arguments):
+        self.send("+ idling")
+        while True:
+            self._report_exists()
+            # wait for DONE from client or new email
+            readable, _, _ = select.select([self.connection], [], [], 0.05)
+            if readable:
+                line = self.rfile.readline()
+                if not line:
+                    return False
+                if line.strip().upper() == b"DONE":
+                    break
+            with self.mailbox.condition:
+                if len(self.mailbox.messages) == self.known_exists:
+                    self.mailbox.condition.wait(0.05)
+        self.send(f"{tag} OK IDLE terminated")
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """ IMAP4rev1 server over a Mailbox, supports the commands EmailManager use:
+    CAPABILITY LOGIN LOGOUT NOOP SELECT EXAMINE STATUS CLOSE IDLE, SEARCH/FETCH/STORE with and without UID
+    SEARCH supports ALL, SEEN, UNSEEN, UID set and sequence set
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox:Mailbox=None, latency:float=0.0, host:str="127.0.0.1", port:int=0):
+        """@param `mailbox:Mailbox` mailbox to serve, new empty one if None
+        @param `latency:float` seconds to wait before answering each command
+        @param `port:int` 0 to pick a free port
+        """
+        super().__init__((host, port), _IMAPHandler)
+        self.mailbox = mailbox if mailbox is not None else Mailbox()
+        self.latency = latency
+        self.commands = [] # every command received, in order, to count round trips
+        self._thread = None
+
+    @property
+    def config(self)->dict:
+        """@return `:dict` HANDLER_IMAP for EmailManager"""
+        return {"host": self.server_address[0], "port": self.server_address[1], "ssl": False}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-imap", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """One smtp connection"""
+    def send(self, line:str):
+        time.sleep(self.server.latency)
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.send("220 fake smtp ready")
+        mail_from, recipients = None, []
+        while line := self.rfile.readline():
+            command = line.rstrip(b"\r\n").decode("utf-8", "replace")
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.wfile.write(b"250-fake\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n")
+                self.send("250 SMTPUTF8")
+            elif verb == "HELO":
+                self.send("250 fake")
+            elif verb == "AUTH":
+                arguments = command.split()
+                if arguments[1].upper() == "LOGIN":
+                    # base64 "Username:" prompt unless sent with command, then "Password:"
+                    prompts = ["UGFzc3dvcmQ6"] if len(arguments) > 2 else ["VXNlcm5hbWU6", "UGFzc3dvcmQ6"]
+                    for prompt in prompts:
+                        self.send(f"334 {prompt}")
+                        self.rfile.readline()
+                self.send("235 authenticated")
+            elif verb == "MAIL":
+                mail_from, recipients = command[10:].strip(), []
+                self.send("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command[8:].strip())
+                self.send("250 OK")
+            elif verb == "DATA":
+                self.send("354 end data with <CR><LF>.<CR><LF>")
+                data = []
+                while (data_line := self.rfile.readline()) not in (b".\r\n", b".\n", b""):
+                    data.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                self.server.deliver(mail_from, recipients, b"".join(data))
+                self.send("250 OK queued")
+            elif verb in ("RSET", "NOOP"):
+                mail_from, recipients = None, []
+                self.send("250 OK")
+            elif verb == "QUIT":
+                self.send("221 bye")
+                return
+            else:
+                self.send("502 command not implemented")
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """ SMTP sink, accepts any login and keeps every email sent
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency:float=0.0, host:str="127.0.0.1", port:int=0, on_message=None):
+        """@param `latency:float` seconds to wait before answering each command
+        @param `on_message:function` called as on_message(mail_from, recipients, data:bytes) for each email received, optional
+        """
+        super().__init__((host, port), _SMTPHandler)
+        self.latency = latency
+        self.on_message = on_message
+        self.messages = [] # [(time.monotonic(), mail_from, recipients, data)]
+        self.received = threading.Condition()
+        self._thread = None
+
+    def deliver(self, mail_from:str, recipients:list, data:bytes):
+        with self.received:
+            self.messages.append((time.monotonic(), mail_from, recipients, data))
+            self.received.notify_all()
+        if self.on_message:
+            self.on_message(mail_from, recipients, data)
+
+    def wait_for(self, count:int, timeout:float)->bool:
+        """Block until count emails are received
+        @return `:bool` True if received before timeout
+        """
+        with self.received:
+            return self.received.wait_for(lambda: len(self.messages) >= count, timeout)
+
+    @property
+    def config(self)->dict:
+        """@return `:dict` HANDLER_SMTP for EmailManager"""
+        return {"host": self.server_address[0], "port": self.server_address[1], "ssl": False}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-smtp", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    """Answer every request with json, /chat/completions and /completions answer like the openai api"""
+    def _answer(self):
+        time.sleep(self.server.latency)
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        if self.path.endswith("/chat/completions"):
+            body = {"id": "stub", "object": "chat.completion", "model": "stub", "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "stub answer"}}]}
+        elif self.path.endswith("/completions"):
+            body = {"id": "stub", "object": "text_completion", "model": "stub", "choices": [{"index": 0, "finish_reason": "stop", "text": "stub answer"}]}
+        else:
+            body = {"method": self.command, "path": self.path}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _answer
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    """ HTTP stub for REQUEST and GPT tasks
+    """
+    daemon_threads = True
+
+    def __init__(self, latency:float=0.0, host:str="127.0.0.1", port:int=0):
+        super().__init__((host, port), _HTTPHandler)
+        self.latency = latency
+        self._thread = None
+
+    @property
+    def url(self)->str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-http", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,163 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import tempfile
+import argparse
+import threading
+from email.mime.text import MIMEText
+from email.utils import formatdate
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "emalia_src"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from fake_servers import Mailbox, FakeIMAPServer, FakeSMTPServer, FakeHTTPServer
+"""End to end load test of Emalia.main_loop against local stand-in servers
+Seed command emails into a fake imap mailbox, run Emalia, and time each reply arriving at the fake smtp sink
+Example: python load_test.py --emails 500 --imap-latency 0.05 --smtp-latency 0.02 --json result.json
+"""
+
+def percentile(values:list, percent:float)->float:
+    """Nearest rank percentile
+    @param `values:list of float` samples, not empty
+    @param `percent:float` 0 to 100
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+def new_command_email(index:int, kind:str, read_path:str, http_url:str)->MIMEText:
+    """Create the command email number index
+    @param `kind:str` "read", "request" or "gpt"
+    @return `:MIMEText` email from <user{index}@bench.local>, reply to it identify the request
+    """
+    bodies = {
+        "read": f"read [] {read_path}",
+        "request": f"request [] {http_url}/item/{index} [] GET [] {{}} [] {{}}",
+        "gpt": f"gpt [] say hello to user {index}",
+    }
+    command_email = MIMEText(bodies[kind])
+    command_email["From"] = f"User {index} <user{index}@bench.local>"
+    command_email["To"] = "emalia@bench.local"
+    command_email["Subject"] = f"bench {kind} {index}"
+    command_email["Message-ID"] = f"<{index}.{kind}@bench.local>"
+    command_email["Date"] = formatdate()
+    return command_email
+
+def run(emails:int=200, mix:dict={"read": 1, "request": 1, "gpt": 1}, rate:float=0.0, imap_latency:float=0.0, smtp_latency:float=0.0,
+        http_latency:float=0.0, wait_mode:str="idle", scan_interval:float=0.05, timeout:float=300.0)->dict:
+    """Run one load test
+    @param `emails:int` number of command emails to seed
+    @param `mix:dict` {kind: weight}, kinds are "read", "request", "gpt"
+    @param `rate:float` emails seeded per second, <=0 to seed all before start
+    @param `imap_latency:float` seconds added to every imap response
+    @param `smtp_latency:float` seconds added to every smtp response
+    @param `http_latency:float` seconds added to every http and gpt stub response
+    @param `wait_mode:str` main_loop wait_mode, "idle" or "poll"
+    @param `scan_interval:float` main_loop scan_interval
+    @param `timeout:float` max seconds to wait for all replies
+    @return `:dict` {"emails", "replied", "elapsed", "emails_per_second", "latency_p50", "latency_p95", "latency_p99", "imap_commands", ...} latencies in seconds
+    """
+    import Emalia
+    import gpt_request
+    work_path = tempfile.mkdtemp(prefix="emalia-bench-")
+    read_path = os.path.join(work_path, "files", "report.txt")
+    os.makedirs(os.path.dirname(read_path))
+    with open(read_path, "w") as f:
+        f.write("benchmark file\n" * 100)
+    setting_location = os.path.join(work_path, "emalia_setting.json")
+    with open(setting_location, "w") as f:
+        json.dump({}, f)
+
+    mailbox = Mailbox()
+    imap_server = FakeIMAPServer(mailbox, latency=imap_latency).start()
+    smtp_server = FakeSMTPServer(latency=smtp_latency).start()
+    http_server = FakeHTTPServer(latency=http_latency).start()
+    # gpt task talk to the http stub instead of openai
+    gpt_request.openai.api_base = http_server.url
+    BenchEmalia = type("BenchEmalia", (Emalia.Emalia,), {"_save_path": work_path, "_file_roots": work_path, "_GPT_API_KEY": "bench"})
+    logger = logging.Logger("emalia-bench", level=logging.WARNING)
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    emalia = BenchEmalia(permission="full", setting_location=setting_location, HANDLER_EMAIL="emalia@bench.local", HANDLER_PASSWORD="bench",
+        HANDLER_SMTP=smtp_server.config, HANDLER_IMAP=imap_server.config, logger=logger)
+
+    # command kinds in proportion to mix weights
+    kinds = [kind for kind, weight in mix.items() for _ in range(weight)]
+    seeded = {}
+    def seed():
+        for index in range(emails):
+            command_email = new_command_email(index, kinds[index % len(kinds)], read_path, http_server.url)
+            seeded[index] = time.monotonic()
+            mailbox.append(command_email)
+            if rate > 0:
+                time.sleep(1 / rate)
+    if rate <= 0:
+        seed()
+    seeder = threading.Thread(target=seed, daemon=True) if rate > 0 else None
+
+    loop = threading.Thread(target=emalia.main_loop, kwargs={"scan_interval": scan_interval, "wait_mode": wait_mode}, daemon=True)
+    start_time = time.monotonic()
+    loop.start()
+    if seeder:
+        seeder.start()
+    smtp_server.wait_for(emails, timeout)
+    end_time = time.monotonic()
+    emalia.break_loop()
+    loop.join(scan_interval + 5)
+
+    # match each reply to its command by receiver
+    latencies = {}
+    for delivered, _, recipients, _ in list(smtp_server.messages):
+        for recipient in recipients:
+            match = re.search(r"user(\d+)@bench\.local", recipient)
+            if match and int(match.group(1)) in seeded and int(match.group(1)) not in latencies:
+                latencies[int(match.group(1))] = delivered - seeded[int(match.group(1))]
+    values = list(latencies.values()) or [float("nan")]
+    elapsed = (max(delivered for delivered, *_ in smtp_server.messages) if smtp_server.messages else end_time) - start_time
+    result = {
+        "emails": emails,
+        "replied": len(latencies),
+        "elapsed": elapsed,
+        "emails_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "latency_p50": percentile(values, 50),
+        "latency_p95": percentile(values, 95),
+        "latency_p99": percentile(values, 99),
+        "imap_commands": len(imap_server.commands),
+        "smtp_messages": len(smtp_server.messages),
+        "settings": {"mix": mix, "rate": rate, "imap_latency": imap_latency, "smtp_latency": smtp_latency, "http_latency": http_latency, "wait_mode": wait_mode, "scan_interval": scan_interval}
+    }
+    for server in (imap_server, smtp_server, http_server):
+        server.stop()
+    emalia.email_handler.close()
+    return result
+
+def _parse_mix(text:str)->dict:
+    """"read=2,gpt=1" -> {"read": 2, "gpt": 1}"""
+    mix = {}
+    for item in text.split(","):
+        kind, _, weight = item.partition("=")
+        if kind.strip() not in ("read", "request", "gpt"):
+            raise argparse.ArgumentTypeError(f"Unknown email kind {kind}")
+        mix[kind.strip()] = int(weight or 1)
+    return mix
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End to end load test of Emalia.main_loop with local imap, smtp and http stand-in servers")
+    parser.add_argument("--emails", type=int, default=200, help="number of command emails")
+    parser.add_argument("--mix", type=_parse_mix, default={"read": 1, "request": 1, "gpt": 1}, help="kind weights, example read=2,request=1,gpt=1")
+    parser.add_argument("--rate", type=float, default=0.0, help="emails delivered per second, 0 to deliver all before start")
+    parser.add_argument("--imap-latency", type=float, default=0.0, help="seconds added to every imap response")
+    parser.add_argument("--smtp-latency", type=float, default=0.0, help="seconds added to every smtp response")
+    parser.add_argument("--http-latency", type=float, default=0.0, help="seconds added to every http/gpt stub response")
+    parser.add_argument("--wait-mode", choices=["idle", "poll"], default="idle")
+    parser.add_argument("--scan-interval", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=300.0, help="max seconds to wait for all replies")
+    parser.add_argument("--json", default="", help="also write result to this json file")
+    arguments = parser.parse_args()
+    result = run(arguments.emails, arguments.mix, arguments.rate, arguments.imap_latency, arguments.smtp_latency, arguments.http_latency,
+        arguments.wait_mode, arguments.scan_interval, arguments.timeout)
+    print(f"replied {result['replied']}/{result['emails']} in {result['elapsed']:.2f}s, {result['emails_per_second']:.1f} emails/s")
+    print(f"latency p50 {result['latency_p50'] * 1000:.0f}ms, p95 {result['latency_p95'] * 1000:.0f}ms, p99 {result['latency_p99'] * 1000:.0f}ms")
+    print(f"imap commands {result['imap_commands']}")
+    if arguments.json:
+        with open(arguments.json, "w") as f:
+            json.dump(result, f, indent=2)
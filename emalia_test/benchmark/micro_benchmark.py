@@ -0,0 +1,231 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import statistics
+from contextlib import contextmanager
+from email import message_from_bytes
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "emalia_src"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import FileManager
+import CommandParser
+import Emalia
+from EmailManager import EmailManager
+from fake_servers import FakeIMAPServer, FakeSMTPServer
+"""Micro benchmarks of parsing and file search hot paths, results are saved as json and compared to a baseline
+Example:
+    python micro_benchmark.py run --output result.json
+    python micro_benchmark.py compare baseline.json result.json
+"""
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+def measure(function, min_time:float=0.2, rounds:int=5)->dict:
+    """Time function, each round call it number times so one round take about min_time / rounds
+    @param `function:callable` function without argument
+    @param `min_time:float` approximate total seconds to spend
+    @param `rounds:int` number of rounds, median of rounds is reported
+    @return `:dict` {"median": float, "min": float, "rounds": int, "number": int} seconds per call
+    """
+    def timed(number):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        return time.perf_counter() - start
+    number = 1
+    elapsed = timed(number)
+    # calibrate so one round is long enough to time
+    while elapsed < min_time / rounds and number < 1000000:
+        number = min(1000000, max(number * 2, int(number * (min_time / rounds) / max(elapsed, 1e-9))))
+        elapsed = timed(number)
+    times = [elapsed / number] + [timed(number) / number for _ in range(rounds - 1)]
+    return {"median": statistics.median(times), "min": min(times), "rounds": rounds, "number": number}
+
+def email_corpus()->dict:
+    """Synthetic emails parsed by parse_email, parsed from bytes in each call like fetched emails
+    @return `:dict` {name: bytes}
+    """
+    corpus = {}
+    plain = MIMEText("read [] report.txt\n\nthanks\n")
+    plain["From"], plain["Subject"], plain["Message-ID"] = "User <user@bench.local>", "plain", "<plain@bench.local>"
+    corpus["plain"] = plain.as_bytes()
+    html = MIMEMultipart("alternative")
+    html["From"], html["Subject"], html["Message-ID"] = "User <user@bench.local>", "html", "<html@bench.local>"
+    html.attach(MIMEText("gpt [] summarize this\n", "plain"))
+    html.attach(MIMEText("<html><body>" + "<p>gpt [] summarize this</p>" * 200 + "</body></html>", "html"))
+    corpus["html"] = html.as_bytes()
+    attachments = MIMEMultipart()
+    attachments["From"], attachments["Subject"], attachments["Message-ID"] = "User <user@bench.local>", "attachments", "<attachments@bench.local>"
+    attachments.attach(MIMEText("write [] files\n", "plain"))
+    for i in range(50):
+        attachment = MIMEApplication(os.urandom(16 * 1024), Name=f"file_{i}.bin")
+        attachment["Content-Disposition"] = f'attachment; filename="file_{i}.bin"'
+        attachments.attach(attachment)
+    corpus["many_attachments"] = attachments.as_bytes()
+    large = MIMEText("gpt [] " + "lorem ipsum dolor sit amet " * 200000)
+    large["From"], large["Subject"], large["Message-ID"] = "User <user@bench.local>", "large", "<large@bench.local>"
+    corpus["large_body"] = large.as_bytes()
+    return corpus
+
+def make_tree(root:str, file_count:int)->str:
+    """Create (or reuse) a tree of empty files, 100 files per directory and 100 directories per group
+    @param `root:str` directory to create the tree in
+    @param `file_count:int` number of files
+    @return `:str` path of the tree, contains one unique file "target_file.txt" at the deepest level
+    """
+    tree_path = os.path.join(root, f"tree_{file_count}")
+    done_marker = os.path.join(tree_path, ".complete")
+    if os.path.exists(done_marker):
+        return tree_path
+    shutil.rmtree(tree_path, ignore_errors=True)
+    for i in range(file_count):
+        directory = os.path.join(tree_path, f"group_{i // 10000}", f"dir_{i // 100}")
+        if i % 100 == 0:
+            os.makedirs(directory, exist_ok=True)
+        open(os.path.join(directory, f"file_{i}.txt"), "w").close()
+    open(os.path.join(directory, "target_file.txt"), "w").close()
+    open(done_marker, "w").close()
+    return tree_path
+
+@contextmanager
+def bench_objects(work_path:str):
+    """[context manager] EmailManager and Emalia built by their constructors against local stand-in servers, so benchmarks run the code users run
+    @param `work_path:str` directory for attachments and Emalia state
+    @return `:tuple of len=2` (EmailManager, Emalia), servers are stopped on exit
+    """
+    setting_location = os.path.join(work_path, "emalia_setting.json")
+    with open(setting_location, "w") as f:
+        json.dump({}, f)
+    imap_server = FakeIMAPServer().start()
+    smtp_server = FakeSMTPServer().start()
+    try:
+        email_manager = EmailManager(attachment_path=work_path, HANDLER_EMAIL="emalia@bench.local", HANDLER_PASSWORD="bench",
+            HANDLER_SMTP=smtp_server.config, HANDLER_IMAP=imap_server.config)
+        BenchEmalia = type("BenchEmalia", (Emalia.Emalia,), {"_save_path": work_path, "_file_roots": work_path})
+        emalia = BenchEmalia(permission="full", setting_location=setting_location, HANDLER_EMAIL="emalia@bench.local", HANDLER_PASSWORD="bench",
+            HANDLER_SMTP=smtp_server.config, HANDLER_IMAP=imap_server.config)
+        try:
+            yield email_manager, emalia
+        finally:
+            email_manager.close()
+            emalia.email_handler.close()
+            emalia.history.close()
+    finally:
+        imap_server.stop()
+        smtp_server.stop()
+
+def collect(work_path:str, tree_sizes:list, email_manager:EmailManager, emalia:Emalia.Emalia)->dict:
+    """Build every benchmark
+    @param `work_path:str` directory for generated files
+    @param `tree_sizes:list of int` file counts of generated trees for file search benchmarks
+    @param `email_manager:EmailManager` parses the email corpus, from bench_objects
+    @param `emalia:Emalia` parses command bodies, from bench_objects
+    @return `:dict` {name: callable}
+    """
+    benchmarks = {}
+    command_bodies = {
+        "short": "read [] report.txt",
+        "options": "gpt <temperature:0.5> <max_tokens:100> [context] summarize [notes] " + "word " * 50,
+        "long": "request [] http://localhost/ [] GET [] {} [] " + "[a] <b> text \\[escaped\\] " * 500,
+        "prompt": "gpt [] " + "lorem ipsum dolor sit amet " * 20000,
+    }
+    for name, body in command_bodies.items():
+        benchmarks[f"parse_command.{name}"] = lambda body=body: CommandParser.parse_command(body)
+        benchmarks[f"parse_email_part.{name}"] = lambda body=body: emalia._parse_email_part(body)
+    # email parsing, attachments written under work_path
+    for name, raw_email in email_corpus().items():
+        benchmarks[f"parse_email.{name}"] = lambda raw_email=raw_email: email_manager.parse_email(message_from_bytes(raw_email))
+    # file search
+    for file_count in tree_sizes:
+        tree_path = make_tree(work_path, file_count)
+        benchmarks[f"search_all.{file_count}"] = lambda tree_path=tree_path: FileManager.search_all("target_file", tree_path)
+        benchmarks[f"search_exact.{file_count}"] = lambda tree_path=tree_path: FileManager.search_exact("target_file.txt", tree_path)
+    # path range check
+    base_path = os.path.join(work_path, "range", "a", "b")
+    os.makedirs(os.path.join(base_path, "c", "d"), exist_ok=True)
+    range_paths = [os.path.join(base_path, "c", "d", "file.txt"), os.path.join(base_path, "file.txt"), os.path.join(work_path, "range", "other.txt")]
+    benchmarks["check_path_in_range"] = lambda: [FileManager.check_path_in_range(path, base_path, 2) for path in range_paths]
+    return benchmarks
+
+def run(name_filter:str="", tree_sizes:list=[10000], work_path:str="", min_time:float=0.2, rounds:int=5)->dict:
+    """Run benchmarks
+    @param `name_filter:str` regex, only run benchmarks with matching name, "" for all
+    @param `tree_sizes:list of int` file counts of generated trees
+    @param `work_path:str` directory for generated files, kept so large trees are generated once, temp directory if ""
+    @return `:dict` {"meta": dict, "results": {name: measure() result}}
+    """
+    temporary = not work_path
+    work_path = work_path or tempfile.mkdtemp(prefix="emalia-micro-")
+    os.makedirs(work_path, exist_ok=True)
+    try:
+        results = {}
+        with bench_objects(work_path) as (email_manager, emalia):
+            for name, function in collect(work_path, tree_sizes, email_manager, emalia).items():
+                if name_filter and not re.search(name_filter, name):
+                    continue
+                results[name] = measure(function, min_time, rounds)
+                print(f"{name:<32} {results[name]['median'] * 1e6:>14.1f} us", file=sys.stderr)
+    finally:
+        if temporary:
+            shutil.rmtree(work_path, ignore_errors=True)
+    meta = {"python": platform.python_version(), "platform": platform.platform(), "machine": platform.machine(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    return {"meta": meta, "results": results}
+
+def compare(baseline:dict, current:dict, threshold:float=0.3)->list:
+    """Compare best round times of two runs, min is less affected by machine noise than median
+    @param `threshold:float` a benchmark is a regression if slower than baseline by more than this ratio
+    @return `:list of tuple` [(name, baseline seconds, current seconds, ratio, regressed:bool)] for benchmarks in both runs
+    Benchmarks only in one run are ignored
+    """
+    rows = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        baseline_time = baseline["results"][name]["min"]
+        ratio = result["min"] / baseline_time if baseline_time > 0 else float("inf")
+        rows.append((name, baseline_time, result["min"], ratio, ratio > 1 + threshold))
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro benchmarks of parsing and file search hot paths")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="run benchmarks and write json")
+    run_parser.add_argument("--filter", default="", help="regex of benchmark names to run")
+    run_parser.add_argument("--tree-sizes", default="10000", help="comma separated file counts of generated trees, example 10000,100000,1000000")
+    run_parser.add_argument("--work-path", default="", help="keep generated trees here to reuse them in later runs")
+    run_parser.add_argument("--min-time", type=float, default=0.2, help="approximate seconds per benchmark")
+    run_parser.add_argument("--rounds", type=int, default=5)
+    run_parser.add_argument("--output", default="", help="json file to write, stdout if empty")
+    compare_parser = subparsers.add_parser("compare", help="compare a run to the baseline, exit 1 on regression")
+    compare_parser.add_argument("baseline", nargs="?", default=BASELINE_PATH, help="baseline json, default the committed baseline.json")
+    compare_parser.add_argument("current", help="json written by run")
+    compare_parser.add_argument("--threshold", type=float, default=0.3, help="allowed slowdown ratio before flagging, 0.3 = 30%% slower")
+    arguments = parser.parse_args()
+    if arguments.command == "run":
+        result = run(arguments.filter, [int(size) for size in arguments.tree_sizes.split(",") if size], arguments.work_path, arguments.min_time, arguments.rounds)
+        if arguments.output:
+            with open(arguments.output, "w") as f:
+                json.dump(result, f, indent=2)
+        else:
+            print(json.dumps(result, indent=2))
+    else:
+        with open(arguments.baseline, "r") as f:
+            baseline = json.load(f)
+        with open(arguments.current, "r") as f:
+            current = json.load(f)
+        rows = compare(baseline, current, arguments.threshold)
+        for name, baseline_time, current_time, ratio, regressed in rows:
+            print(f"{name:<32} {baseline_time * 1e6:>14.1f} us {current_time * 1e6:>14.1f} us {ratio:>7.2f}x {'REGRESSION' if regressed else ''}")
+        # new benchmarks are not compared until the baseline is recorded again
+        for name in current["results"]:
+            if name not in baseline["results"]:
+                print(f"{name:<32} not in baseline, run again with --output {arguments.baseline}", file=sys.stderr)
+        sys.exit(1 if any(regressed for *_, regressed in rows) else 0)
@@ -0,0 +1,31 @@
+import os
+import pytest
+import sys
+from io import BytesIO
+sys.path.append(f"{__file__}/../../../emalia_src")
+import ArchiveCache
+
+def test_ArchiveCache_get_put(tmp_path):
+    cache = ArchiveCache.ArchiveCache(tmp_path / "cache")
+    assert cache.get("abc") is None
+    archive = BytesIO(b"zip data")
+    cache.put("abc", archive, {"entries": 1, "compressed_size": 8, "uncompressed_size": 10})
+    assert archive.tell() == 0
+    cached_archive, info = cache.get("abc")
+    with cached_archive:
+        assert cached_archive.read() == b"zip data"
+    assert info["entries"] == 1
+
+def test_ArchiveCache_evict_lru(tmp_path):
+    cache = ArchiveCache.ArchiveCache(tmp_path / "cache", max_size=20)
+    cache.put("old", BytesIO(b"0" * 10), {})
+    cache.put("used", BytesIO(b"1" * 10), {})
+    os.utime(tmp_path / "cache" / "old.zip", (1, 1))
+    os.utime(tmp_path / "cache" / "used.zip", (2, 2))
+    # hit refresh last access
+    cache.get("used")[0].close()
+    cache.put("new", BytesIO(b"2" * 10), {})
+    assert cache.get("old") is None
+    for signature in ("used", "new"):
+        archive, _ = cache.get(signature)
+        archive.close()
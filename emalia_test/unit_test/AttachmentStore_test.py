@@ -0,0 +1,79 @@
+import os
+import pytest
+import sys
+sys.path.append(f"{__file__}/../../../emalia_src")
+import AttachmentStore
+
+def add_bytes(store, data, name=""):
+    with store.temp_file() as temp_file:
+        temp_file.write(data)
+    return store.add_file(temp_file.name, name=name)
+
+def test_AttachmentStore_deduplicate(tmp_path):
+    store = AttachmentStore.AttachmentStore(tmp_path / "store")
+    sha256 = add_bytes(store, b"same data", "a.txt")
+    assert add_bytes(store, b"same data", "b.txt") == sha256
+    assert store.total_size() == len(b"same data")
+    assert store._index[sha256]["refcount"] == 2
+    assert store._index[sha256]["names"] == ["a.txt", "b.txt"]
+    assert os.path.exists(store.object_path(sha256))
+    # no temp file left
+    assert os.listdir(tmp_path / "store" / "tmp") == []
+    # index survive reopen
+    assert AttachmentStore.AttachmentStore(tmp_path / "store")._index == store._index
+
+def test_AttachmentStore_copy_not_overwritten(tmp_path):
+    store = AttachmentStore.AttachmentStore(tmp_path / "store")
+    first = add_bytes(store, b"first")
+    second = add_bytes(store, b"second")
+    store.copy(first, tmp_path / "file.txt")
+    store.copy(second, tmp_path / "file.txt")
+    assert open(tmp_path / "file.txt", "rb").read() == b"second"
+    assert open(store.object_path(first), "rb").read() == b"first"
+    # editing a copy in place never change the stored file
+    with open(tmp_path / "file.txt", "r+b") as f:
+        f.write(b"edited")
+    assert open(store.object_path(second), "rb").read() == b"second"
+
+def test_AttachmentStore_link(tmp_path):
+    store = AttachmentStore.AttachmentStore(tmp_path / "store")
+    sha256 = add_bytes(store, b"data")
+    store.link(sha256, tmp_path / "a.bin")
+    store.link(sha256, tmp_path / "b.bin")
+    # same file, no data written, read only
+    assert os.path.samefile(tmp_path / "a.bin", store.object_path(sha256))
+    assert os.path.samefile(tmp_path / "b.bin", store.object_path(sha256))
+    assert not os.stat(tmp_path / "a.bin").st_mode & 0o222
+    store.unlink(tmp_path / "a.bin")
+    assert not os.path.exists(tmp_path / "a.bin") and open(store.object_path(sha256), "rb").read() == b"data"
+
+def test_AttachmentStore_log_replay(tmp_path):
+    store = AttachmentStore.AttachmentStore(tmp_path / "store")
+    index_json = open(tmp_path / "store" / "index.json").read()
+    sha256 = add_bytes(store, b"data", "a.txt")
+    store.add_reference(sha256, "b.txt")
+    store.release(sha256)
+    # changes are appended, index.json is not rewritten
+    assert open(tmp_path / "store" / "index.json").read() == index_json
+    assert len(open(tmp_path / "store" / "index.log").readlines()) == 3
+    reopened = AttachmentStore.AttachmentStore(tmp_path / "store")
+    assert reopened._index == store._index and reopened._index[sha256]["refcount"] == 1
+    assert open(tmp_path / "store" / "index.log").read() == ""
+
+def test_AttachmentStore_gc_lru(tmp_path):
+    store = AttachmentStore.AttachmentStore(tmp_path / "store", max_size=10)
+    old = add_bytes(store, b"12345")
+    store.release(old)
+    kept = add_bytes(store, b"abcde")
+    store.copy(kept, tmp_path / "kept")
+    # over size, unreferenced and least recently used file removed
+    new = add_bytes(store, b"ABCDE")
+    assert old not in store
+    assert kept in store and new in store
+    assert store.total_size() == 10
+    # copy stay valid after removal
+    linked = tmp_path / "linked"
+    store.copy(new, linked)
+    store.max_size = 0
+    store.gc()
+    assert open(linked, "rb").read() == b"ABCDE"
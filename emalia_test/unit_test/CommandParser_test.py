@@ -0,0 +1,25 @@
+import pytest
+import sys
+sys.path.append(f"{__file__}/../../../emalia_src")
+import CommandParser
+
+@pytest.mark.parametrize("body, expected", [
+    ("read [] report.txt", (["read", "report.txt"], [], [], "read")),
+    ("GPT <temperature:0.5> <max_tokens:100> [context] summarize [notes] more", (["GPT", "summarize", "more"], ["context", "notes"], ["temperature:0.5", "max_tokens:100"], "gpt")),
+    ("request [] http://a/b?c=1 [] GET [] {} [] {\"a\": 1}", (["request", "http://a/b?c=1", "GET", "{}", "{\"a\": 1}"], [], [], "request")),
+    ("? help", (["? help"], [], [], "")),
+    ("", ([], [], [], "")),
+    # escaped brackets are kept as written and do not pair
+    ("python \\<123\\> [x]", (["python \\<123\\>"], ["x"], [], "python")),
+    # <> inside [] belong to the option, unpaired brackets are text
+    ("custom [a <b> c] d [e", (["custom", "d [e"], ["a <b> c"], [], "custom")),
+])
+def test_parse_command(body, expected):
+    parsed = CommandParser.parse_command(body)
+    assert tuple(parsed) == expected
+    assert parsed.raw is parsed[0] and parsed.command == expected[3]
+
+def test_parse_command_long_body():
+    body = "gpt [] " + "word <a> [b] " * 10000
+    parsed = CommandParser.parse_command(body)
+    assert len(parsed.raw) == 10001 and len(parsed.square) == 10000 and len(parsed.sharp) == 10000
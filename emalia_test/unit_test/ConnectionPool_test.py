@@ -0,0 +1,147 @@
+import pytest
+import sys
+from unittest import mock
+sys.path.append(f"{__file__}/../../../emalia_src")
+import ConnectionPool
+import imaplib
+import smtplib
+
+def new_mock_imap():
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    mock_imap_value.login.return_value = ("OK", [b"Logged in"])
+    mock_imap_value.select.return_value = ("OK", [b"3"])
+    mock_imap_value.response.return_value = ("UIDVALIDITY", [b"42"])
+    mock_imap_value.noop.return_value = ("OK", [b"NOOP completed"])
+    mock_imap_value.state = "SELECTED"
+    return mock_imap_value
+
+def test_IMAPSessionPool_reuse_session():
+    mock_imap_value = new_mock_imap()
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value) as mock_imap:
+        pool = ConnectionPool.IMAPSessionPool({"host": "imap"}, "1", "2")
+        assert pool.run(lambda session: session.uidvalidity) == 42
+        assert pool.run(lambda session: session.uidvalidity) == 42
+        # one connect, one login, one select for both calls
+        mock_imap.assert_called_once()
+        mock_imap_value.login.assert_called_once()
+        mock_imap_value.select.assert_called_once()
+        # same mode given explicitly keep the selected mailbox
+        pool.run(lambda session: None, readonly=False)
+        mock_imap_value.select.assert_called_once()
+
+def test_IMAPSessionPool_reconnect_on_abort():
+    first_imap = new_mock_imap()
+    second_imap = new_mock_imap()
+    with mock.patch("imaplib.IMAP4_SSL", side_effect=[first_imap, second_imap]) as mock_imap:
+        pool = ConnectionPool.IMAPSessionPool({"host": "imap"}, "1", "2")
+        def action(session):
+            if session.imap is first_imap:
+                raise imaplib.IMAP4.abort("BYE")
+            return "done"
+        assert pool.run(action) == "done"
+        assert mock_imap.call_count == 2
+        first_imap.logout.assert_called_once()
+
+def test_IMAPSessionPool_keepalive_drop_dead():
+    first_imap = new_mock_imap()
+    first_imap.noop.side_effect = imaplib.IMAP4.abort("socket error: EOF")
+    second_imap = new_mock_imap()
+    with mock.patch("imaplib.IMAP4_SSL", side_effect=[first_imap, second_imap]):
+        pool = ConnectionPool.IMAPSessionPool({"host": "imap"}, "1", "2", keepalive_interval=0)
+        pool.run(lambda session: None)
+        assert pool.run(lambda session: session.imap) is second_imap
+
+def test_IMAPSessionPool_noop_outside_lock():
+    mock_imap_value = new_mock_imap()
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        pool = ConnectionPool.IMAPSessionPool({"host": "imap"}, "1", "2", keepalive_interval=0)
+        def noop():
+            # other callers can use the pool while NOOP waits for the server
+            assert not pool._condition._is_owned()
+            return ("OK", [b"NOOP completed"])
+        mock_imap_value.noop.side_effect = noop
+        pool.run(lambda session: None)
+        pool.run(lambda session: None)
+        mock_imap_value.noop.assert_called_once()
+
+def test_IMAPSessionPool_keepalive():
+    first_imap = new_mock_imap()
+    first_imap.noop.return_value = ("BAD", [b"gone"])
+    with mock.patch("imaplib.IMAP4_SSL", return_value=first_imap):
+        pool = ConnectionPool.IMAPSessionPool({"host": "imap"}, "1", "2", keepalive_interval=60)
+        pool.run(lambda session: None)
+        # not idle long enough
+        pool.keepalive()
+        first_imap.noop.assert_not_called()
+        pool._idle_sessions[0].last_used -= 61
+        pool.keepalive()
+        first_imap.noop.assert_called_once()
+        assert pool._idle_sessions == [] and pool._session_count == 0
+
+def new_mock_smtp():
+    mock_smtp_value = mock.MagicMock(spec=smtplib.SMTP_SSL)
+    mock_smtp_value.login.return_value = (235, b"Accepted")
+    mock_smtp_value.send_message.return_value = {}
+    return mock_smtp_value
+
+def test_SMTPSessionPool_send_many_one_login():
+    mock_smtp_value = new_mock_smtp()
+    with mock.patch("smtplib.SMTP_SSL", return_value=mock_smtp_value) as mock_smtp:
+        pool = ConnectionPool.SMTPSessionPool({"host": "smtp"}, "1", "2")
+        results = pool.send_many(["a", "b", "c"])
+        assert [error for _, error in results] == [None, None, None]
+        mock_smtp.assert_called_once()
+        mock_smtp_value.login.assert_called_once()
+        assert mock_smtp_value.send_message.call_count == 3
+
+def test_SMTPSessionPool_relogin_on_disconnect():
+    first_smtp = new_mock_smtp()
+    first_smtp.send_message.side_effect = smtplib.SMTPServerDisconnected()
+    second_smtp = new_mock_smtp()
+    with mock.patch("smtplib.SMTP_SSL", side_effect=[first_smtp, second_smtp]) as mock_smtp:
+        pool = ConnectionPool.SMTPSessionPool({"host": "smtp"}, "1", "2")
+        pool.send("a")
+        assert mock_smtp.call_count == 2
+        second_smtp.send_message.assert_called_once_with("a")
+
+def test_SMTPSessionPool_no_resend_after_data():
+    first_smtp = new_mock_smtp()
+    def send_message(outgoing_email):
+        # connection lost waiting for the reply to the message data
+        first_smtp.data(outgoing_email)
+        raise smtplib.SMTPServerDisconnected()
+    first_smtp.send_message.side_effect = send_message
+    second_smtp = new_mock_smtp()
+    with mock.patch("smtplib.SMTP_SSL", side_effect=[first_smtp, second_smtp]) as mock_smtp:
+        pool = ConnectionPool.SMTPSessionPool({"host": "smtp"}, "1", "2")
+        results = pool.send_many(["a", "b"])
+        assert isinstance(results[0][1], ConnectionPool.DeliveryUnknownError)
+        assert results[1] == ("b", None)
+        second_smtp.send_message.assert_called_once_with("b")
+
+def test_SMTPSessionPool_reply_error_not_connection_error(tmp_path):
+    import Outbox
+    from email.message import Message
+    mock_smtp_value = new_mock_smtp()
+    replies = [smtplib.SMTPDataError(451, b"try again later"), None]
+    def send_message(outgoing_email):
+        mock_smtp_value.data(outgoing_email)
+        reply = replies.pop(0)
+        if reply is not None:
+            raise reply
+        return {}
+    mock_smtp_value.send_message.side_effect = send_message
+    with mock.patch("smtplib.SMTP_SSL", return_value=mock_smtp_value) as mock_smtp:
+        pool = ConnectionPool.SMTPSessionPool({"host": "smtp"}, "1", "2")
+        outbox = Outbox.Outbox(str(tmp_path), pool.send_many, base_delay=10)
+        outgoing_email = Message()
+        outgoing_email["To"] = "<a@b.com>"
+        outbox.enqueue(outgoing_email)
+        outbox.send_due(now=1000)
+        # temporary failure is kept for retry, session is not dropped
+        assert len(outbox.pending()) == 1 and outbox.failed() == []
+        assert mock_smtp_value.send_message.call_count == 1
+        outbox.send_due(now=2000)
+        assert outbox.pending() == [] and outbox.failed() == []
+        assert mock_smtp_value.send_message.call_count == 2
+        mock_smtp.assert_called_once()
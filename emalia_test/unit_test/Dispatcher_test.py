@@ -0,0 +1,106 @@
+import time
+import threading
+import pytest
+import sys
+sys.path.append(f"{__file__}/../../../emalia_src")
+import Dispatcher
+
+def test_Dispatcher_results_in_order_per_sender():
+    done = []
+    dispatcher = Dispatcher.Dispatcher(max_workers=4, on_done=lambda tag, result, error: done.append((tag, result)))
+    # first email of a is the slowest, its later emails must wait for it
+    for tag, order_key, delay in [("a1", "a", 0.2), ("b1", "b", 0), ("a2", "a", 0), ("a3", "a", 0.05)]:
+        dispatcher.submit(lambda delay=delay, tag=tag: time.sleep(delay) or tag.upper(), tag=tag, order_key=order_key)
+    assert dispatcher.join(5)
+    assert [tag for tag, _ in done if tag.startswith("a")] == ["a1", "a2", "a3"]
+    assert done[0] == ("b1", "B1")
+    assert dispatcher.pending() == 0
+    dispatcher.shutdown()
+    with pytest.raises(RuntimeError):
+        dispatcher.submit(print)
+
+def test_Dispatcher_limit():
+    running = {"now": 0, "max": 0}
+    lock = threading.Lock()
+    def job():
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        time.sleep(0.02)
+        with lock:
+            running["now"] -= 1
+    fast = []
+    dispatcher = Dispatcher.Dispatcher(max_workers=4, on_done=lambda tag, result, error: fast.append(tag) if tag == "fast" else None)
+    for i in range(8):
+        dispatcher.submit(job, tag=i, limit_key="slow", limit=2, order_key=str(i))
+    # waiting slow jobs do not hold threads, fast job is not behind them
+    dispatcher.submit(lambda: None, tag="fast", order_key="fast")
+    time.sleep(0.01)
+    assert fast == ["fast"]
+    dispatcher.shutdown(wait=True)
+    assert running["max"] == 2 and dispatcher.pending() == 0
+
+def test_Dispatcher_error():
+    done = []
+    dispatcher = Dispatcher.Dispatcher(on_done=lambda tag, result, error: done.append((tag, result, error)))
+    dispatcher.submit(lambda: 1 / 0, tag=1)
+    dispatcher.shutdown()
+    assert done[0][0] == 1 and isinstance(done[0][2], ZeroDivisionError)
+
+def test_Dispatcher_priority_queue():
+    import Scheduler
+    started = []
+    release = threading.Event()
+    dispatcher = Dispatcher.Dispatcher(max_workers=1, queue=Scheduler.PriorityScheduler(weights={"vip_fast": 100, "slow": 1}, max_wait=-1))
+    dispatcher.submit(release.wait, order_key="block", queue_key="slow")
+    for i in range(3):
+        dispatcher.submit(started.append, f"slow{i}", order_key="a", queue_key="slow")
+    dispatcher.submit(started.append, "vip", order_key="b", queue_key="vip_fast")
+    release.set()
+    dispatcher.shutdown(wait=True)
+    # vip email arrived last but run first once the worker is free
+    assert started[0] == "vip" and sorted(started[1:]) == ["slow0", "slow1", "slow2"]
+
+def test_Dispatcher_on_done_outside_lock(caplog):
+    entered = threading.Event()
+    release = threading.Event()
+    done = []
+    def on_done(tag, result, error):
+        if tag == "slow":
+            entered.set()
+            release.wait(5)
+        if tag == "bad":
+            raise ValueError("on_done failed")
+        done.append(tag)
+    dispatcher = Dispatcher.Dispatcher(max_workers=4, on_done=on_done)
+    dispatcher.submit(lambda: None, tag="slow", order_key="a")
+    assert entered.wait(5)
+    # on_done of a is blocked, submit and other senders are not
+    dispatcher.submit(lambda: None, tag="a2", order_key="a")
+    dispatcher.submit(lambda: None, tag="bad", order_key="b")
+    dispatcher.submit(lambda: None, tag="b2", order_key="b")
+    time.sleep(0.1)
+    assert done == ["b2"] and dispatcher.pending() == 2
+    release.set()
+    assert dispatcher.join(5)
+    assert done == ["b2", "slow", "a2"]
+    assert "Error in on_done of job bad" in caplog.text
+    dispatcher.shutdown()
+
+def test_Dispatcher_priority_with_limit():
+    import Scheduler
+    started = []
+    release = threading.Event()
+    queue = Scheduler.PriorityScheduler(weights={"vip_slow": 100, "slow": 1}, max_wait=-1)
+    dispatcher = Dispatcher.Dispatcher(max_workers=4, queue=queue)
+    dispatcher.submit(release.wait, order_key="block", limit_key="python", limit=1, queue_key="slow")
+    for i in range(3):
+        dispatcher.submit(started.append, f"slow{i}", order_key=f"a{i}", limit_key="python", limit=1, queue_key="slow")
+    dispatcher.submit(started.append, "vip", order_key="b", limit_key="python", limit=1, queue_key="vip_slow")
+    time.sleep(0.05)
+    # jobs over their limit stay in the priority queue, not served yet
+    assert started == [] and queue.statistics()["slow"]["served"] == 1 and len(queue) == 4
+    release.set()
+    dispatcher.shutdown(wait=True)
+    # vip job blocked by the same limit still go first once a slot is free
+    assert started == ["vip", "slow0", "slow1", "slow2"]
@@ -5,8 +5,18 @@ sys.path.append(f"{__file__}/../../../emalia_src")
 import EmailManager
 import smtplib
 import imaplib
+import socket
+import time
 from email.parser import BytesParser
 from email.policy import default
+from email import message_from_bytes, encoders
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+from email.mime.text import MIMEText
+from email.mime.base import MIMEBase
+import hashlib
+import AttachmentStore
+import os
 
 # TODO test reading and saving attachments
 def test_EmailManager_basic_init():
@@ -61,4 +71,312 @@ def test_EmailManager_basic_init():
             marked_email = emanager.mark_email([email_list[0][0]])
             assert marked_email == [email_list[0][0]]
             marked_email = emanager.mark_email(1)
-            assert isinstance(marked_email, list)
\ No newline at end of file
+            assert isinstance(marked_email, list)
+def new_mock_email_manager(mock_imap_value):
+    """Create EmailManager with mocked smtp, imaplib.IMAP4_SSL return mock_imap_value"""
+    mock_smtp_value = mock.MagicMock(spec=smtplib.SMTP_SSL)
+    mock_smtp_value.__enter__.return_value = mock_smtp_value
+    mock_imap_value.__enter__.return_value = mock_imap_value
+    mock_imap_value.select.return_value = ("OK", [b"3"])
+    mock_imap_value.response.return_value = ("UIDVALIDITY", [b"42"])
+    mock_imap_value.state = "SELECTED"
+    with mock.patch("smtplib.SMTP_SSL", return_value=mock_smtp_value):
+        with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+            return EmailManager.EmailManager(HANDLER_EMAIL="1", HANDLER_PASSWORD="2")
+
+def test_EmailManager_wait_for_new_emails_idle():
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    mock_imap_value.capabilities = ("IMAP4REV1", "IDLE")
+    mock_imap_value.untagged_responses = {"EXISTS": [b"3"]}
+    mock_imap_value.tagged_commands = {}
+    def new_tag():
+        mock_imap_value.tagged_commands[b"A1"] = None
+        return b"A1"
+    mock_imap_value._new_tag.side_effect = new_tag
+    server_socket, client_socket = socket.socketpair()
+    # all in one segment, lines after the continuation are already buffered when IDLE starts waiting
+    server_socket.sendall(b"+ idling\r\n* 3 EXPUNGE\r\n* 4 EXISTS\r\nA1 OK IDLE terminated\r\n")
+    mock_imap_value.socket.return_value = client_socket
+    mock_imap_value.file = client_socket.makefile("rb")
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        emanager = new_mock_email_manager(mock_imap_value)
+        start_time = time.monotonic()
+        assert emanager.wait_for_new_emails(timeout=5) == True
+        assert time.monotonic() - start_time < 1
+    mock_imap_value.send.assert_any_call(b"A1 IDLE\r\n")
+    mock_imap_value.send.assert_any_call(b"DONE\r\n")
+    assert mock_imap_value.tagged_commands == {}
+    mock_imap_value.file.close()
+    server_socket.close()
+    client_socket.close()
+
+def test_EmailManager_wait_for_new_emails_fallback():
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    mock_imap_value.capabilities = ("IMAP4REV1",)
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        emanager = new_mock_email_manager(mock_imap_value)
+        assert emanager.wait_for_new_emails(timeout=5, poll_interval=0.01) == True
+        assert emanager.wait_for_new_emails(timeout=5, poll_interval=1, stop=lambda: True) == False
+    mock_imap_value.send.assert_not_called()
+
+def test_EmailManager_sequence_set():
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    emanager = new_mock_email_manager(mock_imap_value)
+    assert emanager.sequence_set([1, 5, 9, 10, 11, 12]) == "1,5,9:12"
+    assert emanager.sequence_set(["3", b"2", 1, 1]) == "1:3"
+    with pytest.raises(AttributeError):
+        emanager.sequence_set([])
+
+def test_EmailManager_fetch_emails_by_uid_batched():
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    def uid(command, message_set, message_parts):
+        if "RFC822.SIZE" in message_parts:
+            return ("OK", [b"1 (UID 5 RFC822.SIZE 60)", b"2 (UID 9 RFC822.SIZE 60)", b"3 (UID 10 RFC822.SIZE 60)"])
+        response = []
+        for uid in {"5,9": ["5", "9"], "10": ["10"], "5,9:10": ["5", "9", "10"]}[message_set]:
+            if uid == "10":
+                # uid after literal
+                response += [(b"3 (BODY[] {30}", b"Subject: " + uid.encode() + b"\r\n\r\nbody"), b" UID 10)"]
+            else:
+                response += [(b"1 (UID " + uid.encode() + b" BODY[] {30}", b"Subject: " + uid.encode() + b"\r\n\r\nbody"), b")"]
+        return ("OK", response)
+    mock_imap_value.uid.side_effect = uid
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        emanager = new_mock_email_manager(mock_imap_value)
+        # 2 emails per batch
+        emails = emanager.fetch_emails_by_uid(["10", "5", "9"], max_batch_bytes=120)
+        assert [uid for uid, _ in emails] == ["5", "9", "10"]
+        assert [email["Subject"] for _, email in emails] == ["5", "9", "10"]
+        fetch_calls = [call.args[1] for call in mock_imap_value.uid.call_args_list if "RFC822.SIZE" not in call.args[2]]
+        assert fetch_calls == ["5,9", "10"]
+        # no budget, one fetch
+        mock_imap_value.uid.reset_mock()
+        emails = emanager.fetch_emails_by_uid(["10", "5", "9"], max_batch_bytes=0)
+        assert len(emails) == 3
+        mock_imap_value.uid.assert_called_once_with("FETCH", "5,9:10", "(UID BODY[])")
+
+def test_EmailManager_new_uids_incremental(tmp_path):
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    searches = []
+    def uid(command, charset, criteria):
+        searches.append(criteria)
+        return {"UNSEEN": ("OK", [b"3 7"]), "UID *": ("OK", [b"8"]), "UID 9:*": ("OK", [b"9 12"]), "UID 13:*": ("OK", [b"12"])}[criteria]
+    mock_imap_value.uid.side_effect = uid
+    state_path = tmp_path / "inbox_state.json"
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        emanager = new_mock_email_manager(mock_imap_value)
+        emanager.sync_state_path = str(state_path)
+        # first run resync from unseen
+        assert emanager.new_uids() == ["3", "7"]
+        emanager.mark_processed(["3", "7"])
+        # only search above last uid seen
+        assert emanager.new_uids() == ["9", "12"]
+        emanager.mark_processed("9")
+        assert emanager.new_uids() == ["12"]
+        assert searches == ["UNSEEN", "UID *", "UID 9:*", "UID 13:*"]
+        # state survive restart
+        emanager.sync_state_path = str(state_path)
+        assert emanager._load_sync_state() == {"uidvalidity": 42, "last_uid": 12, "pending": [12]}
+        # uidvalidity changed, resync
+        emanager._sync_state["uidvalidity"] = 41
+        searches.clear()
+        assert emanager.new_uids() == ["3", "7"]
+        assert searches == ["UNSEEN", "UID *"]
+        # uidvalidity changed on server while session stay selected, read with STATUS
+        emanager.mark_processed(["3", "7"])
+        mock_imap_value.response.return_value = ("UIDVALIDITY", [None])
+        mock_imap_value.status.return_value = ("OK", [b'"inbox" (UIDVALIDITY 43)'])
+        searches.clear()
+        assert emanager.new_uids() == ["3", "7"]
+        assert searches == ["UNSEEN", "UID *"]
+        mock_imap_value.select.assert_called_once()
+        mock_imap_value.status.assert_called_with("inbox", "(UIDVALIDITY)")
+
+def test_EmailManager_parse_email_spool_attachments(tmp_path):
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    emanager = new_mock_email_manager(mock_imap_value)
+    emanager.attachment_path = tmp_path
+    binary_data = os.urandom(300 * 1024)
+    text_data = ("café = long line " * 400 + "\n").encode("utf-8") * 20
+    email = MIMEMultipart()
+    email["From"] = "sender <sender@test.com>"
+    email["Subject"] = "spool"
+    email.attach(MIMEText("read", "plain"))
+    binary_attachment = MIMEApplication(binary_data, Name="data.bin")
+    binary_attachment.add_header("Content-Disposition", "attachment; filename=data.bin")
+    email.attach(binary_attachment)
+    text_attachment = MIMEBase("text", "plain")
+    text_attachment.set_payload(text_data)
+    encoders.encode_quopri(text_attachment)
+    text_attachment.add_header("Content-Disposition", "attachment; filename=data.txt")
+    email.attach(text_attachment)
+    email = message_from_bytes(email.as_bytes())
+
+    parsed_email = emanager.parse_email(email, spool=True)
+    assert [name for name, _ in parsed_email["attachments"]] == ["data.bin", "data.txt"]
+    for (name, handle), data in zip(parsed_email["attachments"], [binary_data, text_data]):
+        assert handle["size"] == len(data)
+        assert handle["sha256"] == hashlib.sha256(data).hexdigest()
+        assert open(handle["path"], "rb").read() == data
+    # no temp file left
+    assert sorted(os.listdir(os.path.dirname(parsed_email["attachments"][0][1]["path"]))) == ["data.bin", "data.txt"]
+
+@pytest.mark.parametrize("spool", [True, False])
+def test_EmailManager_parse_email_attachment_name_traversal(tmp_path, spool):
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    emanager = new_mock_email_manager(mock_imap_value)
+    emanager.attachment_path = str(tmp_path / "attachments")
+    email = MIMEMultipart()
+    email["From"] = "sender <sender@test.com>"
+    email["Subject"] = "traversal"
+    email.attach(MIMEText("write", "plain"))
+    for file_name in ("../../evil.txt", "..\\..\\evil.bat", "..", "a\x00b:c.txt"):
+        attachment = MIMEApplication(b"data", Name="x")
+        attachment.add_header("Content-Disposition", "attachment", filename=file_name)
+        email.attach(attachment)
+    email = message_from_bytes(email.as_bytes())
+    parsed_email = emanager.parse_email(email, spool=spool)
+    assert [name for name, _ in parsed_email["attachments"]] == ["evil.txt", "evil.bat", "attachment_2", "a_b_c.txt"]
+    # nothing written outside attachment_path
+    assert sorted(os.listdir(tmp_path)) == ["attachments"]
+
+def test_EmailManager_parse_email_attachment_store(tmp_path):
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    emanager = new_mock_email_manager(mock_imap_value)
+    emanager.attachment_path = tmp_path / "attachments"
+    emanager.attachment_store = AttachmentStore.AttachmentStore(tmp_path / "store")
+    def new_email(message_id, data):
+        email = MIMEMultipart()
+        email["From"] = "sender <sender@test.com>"
+        email["Message-Id"] = message_id
+        email.attach(MIMEText("write", "plain"))
+        attachment = MIMEApplication(data, Name="same.bin")
+        attachment.add_header("Content-Disposition", "attachment; filename=same.bin")
+        email.attach(attachment)
+        return message_from_bytes(email.as_bytes())
+    first = emanager.parse_email(new_email("<1@test>", b"first"), spool=True)["attachments"][0][1]
+    second = emanager.parse_email(new_email("<2@test>", b"second"), spool=True)["attachments"][0][1]
+    repeat = emanager.parse_email(new_email("<3@test>", b"first"), spool=True)["attachments"][0][1]
+    # same name from different email do not collide
+    assert open(first["path"], "rb").read() == b"first"
+    assert open(second["path"], "rb").read() == b"second"
+    # repeated file stored once
+    assert repeat["sha256"] == first["sha256"]
+    assert emanager.attachment_store.total_size() == len(b"first") + len(b"second")
+    # repeated file is a link to the stored file, disk usage do not grow
+    def disk_usage():
+        files = {}
+        for root, _, names in os.walk(tmp_path):
+            for name in names:
+                if not name.startswith("index."):
+                    file_stat = os.stat(os.path.join(root, name))
+                    files[(file_stat.st_dev, file_stat.st_ino)] = file_stat.st_size
+        return sum(files.values())
+    assert os.path.samefile(repeat["path"], first["path"])
+    usage = disk_usage()
+    again = emanager.parse_email(new_email("<4@test>", b"first"), spool=True)["attachments"][0][1]
+    assert disk_usage() == usage
+    emanager.release_attachments([("same.bin", again)])
+    # save from store
+    target = emanager.save_attachment(("same.bin", repeat), str(tmp_path / "saved.bin"))
+    assert open(target, "rb").read() == b"first"
+    assert emanager.attachment_store._index[first["sha256"]]["refcount"] == 2
+    # released copies are removed and their stored file can be evicted
+    emanager.release_attachments([("same.bin", first), ("same.bin", repeat)])
+    assert not os.path.exists(first["path"]) and not os.path.exists(os.path.dirname(repeat["path"]))
+    assert emanager.attachment_store._index[first["sha256"]]["refcount"] == 0
+    emanager.attachment_store.max_size = len(b"second")
+    assert emanager.attachment_store.gc() == [first["sha256"]]
+    assert open(target, "rb").read() == b"first"
+
+def test_EmailManager_fetch_email_summaries_lazy_attachments(tmp_path):
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    structure = b'(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "BASE64" 12 1 NIL NIL NIL)("APPLICATION" "OCTET-STREAM" NIL NIL NIL "BASE64" 8 NIL ("ATTACHMENT" ("FILENAME" "a.bin")) NIL) "MIXED" ("BOUNDARY" "b") NIL NIL)'
+    def uid(command, message_set, message_parts):
+        if "BODYSTRUCTURE" in message_parts:
+            return ("OK", [(b"1 (UID 3 BODYSTRUCTURE " + structure + b" BODY[HEADER] {56}", b"From: sender <sender@test.com>\r\nSubject: write\r\nMessage-Id: <1@test>\r\n\r\n"), b")"])
+        if "BODY[1]" in message_parts:
+            return ("OK", [(b"1 (UID 3 BODY[1] {12}", b"d3JpdGUgW2FdCg=="), b")"])
+        if "BODY.PEEK[2]" in message_parts:
+            return ("OK", [(b"1 (UID 3 BODY[2] {8}", b"AAECAw=="), b")"])
+    mock_imap_value.uid.side_effect = uid
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        emanager = new_mock_email_manager(mock_imap_value)
+        emanager.attachment_path = tmp_path
+        summaries = emanager.fetch_email_summaries(["3"])
+        assert len(summaries) == 1
+        uid_fetched, summary, attachment_parts = summaries[0]
+        parsed_email = emanager.parse_email(summary)
+        assert parsed_email["body"][0][0].strip() == "write [a]"
+        assert parsed_email["subject"] == "write"
+        assert [part["section"] for part in attachment_parts] == ["2"]
+        # attachment not fetched yet
+        assert not any("[2]" in call.args[2] for call in mock_imap_value.uid.call_args_list)
+        attachments = emanager.fetch_attachments(uid_fetched, attachment_parts, parsed_email["id"])
+        assert attachments[0][0] == "a.bin"
+        assert open(attachments[0][1]["path"], "rb").read() == b"\x00\x01\x02\x03"
+
+def test_EmailManager_fetch_email_summaries_bad_email():
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    structures = {
+        3: b'("TEXT" "PLAIN" ("CHARSET" "utf-9") NIL NIL "7BIT" 5 1 NIL NIL NIL)', # unknown charset
+        4: b'("TEXT" "PLAIN" NIL NIL NIL "7BIT" "big" 1)', # malformed size
+        5: b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 5 1 NIL NIL NIL)',
+    }
+    header = b"From: sender <sender@test.com>\r\nSubject: hi\r\n\r\n"
+    def uid(command, message_set, message_parts):
+        if "BODYSTRUCTURE" in message_parts:
+            return ("OK", [item for uid, structure in structures.items()
+                for item in [(f"{uid} (UID {uid} BODYSTRUCTURE ".encode() + structure + f" BODY[HEADER] {{{len(header)}}}".encode(), header), b")"]])
+        return ("OK", [item for uid in message_set.replace(":", ",").split(",") for item in [(f"{uid} (UID {uid} BODY[1] {{5}}".encode(), b"help\n"), b")"]])
+    mock_imap_value.uid.side_effect = uid
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        emanager = new_mock_email_manager(mock_imap_value)
+        summaries = emanager.fetch_email_summaries(["3", "4", "5"], mark_read=False)
+        # malformed email is left out, the rest of the batch is read
+        assert [uid for uid, _, _ in summaries] == ["3", "5"]
+        assert [summary.get_payload(decode=True) for _, summary, _ in summaries] == [b"help\n", b"help\n"]
+
+def test_EmailManager_store_flags_one_command():
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    mock_imap_value.uid.return_value = ("OK", [None])
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        emanager = new_mock_email_manager(mock_imap_value)
+        results = emanager.store_flags(list(range(1, 51)) + [60] + list(range(72, 81)), "add", "\\Seen")
+        assert len(results) == 60 and all(result is True for result in results.values())
+        mock_imap_value.uid.assert_called_once_with("STORE", "1:50,60,72:80", "+FLAGS.SILENT", "(\\Seen)")
+        # writable selection
+        mock_imap_value.select.assert_called_with("inbox", readonly=False)
+
+def test_EmailManager_one_mailbox_mode():
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    mock_imap_value.uid.return_value = ("OK", [b"3"])
+    mock_imap_value.capabilities = ()
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        emanager = new_mock_email_manager(mock_imap_value)
+        # a scan loop: wait, search, then mark read
+        emanager.wait_for_new_emails(poll_interval=0.01)
+        assert emanager.new_uids() == ["3"]
+        assert emanager.unseen_uids() == ["3"]
+        emanager.store_flags(["3"], "add", "\\Seen")
+        # pooled session selected once, never switched between EXAMINE and SELECT
+        mock_imap_value.select.assert_called_once_with("inbox", readonly=False)
+
+def test_EmailManager_store_flags_results():
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    mock_imap_value.uid.return_value = ("OK", [b"1 (UID 5 FLAGS (\\Seen \\Flagged))"])
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        emanager = new_mock_email_manager(mock_imap_value)
+        results = emanager.store_flags(["5", "6"], "remove", ["\\Answered"], silent=False)
+        assert results == {"5": ("\\Seen", "\\Flagged"), "6": None}
+        mock_imap_value.uid.assert_called_once_with("STORE", "5:6", "-FLAGS", "(\\Answered)")
+        with pytest.raises(AttributeError):
+            emanager.store_flags(["5"], "toggle")
+
+def test_EmailManager_mark_emails_one_store():
+    mock_imap_value = mock.MagicMock(spec=imaplib.IMAP4_SSL)
+    mock_imap_value.store.return_value = ("OK", [])
+    with mock.patch("imaplib.IMAP4_SSL", return_value=mock_imap_value):
+        emanager = new_mock_email_manager(mock_imap_value)
+        assert emanager.mark_emails([b"3", "1", "2"], "remove") == ["3", "1", "2"]
+        mock_imap_value.store.assert_called_once_with("1:3", "-FLAGS", "\\Seen")
@@ -0,0 +1,130 @@
+import pytest
+import sys
+import os
+from email.mime.text import MIMEText
+sys.path.append(f"{__file__}/../../../emalia_src")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmark"))
+import EmailManager
+import MessageCache
+import fake_servers
+
+def test_fake_servers_with_EmailManager(tmp_path):
+    imap_server = fake_servers.FakeIMAPServer().start()
+    smtp_server = fake_servers.FakeSMTPServer().start()
+    try:
+        for i in range(3):
+            command_email = MIMEText(f"help {i}")
+            command_email["From"] = f"<user{i}@b.com>"
+            command_email["Message-ID"] = f"<{i}@b.com>"
+            imap_server.mailbox.append(command_email)
+        emanager = EmailManager.EmailManager(HANDLER_EMAIL="1", HANDLER_PASSWORD="2", HANDLER_SMTP=smtp_server.config, HANDLER_IMAP=imap_server.config, attachment_path=str(tmp_path))
+        uids = emanager.new_uids()
+        assert uids == ["1", "2", "3"]
+        summaries = emanager.fetch_email_summaries(uids, mark_read=False)
+        assert [emanager.parse_email(summary)["body"][0][0].strip() for _, summary, _ in summaries] == ["help 0", "help 1", "help 2"]
+        assert emanager.store_flags(uids, silent=False) == {"1": ("\\Seen",), "2": ("\\Seen",), "3": ("\\Seen",)}
+        assert emanager.unseen_uids() == []
+        emanager.send_many([emanager.new_email("<user0@b.com>", "re", "done")])
+        assert smtp_server.wait_for(1, 5)
+        assert smtp_server.messages[0][2] == ["<user0@b.com>"]
+        emanager.close()
+    finally:
+        imap_server.stop()
+        smtp_server.stop()
+
+def test_new_uids_uidvalidity_change(tmp_path):
+    imap_server = fake_servers.FakeIMAPServer().start()
+    smtp_server = fake_servers.FakeSMTPServer().start()
+    try:
+        imap_server.mailbox.append(MIMEText("help"))
+        emanager = EmailManager.EmailManager(HANDLER_EMAIL="1", HANDLER_PASSWORD="2", HANDLER_SMTP=smtp_server.config, HANDLER_IMAP=imap_server.config, attachment_path=str(tmp_path))
+        assert emanager.new_uids() == ["1"]
+        emanager.mark_processed("1")
+        assert emanager.new_uids() == []
+        # mailbox recreated, pooled session is still selected from before
+        imap_server.mailbox.uidvalidity += 1
+        assert emanager.new_uids() == ["1"]
+        assert emanager._sync_state["uidvalidity"] == imap_server.mailbox.uidvalidity
+        emanager.close()
+    finally:
+        imap_server.stop()
+        smtp_server.stop()
+
+def test_uidvalidity_change_after_new_uids(tmp_path):
+    imap_server = fake_servers.FakeIMAPServer().start()
+    smtp_server = fake_servers.FakeSMTPServer().start()
+    try:
+        imap_server.mailbox.append(MIMEText("help"))
+        emanager = EmailManager.EmailManager(HANDLER_EMAIL="1", HANDLER_PASSWORD="2", HANDLER_SMTP=smtp_server.config, HANDLER_IMAP=imap_server.config, attachment_path=str(tmp_path))
+        uids = emanager.new_uids()
+        uidvalidity = emanager.sync_uidvalidity()
+        # mailbox recreated between the search and the fetch, uid 1 may be another email now
+        imap_server.mailbox.uidvalidity += 1
+        with pytest.raises(ValueError):
+            emanager.fetch_email_summaries(uids, mark_read=False, uidvalidity=uidvalidity)
+        with pytest.raises(ValueError):
+            emanager.store_flags(uids, uidvalidity=uidvalidity)
+        assert "UID FETCH" not in imap_server.commands and "UID STORE" not in imap_server.commands
+        # next scan resync, uids done under the old UIDVALIDITY do not touch the new state
+        assert emanager.new_uids() == ["1"]
+        emanager.mark_processed(uids, uidvalidity)
+        assert emanager.new_uids() == ["1"]
+        assert emanager.fetch_email_summaries(["1"], mark_read=False, uidvalidity=emanager.sync_uidvalidity())[0][0] == "1"
+        emanager.close()
+    finally:
+        imap_server.stop()
+        smtp_server.stop()
+
+def test_message_cache_serve_fetch_locally(tmp_path):
+    imap_server = fake_servers.FakeIMAPServer().start()
+    smtp_server = fake_servers.FakeSMTPServer().start()
+    try:
+        command_email = MIMEText("help")
+        command_email["Message-ID"] = "<1@b.com>"
+        imap_server.mailbox.append(command_email)
+        emanager = EmailManager.EmailManager(HANDLER_EMAIL="1", HANDLER_PASSWORD="2", HANDLER_SMTP=smtp_server.config, HANDLER_IMAP=imap_server.config,
+            attachment_path=str(tmp_path), message_cache=MessageCache.MessageCache(tmp_path / "cache"))
+        assert emanager.fetch_email("1", mark_read=False, by_uid=True)["Message-ID"] == "<1@b.com>"
+        commands = len(imap_server.commands)
+        # second fetch is a cache hit, no command sent
+        assert emanager.fetch_email("1", mark_read=False, by_uid=True)["Message-ID"] == "<1@b.com>"
+        assert emanager.fetch_emails_by_uid(["1"], mark_read=False)[0][1]["Message-ID"] == "<1@b.com>"
+        assert len(imap_server.commands) == commands
+        assert emanager.message_cache.get_by_message_id("<1@b.com>")
+        emanager.close()
+    finally:
+        imap_server.stop()
+        smtp_server.stop()
+
+def test_message_cache_fill_from_fetch_attachments(tmp_path):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.application import MIMEApplication
+    from email.mime.message import MIMEMessage
+    imap_server = fake_servers.FakeIMAPServer().start()
+    smtp_server = fake_servers.FakeSMTPServer().start()
+    try:
+        command_email = MIMEMultipart()
+        command_email["Message-ID"] = "<1@b.com>"
+        command_email.attach(MIMEText("write [a]"))
+        command_email.attach(MIMEApplication(b"\x00\x01\x02", Name="a.bin"))
+        command_email.get_payload()[1]["Content-Disposition"] = 'attachment; filename="a.bin"'
+        forwarded_email = MIMEMessage(MIMEText("forwarded"))
+        forwarded_email["Content-Disposition"] = 'attachment; filename="f.eml"'
+        command_email.attach(forwarded_email)
+        imap_server.mailbox.append(command_email)
+        emanager = EmailManager.EmailManager(HANDLER_EMAIL="1", HANDLER_PASSWORD="2", HANDLER_SMTP=smtp_server.config, HANDLER_IMAP=imap_server.config,
+            attachment_path=str(tmp_path), message_cache=MessageCache.MessageCache(tmp_path / "cache"))
+        uid, _, attachment_parts = emanager.fetch_email_summaries(emanager.new_uids(), mark_read=False)[0]
+        attachments = emanager.fetch_attachments(uid, attachment_parts, "<1@b.com>")
+        assert [name for name, _ in attachments] == ["a.bin", "f.eml"]
+        assert open(attachments[0][1]["path"], "rb").read() == b"\x00\x01\x02"
+        assert b"forwarded" in open(attachments[1][1]["path"], "rb").read()
+        # whole email cached by the attachment fetch, a rerun send no fetch
+        assert emanager.message_cache.get_by_message_id("<1@b.com>")
+        commands = len(imap_server.commands)
+        assert [handle["sha256"] for _, handle in emanager.fetch_attachments(uid, attachment_parts, "<1@b.com>")] == [handle["sha256"] for _, handle in attachments]
+        assert not any("FETCH" in str(command).upper() for command in imap_server.commands[commands:])
+        emanager.close()
+    finally:
+        imap_server.stop()
+        smtp_server.stop()
@@ -1,4 +1,6 @@
 import tempfile
+import os
+import zipfile
 from pathlib import Path
 import pytest
 import sys
@@ -88,4 +90,117 @@ def test_check_path_in_range_diverge_layer():
         # diverge path True
         check_path = base_dir / "A/B"
         check_path.touch()
-        assert FileManager.check_path_in_range(target_file, check_path, 5) == True
\ No newline at end of file
+        assert FileManager.check_path_in_range(target_file, check_path, 5) == True
+def test_zip_directory():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_dir = Path(temp_dir)
+        (base_dir / "a/b").mkdir(parents=True)
+        (base_dir / "a/top.txt").write_bytes(b"top" * 1000)
+        (base_dir / "a/b/inner.bin").write_bytes(os.urandom(2000))
+        archive, info = FileManager.zip_directory(base_dir / "a", chunk_size=100)
+        with archive, zipfile.ZipFile(archive) as zipped_file:
+            assert sorted(zipped_file.namelist()) == ["b/inner.bin", "top.txt"]
+            assert zipped_file.read("top.txt") == b"top" * 1000
+            assert zipped_file.testzip() is None
+        assert info["entries"] == 2
+        assert info["uncompressed_size"] == 5000
+        assert 0 < info["compressed_size"] < 5000
+
+def test_zip_directory_max_size():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_dir = Path(temp_dir)
+        (base_dir / "a").mkdir()
+        (base_dir / "a/random.bin").write_bytes(os.urandom(100000))
+        with pytest.raises(ValueError):
+            FileManager.zip_directory(base_dir / "a", max_size=1000, chunk_size=1000)
+
+def test_tree_signature():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_dir = Path(temp_dir)
+        (base_dir / "a/b").mkdir(parents=True)
+        (base_dir / "a/b/file.txt").write_bytes(b"123")
+        signature = FileManager.tree_signature(base_dir / "a")
+        assert signature == FileManager.tree_signature(base_dir / "a")
+        # modified
+        os.utime(base_dir / "a/b/file.txt", ns=(1, 1))
+        modified_signature = FileManager.tree_signature(base_dir / "a")
+        assert modified_signature != signature
+        # added
+        (base_dir / "a/b/new.txt").touch()
+        assert FileManager.tree_signature(base_dir / "a") != modified_signature
+
+@pytest.mark.skipif(not hasattr(os, "symlink") or sys.platform == "win32", reason="symlinks need privilege on windows")
+def test_tree_signature_symlinks():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_dir = Path(temp_dir)
+        (base_dir / "a/b").mkdir(parents=True)
+        (base_dir / "target.txt").write_bytes(b"123")
+        # cycle back to the root and a dangling link
+        os.symlink(base_dir / "a", base_dir / "a/b/loop")
+        os.symlink(base_dir / "missing", base_dir / "a/dangling")
+        os.symlink(base_dir / "target.txt", base_dir / "a/link.txt")
+        signature = FileManager.tree_signature(base_dir / "a")
+        assert signature == FileManager.tree_signature(base_dir / "a")
+        # content behind a file link changed
+        os.utime(base_dir / "target.txt", ns=(1, 1))
+        assert FileManager.tree_signature(base_dir / "a") != signature
+
+def test_choose_compression():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_dir = Path(temp_dir)
+        (base_dir / "photo.jpg").write_bytes(b"a" * 1000)
+        (base_dir / "backup.tar.gz").write_bytes(b"a" * 1000)
+        (base_dir / "text.txt").write_bytes(b"abc" * 100000)
+        (base_dir / "random.bin").write_bytes(os.urandom(300000))
+        assert FileManager.choose_compression(base_dir / "photo.jpg") == zipfile.ZIP_STORED
+        assert FileManager.choose_compression(base_dir / "backup.tar.gz") == zipfile.ZIP_STORED
+        assert FileManager.choose_compression(base_dir / "text.txt") == zipfile.ZIP_DEFLATED
+        assert FileManager.choose_compression(base_dir / "random.bin") == zipfile.ZIP_STORED
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_zip_directory_mixed_entries(workers):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_dir = Path(temp_dir)
+        (base_dir / "a/b").mkdir(parents=True)
+        contents = {"text.txt": b"hello world " * 50000, "b/photo.jpg": os.urandom(5000), "b/random.bin": os.urandom(300000), "b/small.txt": b"small"}
+        for name, content in contents.items():
+            (base_dir / "a" / name).write_bytes(content)
+        archive, info = FileManager.zip_directory(base_dir / "a", chunk_size=4096, workers=workers, parallel_size=0)
+        with archive, zipfile.ZipFile(archive) as zipped_file:
+            assert zipped_file.testzip() is None
+            assert {name: zipped_file.read(name) for name in zipped_file.namelist()} == contents
+            assert zipped_file.getinfo("text.txt").compress_type == zipfile.ZIP_DEFLATED
+            assert zipped_file.getinfo("b/photo.jpg").compress_type == zipfile.ZIP_STORED
+            assert zipped_file.getinfo("b/random.bin").compress_type == zipfile.ZIP_STORED
+        assert info["entries"] == 4 and info["stored_entries"] == 3
+
+def test_zip_directory_size_checked_before_write(monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_dir = Path(temp_dir)
+        (base_dir / "a").mkdir()
+        (base_dir / "a/small.txt").write_bytes(b"small")
+        (base_dir / "a/text.txt").write_bytes(b"hello world " * 50000)
+        archive, info = FileManager.zip_directory(base_dir / "a")
+        archive.close()
+        # deflated entry does not fit, it is never written
+        writes = []
+        real_add = FileManager._ZipWriter.add
+        monkeypatch.setattr(FileManager._ZipWriter, "add", lambda self, zip_info, *args: writes.append(zip_info.filename) or real_add(self, zip_info, *args))
+        with pytest.raises(ValueError):
+            FileManager.zip_directory(base_dir / "a", max_size=info["compressed_size"] - 200)
+        assert "text.txt" not in writes
+
+def test_zip_directory_pool_reused():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_dir = Path(temp_dir)
+        (base_dir / "a").mkdir()
+        for i in range(3):
+            (base_dir / f"a/{i}.txt").write_bytes(f"{i} text ".encode() * 20000)
+        FileManager.zip_directory(base_dir / "a", workers=2, parallel_size=0)[0].close()
+        pool = FileManager._pool
+        archive, _ = FileManager.zip_directory(base_dir / "a", workers=2, parallel_size=0)
+        assert FileManager._pool is pool
+        with archive, zipfile.ZipFile(archive) as zipped_file:
+            assert zipped_file.read("2.txt") == b"2 text " * 20000
+        FileManager.shutdown_pool()
+        assert FileManager._pool is None
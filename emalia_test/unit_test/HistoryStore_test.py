@@ -0,0 +1,115 @@
+import csv
+import pytest
+import sys
+sys.path.append(f"{__file__}/../../../emalia_src")
+import HistoryStore
+
+def new_parsed_email(sender="<a@b.com>", body="help", email_id="<1@b.com>"):
+    return {"id": email_id, "sender": sender, "from": sender, "date": "Mon, 02 Jan 2023 10:00:00 +0000", "subject": "hi",
+        "body": [(body, "plain")], "attachments": []}
+
+def test_SQLiteHistoryStore_record_find(tmp_path):
+    store = HistoryStore.SQLiteHistoryStore(str(tmp_path / "history.db"))
+    store.record(new_parsed_email(), "received", task="1")
+    store.record(new_parsed_email("<c@d.com>", "write", "<2@d.com>"), "received", task="2", error="failed")
+    store.flush()
+    records = store.find(sender="<a@b.com>")
+    assert len(records) == 1
+    assert records[0]["body"] == "help"
+    assert records[0]["task"] == "1"
+    assert store.find(message_id="<2@d.com>")[0]["error"] == "failed"
+    with pytest.raises(AttributeError):
+        store.find(unknown="1")
+    store.close()
+    with pytest.raises(ValueError):
+        store.record(new_parsed_email(), "received")
+
+def test_SQLiteHistoryStore_batch_written_on_close(tmp_path):
+    store = HistoryStore.SQLiteHistoryStore(str(tmp_path / "history.db"), batch_size=3, flush_interval=60)
+    for i in range(10):
+        store.record(new_parsed_email(email_id=f"<{i}@b.com>"), "received")
+    store.close()
+    reopened = HistoryStore.SQLiteHistoryStore(str(tmp_path / "history.db"))
+    assert len(reopened.find(action="received")) == 10
+    reopened.close()
+
+def test_migrate_csv(tmp_path):
+    csv_path = tmp_path / "history.csv"
+    with open(csv_path, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=["id", "date", "from", "subject", "sender", "body", "attachments", "action", "comment"])
+        writer.writeheader()
+        writer.writerow({"id": "<1@b.com>", "date": "Mon, 02 Jan 2023 10:00:00 +0000", "from": "<a@b.com>", "subject": "hi",
+            "sender": "<a@b.com>", "body": str([("help", "plain")]), "attachments": "[]", "action": "received", "comment": ""})
+    store = HistoryStore.SQLiteHistoryStore(str(tmp_path / "history.db"))
+    assert HistoryStore.migrate_csv(str(csv_path), store) == 1
+    assert store.find(message_id="<1@b.com>")[0]["body"] == "help"
+    store.close()
+
+def new_searchable_store(path):
+    store = HistoryStore.SQLiteHistoryStore(path)
+    store.record(new_parsed_email(body="gpt summarize the quarterly report", email_id="<1@b.com>"), "received", task="7", error="timeout")
+    store.record(new_parsed_email(body="gpt write a poem", email_id="<2@b.com>"), "received", task="7")
+    store.record(new_parsed_email("<c@d.com>", "read [report.pdf]", "<3@d.com>"), "received", task="1")
+    store.flush()
+    return store
+
+@pytest.mark.parametrize("full_text", [True, False])
+def test_SQLiteHistoryStore_search(tmp_path, full_text):
+    store = new_searchable_store(str(tmp_path / "history.db"))
+    store.full_text = store.full_text and full_text
+    assert {record["message_id"] for record in store.search("report")} == {"<1@b.com>", "<3@d.com>"}
+    assert [record["message_id"] for record in store.search("gpt", error=True)] == ["<1@b.com>"]
+    assert [record["message_id"] for record in store.search(task="7", error=False)] == ["<2@b.com>"]
+    assert [record["message_id"] for record in store.search(sender="c@d.com")] == ["<3@d.com>"]
+    assert list(store.search(since=2e9)) == []
+    # fts syntax in user input is searched as plain words
+    assert list(store.search('report" OR "poem')) == []
+    store.close()
+
+def test_SQLiteHistoryStore_sender_normalized(tmp_path):
+    store = HistoryStore.SQLiteHistoryStore(str(tmp_path / "history.db"))
+    store.record(new_parsed_email("A Name <A@b.com>", email_id="<1@b.com>"), "received")
+    store.record(new_parsed_email("a@b.com", email_id="<2@b.com>"), "received")
+    store.flush()
+    for sender in ("a@b.com", "<a@b.com>", "Other Name <a@B.com>"):
+        assert {record["message_id"] for record in store.search(sender=sender)} == {"<1@b.com>", "<2@b.com>"}
+    assert len(store.find(sender="<a@b.com>")) == 2
+    store.close()
+
+def test_SQLiteHistoryStore_sender_migrated(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "history.db")
+    store = HistoryStore.SQLiteHistoryStore(path)
+    store.close()
+    # database written before senders were normalized
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute("INSERT INTO history (message_id, sender, action) VALUES ('<1@b.com>', 'A Name <A@b.com>', 'received')")
+        connection.execute("PRAGMA user_version = 0")
+    connection.close()
+    store = HistoryStore.SQLiteHistoryStore(path)
+    assert [record["message_id"] for record in store.search(sender="a@b.com")] == ["<1@b.com>"]
+    store.close()
+
+def test_SQLiteHistoryStore_search_paging(tmp_path):
+    store = HistoryStore.SQLiteHistoryStore(str(tmp_path / "history.db"))
+    for i in range(25):
+        store.record(new_parsed_email(body=f"help {i}", email_id=f"<{i}@b.com>"), "received")
+    store.flush()
+    assert len(list(store.search("help", page_size=7))) == 25
+    assert len(list(store.search("help", offset=20))) == 5
+    store.close()
+
+def test_SQLiteHistoryStore_writer_survive_error(tmp_path, caplog):
+    store = HistoryStore.SQLiteHistoryStore(str(tmp_path / "history.db"), flush_interval=0.01)
+    # a record the writer cannot insert
+    store._queue.put({"message_id": "<bad@b.com>"})
+    store.flush()
+    assert "Cannot write 1 history records" in caplog.text
+    # writer still running, flush do not hang
+    store.record(new_parsed_email(), "received")
+    store.flush()
+    assert len(store.find(action="received")) == 1
+    store.close()
+    with pytest.raises(TypeError):
+        HistoryStore.HistoryStore()
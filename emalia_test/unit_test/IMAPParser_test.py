@@ -0,0 +1,37 @@
+import pytest
+import sys
+sys.path.append(f"{__file__}/../../../emalia_src")
+import IMAPParser
+
+def test_parse_fetch_response_literal():
+    response = [
+        (b'1 (UID 5 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 4 1 NIL NIL NIL) BODY[HEADER] {22}', b"Subject: hi\r\nTo: a\r\n\r\n"),
+        b")",
+        (b'2 (BODY[HEADER] {14}', b"Subject: x\r\n\r\n"),
+        b' UID 9 FLAGS (\\Seen "a \\" b"))',
+    ]
+    fetched = IMAPParser.parse_fetch_response(response)
+    assert len(fetched) == 2
+    assert fetched[0]["UID"] == b"5"
+    assert fetched[0]["BODY[HEADER]"] == b"Subject: hi\r\nTo: a\r\n\r\n"
+    assert fetched[0]["BODYSTRUCTURE"][2] == [b"CHARSET", b"utf-8"]
+    assert fetched[0]["BODYSTRUCTURE"][3] is None
+    assert fetched[1]["UID"] == b"9"
+    assert fetched[1]["FLAGS"] == [b"\\Seen", b'a " b']
+
+def test_parse_bodystructure_multipart():
+    response = [b'1 (UID 7 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL)("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "BASE64" 300 5 NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "b2") NIL NIL)("APPLICATION" "PDF" ("NAME" "doc.pdf") NIL NIL "BASE64" 5000 NIL ("ATTACHMENT" ("FILENAME*" "utf-8\'\'r%C3%A9sum%C3%A9.pdf")) NIL)("TEXT" "PLAIN" NIL NIL NIL "7BIT" 10 1 NIL ("attachment" ("filename" "=?utf-8?q?note=2Etxt?=")) NIL) "MIXED" ("BOUNDARY" "b1") NIL NIL))']
+    structure = IMAPParser.parse_fetch_response(response)[0]["BODYSTRUCTURE"]
+    parts = IMAPParser.parse_bodystructure(structure)
+    assert [part["section"] for part in parts] == ["1.1", "1.2", "2", "3"]
+    assert [part["type"] for part in parts] == ["text/plain", "text/html", "application/pdf", "text/plain"]
+    assert parts[0]["encoding"] == "quoted-printable"
+    assert parts[0]["disposition"] is None
+    assert parts[2]["disposition"] == "attachment"
+    assert parts[2]["filename"] == "résumé.pdf"
+    assert parts[2]["size"] == 5000
+    assert parts[3]["filename"] == "note.txt"
+
+def test_parse_bodystructure_single_part():
+    structure = IMAPParser.parse_fetch_response([b'1 (BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 3 1 NIL NIL NIL))'])[0]["BODYSTRUCTURE"]
+    assert IMAPParser.parse_bodystructure(structure)[0]["section"] == "1"
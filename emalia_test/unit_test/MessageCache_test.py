@@ -0,0 +1,39 @@
+import os
+import pytest
+import sys
+sys.path.append(f"{__file__}/../../../emalia_src")
+import MessageCache
+
+def new_raw_email(message_id, body="hello"):
+    return f"Message-ID: {message_id}\r\nSubject: hi\r\n\r\n{body}\r\n".encode()
+
+def test_MessageCache_get_put(tmp_path):
+    cache = MessageCache.MessageCache(tmp_path / "cache")
+    assert cache.get(42, 1) is None
+    cache.put(42, "1", new_raw_email("<1@b.com>"))
+    assert cache.get(42, 1) == new_raw_email("<1@b.com>")
+    assert cache.get_by_message_id("<1@b.com>") == new_raw_email("<1@b.com>")
+    # other uidvalidity is another mailbox state
+    assert cache.get(43, 1) is None
+    assert cache.get(None, 1) is None
+    # index is rebuilt from file names
+    reopened = MessageCache.MessageCache(tmp_path / "cache")
+    assert (42, 1) in reopened
+    assert reopened.get_by_message_id("<1@b.com>") == new_raw_email("<1@b.com>")
+    reopened.discard(42, 1)
+    assert reopened.get(42, 1) is None and reopened.get_by_message_id("<1@b.com>") is None
+
+def test_MessageCache_evict_lru(tmp_path):
+    size = len(new_raw_email("<0@b.com>", "0" * 10))
+    cache = MessageCache.MessageCache(tmp_path / "cache", max_size=size * 2)
+    cache.put(1, 1, new_raw_email("<1@b.com>", "1" * 10))
+    cache.put(1, 2, new_raw_email("<2@b.com>", "2" * 10))
+    cache._entries[(1, 1)]["last_access"] = 1
+    cache._entries[(1, 2)]["last_access"] = 2
+    # hit refresh last access
+    cache.get(1, 1)
+    cache.put(1, 3, new_raw_email("<3@b.com>", "3" * 10))
+    assert cache.get(1, 2) is None
+    assert cache.get(1, 1) and cache.get(1, 3)
+    assert cache.total_size() <= size * 2
+    assert len(os.listdir(tmp_path / "cache" / "cur")) == 2
@@ -0,0 +1,87 @@
+import pytest
+import sys
+import smtplib
+from email.message import Message
+sys.path.append(f"{__file__}/../../../emalia_src")
+import Outbox
+import ConnectionPool
+
+def new_email(to="<a@b.com>", subject="hi"):
+    outgoing_email = Message()
+    outgoing_email["To"] = to
+    outgoing_email["Subject"] = subject
+    outgoing_email.set_payload("body")
+    return outgoing_email
+
+class FakeSender():
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.sent = []
+    def __call__(self, outgoing_emails):
+        results = []
+        for outgoing_email in outgoing_emails:
+            error = self.errors.pop(0) if self.errors else None
+            if error is None:
+                self.sent.append(outgoing_email["Subject"])
+            results.append((outgoing_email, error))
+        return results
+
+def test_TokenBucket_refill():
+    bucket = Outbox.TokenBucket(2, 60, updated=0)
+    assert bucket.available(0) == 2
+    bucket.consume(2, 0)
+    assert bucket.available(0) == 0
+    assert bucket.wait_time(1, 0) == 30
+    assert bucket.available(30) == 1
+    assert Outbox.TokenBucket(-1, 60).available() == -1
+
+def test_Outbox_send_in_order_and_survive_restart(tmp_path):
+    sender = FakeSender()
+    outbox = Outbox.Outbox(str(tmp_path), sender)
+    for i in range(3):
+        outbox.enqueue(new_email(subject=str(i)))
+    # reopen, pending emails are read from disk
+    outbox = Outbox.Outbox(str(tmp_path), sender)
+    assert len(outbox.pending()) == 3
+    assert outbox.send_due() == 0
+    assert sender.sent == ["0", "1", "2"]
+    assert outbox.pending() == []
+
+def test_Outbox_retry_backoff(tmp_path):
+    sender = FakeSender([ConnectionError("down"), ConnectionError("down")])
+    failed = []
+    outbox = Outbox.Outbox(str(tmp_path), sender, base_delay=10, max_attempts=3, on_failed=lambda outgoing_email, err: failed.append(err))
+    outbox.enqueue(new_email())
+    outbox.send_due(now=1000)
+    # not due until backoff passed
+    assert 8 <= outbox.send_due(now=1000) <= 10
+    outbox.send_due(now=1010)
+    assert 16 <= outbox.send_due(now=1010) <= 20
+    outbox.send_due(now=1100)
+    assert sender.sent == ["hi"]
+    assert outbox.pending() == [] and failed == []
+
+@pytest.mark.parametrize("error", [smtplib.SMTPRecipientsRefused({"a@b.com": (550, b"no such user")}), ConnectionPool.DeliveryUnknownError("lost after DATA")])
+def test_Outbox_permanent_failure(tmp_path, error):
+    sender = FakeSender([error])
+    failed = []
+    outbox = Outbox.Outbox(str(tmp_path), sender, on_failed=lambda outgoing_email, err: failed.append(err))
+    outbox.enqueue(new_email())
+    outbox.send_due()
+    assert outbox.pending() == []
+    assert len(outbox.failed()) == 1 and len(failed) == 1
+
+def test_Outbox_rate_limit(tmp_path):
+    sender = FakeSender()
+    outbox = Outbox.Outbox(str(tmp_path), sender, per_minute=2, max_total=3)
+    for i in range(4):
+        outbox.enqueue(new_email(subject=str(i)))
+    outbox.send_due(now=outbox.buckets["minute"].updated)
+    assert sender.sent == ["0", "1"]
+    # per minute quota, next email allowed in 30 seconds
+    assert outbox.send_due(now=outbox.buckets["minute"].updated) == pytest.approx(30)
+    outbox.send_due(now=outbox.buckets["minute"].updated + 60)
+    assert sender.sent == ["0", "1", "2"]
+    # max_total reached, last email stays pending
+    assert outbox.send_due(now=outbox.buckets["minute"].updated + 60) == float("inf")
+    assert len(outbox.pending()) == 1
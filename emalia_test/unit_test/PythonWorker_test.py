@@ -0,0 +1,44 @@
+import time
+import threading
+import pytest
+import sys
+sys.path.append(f"{__file__}/../../../emalia_src")
+import PythonWorker
+
+@pytest.fixture
+def pool():
+    pool = PythonWorker.PythonWorkerPool(workers=2, timeout=5, cpu_time=1, memory=-1, max_jobs=3)
+    pool.start()
+    yield pool
+    pool.stop()
+
+def test_PythonWorkerPool_output(pool):
+    result = pool.run("import sys\nprint('hello')\nprint('warn', file=sys.stderr)")
+    assert result["stdout"] == "hello\n" and result["stderr"] == "warn\n" and result["error"] is None
+    result = pool.run("raise ValueError('bad')")
+    assert result["error"] == "ValueError: bad" and "Traceback" in result["stderr"]
+    # a script do not see globals of the last one
+    pool.run("x = 1")
+    assert pool.run("print(x)")["error"].startswith("NameError")
+
+def test_PythonWorkerPool_limits(pool):
+    pool.timeout = 0.5
+    assert pool.run("import time\ntime.sleep(3)")["error"] == "Timed out after 0.5 seconds"
+    pool.timeout = 5
+    if PythonWorker.resource is not None:
+        assert pool.run("while True: pass")["error"].startswith("CPUTimeExceeded")
+    # pool still work after workers are replaced
+    assert pool.run("print(1)")["stdout"] == "1\n"
+
+def test_PythonWorkerPool_recycle_and_parallel(pool):
+    pids = [pool.run("import os\nprint(os.getpid())")["stdout"] for _ in range(7)]
+    # max_jobs 3 per worker, 2 workers
+    assert len(set(pids)) >= 3
+    results = []
+    start = time.monotonic()
+    threads = [threading.Thread(target=lambda: results.append(pool.run("import time\ntime.sleep(0.5)"))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - start < 0.95 and all(result["error"] is None for result in results)
@@ -0,0 +1,102 @@
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import sys
+sys.path.append(f"{__file__}/../../../emalia_src")
+pytest.importorskip("requests")
+import RequestEngine
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/login":
+            self.server.cookies.append(self.headers.get("Cookie"))
+            self.send_response(200)
+            self.send_header("Set-Cookie", "session=secret; Path=/")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path.startswith("/redirect"):
+            self.send_response(302)
+            self.send_header("Location", "http://127.0.0.2:1/small")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path == "/small":
+            data = json.dumps({"a": 1}).encode()
+        else:
+            data = b"x" * int(self.path.split("/")[-1])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json" if self.path == "/small" else "application/octet-stream")
+        if not self.path.startswith("/chunked"):
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for start in range(0, len(data), 1000):
+            chunk = data[start:start + 1000]
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.clients = set()
+    server.cookies = [] # Cookie header of each /login request
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", server
+    server.shutdown()
+    server.server_close()
+
+def test_RequestEngine_reuse_connection(server):
+    url, http_server = server
+    engine = RequestEngine.RequestEngine()
+    for _ in range(5):
+        result = engine.request("GET", url + "/small")
+        assert result["status"] == 200 and json.loads(RequestEngine.RequestEngine.text(result)) == {"a": 1}
+    # one connection for all requests
+    assert len(http_server.clients) == 1
+    engine.close()
+    with pytest.raises(AttributeError):
+        engine.request("GET", "file:///etc/passwd")
+
+def test_RequestEngine_large_response(server):
+    url, _ = server
+    engine = RequestEngine.RequestEngine(memory_size=1000, max_size=50000, chunk_size=512)
+    result = engine.request("GET", url + "/file/20000")
+    assert result["body"] is None and os.path.getsize(result["path"]) == 20000 and result["path"].endswith(".bin")
+    RequestEngine.RequestEngine.cleanup(result)
+    assert not os.path.exists(result["path"])
+    # over max size, by content length and while streaming
+    with pytest.raises(ValueError):
+        engine.request("GET", url + "/file/60000")
+    with pytest.raises(ValueError):
+        engine.request("GET", url + "/chunked/60000")
+    assert engine.request("GET", url + "/chunked/900")["body"] == b"x" * 900
+
+def test_RequestEngine_redirect_not_followed(server):
+    url, http_server = server
+    engine = RequestEngine.RequestEngine()
+    result = engine.request("GET", url + "/redirect")
+    # the session stay with the host it is pooled under
+    assert result["status"] == 302 and result["headers"]["Location"] == "http://127.0.0.2:1/small"
+    assert engine.request("GET", url + "/small")["status"] == 200 and len(http_server.clients) == 1
+    engine.close()
+
+def test_RequestEngine_cookies_not_shared(server):
+    url, http_server = server
+    engine = RequestEngine.RequestEngine()
+    # same pooled session for both requests, cookie set for the first sender is not sent for the second
+    engine.request("GET", url + "/login")
+    engine.request("GET", url + "/login")
+    assert len(http_server.clients) == 1
+    assert http_server.cookies == [None, None]
+    engine.close()
@@ -0,0 +1,70 @@
+from datetime import datetime
+import pytest
+import sys
+sys.path.append(f"{__file__}/../../../emalia_src")
+import Scheduler
+
+def test_PollScheduler_backoff():
+    scheduler = Scheduler.PollScheduler(min_interval=5, max_interval=60, backoff=2)
+    noon = datetime(2024, 1, 1, 12, 0)
+    assert [scheduler.next_interval(now=noon) for _ in range(5)] == [10, 20, 40, 60, 60]
+    # activity or backlog reset to min_interval
+    assert scheduler.next_interval(activity=1, now=noon) == 5
+    assert scheduler.next_interval(now=noon) == 10
+    assert scheduler.next_interval(backlog=3, now=noon) == 5
+    with pytest.raises(ValueError):
+        Scheduler.PollScheduler(min_interval=10, max_interval=5)
+
+def test_PollScheduler_quiet_hours():
+    scheduler = Scheduler.PollScheduler(min_interval=5, max_interval=60, quiet_hours=[["23:00", "07:00"]], quiet_interval=1800)
+    assert scheduler.quiet_remaining(datetime(2024, 1, 1, 12, 0)) == 0
+    assert scheduler.quiet_remaining(datetime(2024, 1, 1, 23, 30)) == 7.5 * 3600
+    assert scheduler.next_interval(now=datetime(2024, 1, 1, 2, 0)) == 1800
+    # never wait past the end of quiet hours
+    assert scheduler.next_interval(now=datetime(2024, 1, 1, 6, 50)) == 600
+    assert scheduler.next_interval(activity=1, now=datetime(2024, 1, 1, 2, 0)) == 5
+    assert scheduler.next_interval(now=datetime(2024, 1, 1, 7, 0)) == 10
+
+def test_PriorityScheduler_weighted_fair():
+    scheduler = Scheduler.PriorityScheduler(weights={"fast": 3, "slow": 1}, max_wait=-1)
+    for i in range(8):
+        scheduler.put(f"slow{i}", "slow")
+        scheduler.put(f"fast{i}", "fast")
+    served = [scheduler.get(now=0) for _ in range(8)]
+    assert [job[:4] for job in served].count("fast") == 6
+    assert served[:4].count("slow0") == 1
+    # order is kept in a class, a class alone is served at full speed
+    assert [job for job in served if job.startswith("fast")] == [f"fast{i}" for i in range(6)]
+    assert len(scheduler) == 8
+    while scheduler.get(now=0) is not None:
+        pass
+    assert len(scheduler) == 0
+    statistics = scheduler.statistics(now=0)
+    assert statistics["fast"]["served"] == 8 and statistics["slow"]["queued"] == 0
+
+def test_PriorityScheduler_aging():
+    scheduler = Scheduler.PriorityScheduler(weights={"fast": 100, "slow": 1}, max_wait=10)
+    scheduler.put("slow", "slow")
+    for i in range(5):
+        scheduler.put(f"fast{i}", "fast")
+    now = Scheduler.time.monotonic()
+    assert scheduler.get(now=now) == "fast0"
+    # waited over max_wait, served before fast jobs
+    assert scheduler.get(now=now + 11) == "slow"
+    assert scheduler.statistics(now=now + 11)["slow"]["max_wait"] >= 11
+    # unknown class get weight 1
+    scheduler.put("other", "other")
+    assert "other" in scheduler.statistics()
+
+def test_PriorityScheduler_ready():
+    scheduler = Scheduler.PriorityScheduler(weights={"fast": 1, "slow": 1}, max_wait=-1)
+    scheduler.put("python1", "slow")
+    scheduler.put("request1", "slow")
+    scheduler.put("fast1", "fast")
+    not_python = lambda job: not job.startswith("python")
+    # blocked job keep its place, next ready job of its class is served
+    assert {scheduler.get(now=0, ready=not_python), scheduler.get(now=0, ready=not_python)} == {"request1", "fast1"}
+    assert scheduler.get(now=0, ready=not_python) is None and len(scheduler) == 1
+    # blocked job is not counted as served
+    assert scheduler.statistics(now=0)["slow"]["served"] == 1
+    assert scheduler.get(now=0) == "python1"
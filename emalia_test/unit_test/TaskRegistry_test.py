@@ -0,0 +1,44 @@
+import pytest
+import sys
+sys.path.append(f"{__file__}/../../../emalia_src")
+import TaskRegistry
+
+def new_registry():
+    return TaskRegistry.TaskRegistry({
+        "?": {"function": print, "name": "Get help", "trigger": ["?", "help", ""]},
+        "1": {"function": print, "name": "Get File", "trigger": ["1", "READ"]}
+    })
+
+def test_TaskRegistry_find():
+    registry = new_registry()
+    assert registry.find("read") == "1" and registry.find("Read") == "1" and registry.find("1") == "1"
+    assert registry.find("") == "?"
+    assert registry.find("write") is None
+    assert registry.get(registry.find("help"))["name"] == "Get help"
+    assert registry.get("2") is None
+    # views are read only
+    with pytest.raises(TypeError):
+        registry.tasks["2"] = {}
+    with pytest.raises(TypeError):
+        registry.triggers["write"] = "2"
+
+def test_TaskRegistry_register():
+    registry = new_registry()
+    tasks = registry.tasks
+    registry.register("report", {"function": print, "name": "Report", "trigger": ["daily"]})
+    assert registry.find("daily") == "report" and registry.find("report") == "report"
+    # old view is not changed
+    assert "report" not in tasks
+    with pytest.raises(ValueError):
+        registry.register("other", {"function": print, "name": "Other", "trigger": ["read"]})
+    assert "other" not in registry.tasks and registry.find("read") == "1"
+    # a registered key is only replaced on request
+    with pytest.raises(ValueError):
+        registry.register("1", {"function": print, "name": "Other", "trigger": ["other"]})
+    assert registry.find("read") == "1" and registry.find("other") is None
+    registry.register("report", {"function": print, "name": "Report 2", "trigger": ["weekly"]}, replace=True)
+    assert registry.find("weekly") == "report" and registry.find("daily") is None
+    registry.unregister("report")
+    assert registry.find("daily") is None
+    with pytest.raises(ValueError):
+        TaskRegistry.TaskRegistry({"1": {"trigger": ["a"]}, "2": {"trigger": ["a"]}})